@@ -23,6 +23,10 @@ from conversion import parse_labels
 from conversion.antsUtil import antsReg, applyXform
 from conversion import num2str
 
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import cached, tool_identity, ANTSREG_OUTPUTS
+
 eps= 2.204e-16
 inf= 65535.
 
@@ -85,6 +89,50 @@ def form_bins(interval):
     return interval
 
 
+def min_over_grads(data, bse_data, where_dwi, grad_axis):
+    "1/b0 * min_i(b0-Gi) over the gradient volumes where_dwi of data"
+
+    # prevent division by zero during normalization
+    bse_data= np.maximum(bse_data, 1.)
+    extend_bse = np.expand_dims(bse_data, grad_axis)
+    extend_bse = np.repeat(extend_bse, len(where_dwi), grad_axis)
+    curtail_dwi = np.take(data, where_dwi, axis=grad_axis)
+
+    # 1 / b0 * min(b0 - Gi)
+    minOverGrads = np.min(extend_bse - curtail_dwi, axis=grad_axis) / bse_data
+
+    # another way to prevent division by zero: 1/b0 * min(b0-Gi) with condition at b0~eps
+    # minOverGrads = np.min(extend_bse - curtail_dwi, axis=grad_axis) / (bse_data + eps)
+    # minOverGrads[(bse_data < eps) & (minOverGrads < 5 * eps)] = 0.
+    # minOverGrads[(bse_data < eps) & (minOverGrads > 5 * eps)] = 10.
+
+    return minOverGrads
+
+def roi_stats(labelMap, label2name, fa, md, ad, rd, minOverGradsNegativeMask, evals_zero_mask, mk):
+    "DataFrame of the statistics of each label of labelMap, with labels as rows and stats as columns"
+
+    df= pd.DataFrame(columns= ['region','FA_mean','FA_std','MD_mean','MD_std',
+                                        'AD_mean','AD_std','RD_mean','RD_std',
+                                        'total_{min_i(b0-Gi)<0}','total_evals<0',
+                                        'MK_mean','MK_std',])
+
+    for i,label in enumerate(label2name.keys()):
+        roi = labelMap == int(label)
+
+        properties= [num2str(x) for x in [fa[roi>0].mean(), fa[roi>0].std(),
+                                          md[roi>0].mean(), md[roi>0].std(),
+                                          ad[roi>0].mean(), ad[roi>0].std(),
+                                          rd[roi>0].mean(), rd[roi>0].std(),
+                                          minOverGradsNegativeMask[roi>0].sum(), evals_zero_mask[roi>0].sum(),
+                                          mk[roi>0].mean(), mk[roi>0].std()]
+                     ]
+
+
+        df.loc[i]= [label2name[label]]+ properties
+
+    return df.set_index('region')
+
+
 class quality(cli.Application):
     """
     This script finds various DWMRI quality attributes:
@@ -219,19 +267,7 @@ class quality(cli.Application):
         b0File= outPrefix + '_b0' + outFormat
         save_map(b0File, bse_data, affine, hdr)
 
-        # prevent division by zero during normalization
-        bse_data[bse_data < 1] = 1.
-        extend_bse = np.expand_dims(bse_data, grad_axis)
-        extend_bse = np.repeat(extend_bse, len(where_dwi), grad_axis)
-        curtail_dwi = np.take(data, where_dwi, axis=grad_axis)
-
-        # 1 / b0 * min(b0 - Gi)
-        minOverGrads = np.min(extend_bse - curtail_dwi, axis=grad_axis) / bse_data
-
-        # another way to prevent division by zero: 1/b0 * min(b0-Gi) with condition at b0~eps
-        # minOverGrads = np.min(extend_bse - curtail_dwi, axis=grad_axis) / (bse_data + eps)
-        # minOverGrads[(bse_data < eps) & (minOverGrads < 5 * eps)] = 0.
-        # minOverGrads[(bse_data < eps) & (minOverGrads > 5 * eps)] = 10.
+        minOverGrads = min_over_grads(data, bse_data, where_dwi, grad_axis)
 
         minOverGradsNegativeMask = (minOverGrads < 0) * 1
 
@@ -304,7 +340,11 @@ class quality(cli.Application):
 
         # perform roi based analysis
         if self.template and self.labelMap:
-            antsReg(b0File, self.maskFile, self.template, outPrefix)
+            cached(lambda: antsReg(b0File, self.maskFile, self.template, outPrefix),
+                   ['antsReg', b0File, self.maskFile, self.template, outPrefix],
+                   inputs= [b0File, self.maskFile, self.template],
+                   outputs= [outPrefix+x for x in ANTSREG_OUTPUTS],
+                   version= tool_identity('antsRegistration'))
             warp = outPrefix+ '1Warp.nii.gz'
             trans = outPrefix+ '0GenericAffine.mat'
             outLabelMapFile = outPrefix + '_labelMap.nii.gz'
@@ -320,26 +360,7 @@ class quality(cli.Application):
             print('Creating ROI based statistics ...')
             stat_file= outPrefix + f'_{self.name}_stat.csv'
 
-            df= pd.DataFrame(columns= ['region','FA_mean','FA_std','MD_mean','MD_std',
-                                                'AD_mean','AD_std','RD_mean','RD_std',
-                                                'total_{min_i(b0-Gi)<0}','total_evals<0',
-                                                'MK_mean','MK_std',])
-
-            for i,label in enumerate(label2name.keys()):
-                roi = outLabelMap == int(label)
-
-                properties= [num2str(x) for x in [fa[roi>0].mean(), fa[roi>0].std(),
-                                                  md[roi>0].mean(), md[roi>0].std(),
-                                                  ad[roi>0].mean(), ad[roi>0].std(),
-                                                  rd[roi>0].mean(), rd[roi>0].std(),
-                                                  minOverGradsNegativeMask[roi>0].sum(), evals_zero_mask[roi>0].sum(),
-                                                  mk[roi>0].mean(), mk[roi>0].std()]
-                             ]
-
-
-                df.loc[i]= [label2name[label]]+ properties
-
-            df= df.set_index('region')
+            df= roi_stats(outLabelMap, label2name, fa, md, ad, rd, minOverGradsNegativeMask, evals_zero_mask, mk)
             # print(df)
             df.to_csv(stat_file)
             print('See ', os.path.abspath(stat_file))
@@ -5,8 +5,6 @@ from plumbum import cli
 from os.path import dirname, join, basename, abspath, isdir
 from os import mkdir
 from shutil import rmtree
-import psutil
-import multiprocessing
 import pandas as pd
 import nibabel as nib
 import numpy as np
@@ -14,6 +12,10 @@ from conversion import parse_labels, read_imgs_masks, num2str
 from subprocess import check_call
 SCRIPTDIR=dirname(__file__)
 
+import sys
+sys.path.append(dirname(dirname(abspath(__file__))))
+from util import cpu_pool
+
 def dwi_quality_wrapper(imgPath, maskPath, bvalFile, bvecFile,
                         mk_low_high, fa_low_high, md_low_high, out_dir, name, template, labelMap, lut):
         
@@ -122,10 +124,8 @@ class quality_batch(cli.Application):
 
         imgs, masks = read_imgs_masks(self.imagelist)
 
-        if int(self.N_proc)==-1:
-            self.N_proc= psutil.cpu_count()
-
-        pool= multiprocessing.Pool(int(self.N_proc))
+        # -1 and oversized requests are limited to the available cores
+        pool= cpu_pool(self.N_proc)
         for imgPath, maskPath in zip(imgs, masks):
             imgPath= imgPath
             inPrefix= imgPath.split('.')[0]
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+'''Per-invocation profiling of external commands.
+
+Once enable_trace() is called, every child process started through subprocess, hence by plumbum
+(`cmd & FG`, `cmd()`) and check_call() alike, is recorded with its wall time, user/sys CPU time,
+peak RSS, and bytes read/written. The records are appended to a JSON-lines trace file as the
+children finish, and a summary table per tool is printed when the script exits.
+'''
+
+import os, sys, json, time, atexit, subprocess, threading
+from os.path import basename, join as pjoin
+
+# seconds between psutil samples of the running children
+TRACE_INTERVAL= 0.5
+
+_trace_file= None
+_live= {}
+_lock= threading.Lock()
+_sampler= None
+
+
+def _tree(pid):
+    import psutil
+    try:
+        proc= psutil.Process(pid)
+        return [proc]+proc.children(recursive=True)
+    except psutil.Error:
+        return []
+
+
+def _sample():
+    '''Keeps the peak RSS of each child's process tree and the latest io/cpu counters of each process in it'''
+
+    import psutil
+    while True:
+        with _lock:
+            procs= list(_live.values())
+
+        for p in procs:
+            rss= 0
+            for proc in _tree(p.pid):
+                try:
+                    with proc.oneshot():
+                        rss+= proc.memory_info().rss
+                        cpu= proc.cpu_times()
+                        p._trace_cpu[proc.pid]= (cpu.user, cpu.system)
+                        try:
+                            io= proc.io_counters()
+                            p._trace_io[proc.pid]= (io.read_chars, io.write_chars)
+                        except AttributeError:
+                            # io_counters() is not available on macOS
+                            pass
+                except psutil.Error:
+                    pass
+            p._trace_rss= max(p._trace_rss, rss)
+
+        time.sleep(TRACE_INTERVAL)
+
+
+def _ensure_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler= threading.Thread(target=_sample, daemon=True)
+        _sampler.start()
+
+
+def _reset_after_fork():
+    # the sampler thread does not survive fork, pool workers start their own
+    global _lock, _live, _sampler
+    _lock= threading.Lock()
+    _live= {}
+    _sampler= None
+
+
+class TracedPopen(subprocess.Popen):
+
+    def __init__(self, *args, **kwargs):
+        self._trace_start= time.time()
+        self._trace_rusage= None
+        self._trace_rss= 0
+        self._trace_cpu= {}
+        self._trace_io= {}
+        self._trace_final_io= None
+        self._trace_done= False
+        super().__init__(*args, **kwargs)
+
+        with _lock:
+            _live[self.pid]= self
+        _ensure_sampler()
+
+    def _try_wait(self, wait_flags):
+        # same as subprocess.Popen._try_wait, but os.wait4 also gives the resource usage of the finished child
+        try:
+            # before reaping, the zombie's io counters include those of all its descendants
+            if hasattr(os, 'waitid') and \
+                    os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT | wait_flags) is not None:
+                self._read_final_io()
+
+            (pid, sts, rusage)= os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            pid= self.pid
+            sts= 0
+            rusage= None
+
+        if pid==self.pid:
+            self._trace_rusage= rusage
+        return (pid, sts)
+
+    def _read_final_io(self):
+        import psutil
+        try:
+            io= psutil.Process(self.pid).io_counters()
+            self._trace_final_io= (io.read_chars, io.write_chars)
+        except (psutil.Error, AttributeError):
+            pass
+
+    def _handle_exitstatus(self, sts, *args, **kwargs):
+        super()._handle_exitstatus(sts, *args, **kwargs)
+        if not self._trace_done:
+            self._trace_done= True
+            _record(self)
+
+
+def _record(p):
+
+    with _lock:
+        _live.pop(p.pid, None)
+
+    args= p.args if isinstance(p.args, (list, tuple)) else str(p.args).split()
+    rusage= p._trace_rusage
+
+    if rusage:
+        # rusage includes all waited-for descendants
+        user, system= rusage.ru_utime, rusage.ru_stime
+    else:
+        user= sum(c[0] for c in p._trace_cpu.values())
+        system= sum(c[1] for c in p._trace_cpu.values())
+
+    # ru_maxrss also counts the parent's pages shared with the child between fork and exec,
+    # so the sampled peak of the process tree is preferred and ru_maxrss (kB on Linux, bytes on macOS)
+    # only used for children that finished before the first sample
+    maxrss= p._trace_rss
+    if not maxrss and rusage:
+        maxrss= rusage.ru_maxrss*(1 if sys.platform=='darwin' else 1024)
+
+    if p._trace_final_io:
+        read_bytes, write_bytes= p._trace_final_io
+    else:
+        read_bytes= sum(io[0] for io in p._trace_io.values())
+        write_bytes= sum(io[1] for io in p._trace_io.values())
+
+    record= {'script': basename(sys.argv[0]),
+             'pid': p.pid,
+             'tool': basename(str(args[0])) if args else '',
+             'cmd': [str(a) for a in args],
+             'start': p._trace_start,
+             'wall': time.time()-p._trace_start,
+             'user': user,
+             'sys': system,
+             'maxrss': maxrss,
+             'read_bytes': read_bytes,
+             'write_bytes': write_bytes,
+             'returncode': p.returncode}
+
+    # O_APPEND writes of a single line do not interleave between pool workers
+    with open(_trace_file, 'a') as f:
+        f.write(json.dumps(record)+'\n')
+
+
+def read_trace(trace_file):
+    with open(trace_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    '''Summary table of the records per tool, the most time consuming first'''
+
+    tools= {}
+    for r in records:
+        t= tools.setdefault(r['tool'], {'calls': 0, 'wall': 0., 'user': 0., 'sys': 0., 'maxrss': 0,
+                                         'read_bytes': 0, 'write_bytes': 0})
+        t['calls']+= 1
+        for key in ['wall', 'user', 'sys', 'read_bytes', 'write_bytes']:
+            t[key]+= r[key]
+        t['maxrss']= max(t['maxrss'], r['maxrss'])
+
+    MB= 1024.**2
+    lines= ['{:<32}{:>7}{:>11}{:>11}{:>11}{:>13}{:>12}{:>12}'.format(
+        'tool', 'calls', 'wall (s)', 'user (s)', 'sys (s)', 'maxrss (MB)', 'read (MB)', 'write (MB)')]
+    for tool, t in sorted(tools.items(), key=lambda x: -x[1]['wall']):
+        lines.append('{:<32}{:>7}{:>11.1f}{:>11.1f}{:>11.1f}{:>13.1f}{:>12.1f}{:>12.1f}'.format(
+            tool[:31], t['calls'], t['wall'], t['user'], t['sys'],
+            t['maxrss']/MB, t['read_bytes']/MB, t['write_bytes']/MB))
+
+    return '\n'.join(lines)
+
+
+def _print_summary(pid):
+    # pool workers inherit the atexit handler through fork, only the script itself prints
+    if os.getpid()!=pid or not os.path.exists(_trace_file):
+        return
+
+    print('\nExternal commands run by {}, see {}'.format(basename(sys.argv[0]), _trace_file))
+    print(summarize(read_trace(_trace_file)))
+
+
+def enable_trace(trace_dir):
+    '''Records every child process of this script to trace_dir/<script>-<pid>.jsonl'''
+
+    global _trace_file
+    if _trace_file:
+        return _trace_file
+
+    os.makedirs(trace_dir, exist_ok=True)
+    _trace_file= pjoin(trace_dir, '{}-{}.jsonl'.format(basename(sys.argv[0]) or 'python', os.getpid()))
+
+    subprocess.Popen= TracedPopen
+    # plumbum binds subprocess.Popen at import time
+    plumbum_local= sys.modules.get('plumbum.machines.local')
+    if plumbum_local is not None and hasattr(plumbum_local, 'Popen'):
+        plumbum_local.Popen= TracedPopen
+
+    os.register_at_fork(after_in_child=_reset_after_fork)
+    atexit.register(_print_summary, os.getpid())
+
+    return _trace_file
+
+
+if __name__ == '__main__':
+    # summarize existing trace files: _proctrace.py trace1.jsonl trace2.jsonl ...
+    records= []
+    for trace_file in sys.argv[1:]:
+        records+= read_trace(trace_file)
+    print(summarize(records))
@@ -4,7 +4,7 @@ from plumbum import cli
 import numpy as np
 from numpy import matrix, diag, linalg, vstack, hstack, array
 
-from util import load_nifti, save_nifti
+from util import load_nifti_parallel, save_nifti
 
 from conversion.bval_bvec_io import bvec_rotate
 
@@ -104,7 +104,8 @@ class Xalign(cli.Application):
 
 
         if self.img_file.endswith('.nii') or self.img_file.endswith('.nii.gz'):
-            mri= load_nifti(self.img_file._path)
+            # the whole image is rewritten, outputs of save_nifti() are inflated in parallel
+            mri= load_nifti_parallel(self.img_file._path)
         else:
             print('Invalid image format, accepts nifti only')
             exit(1)
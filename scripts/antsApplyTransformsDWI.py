@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory
+from util import logfmt, TemporaryDirectory, TMP_EXT, intermediate_env, compress_nifti, cpu_pool, nifti_nbytes
 from plumbum import local, cli, FG
 from plumbum.cmd import WarpImageMultiTransform, fslsplit, fslmaths, fslmerge
 
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
-from multiprocessing import Pool
 
 
 def _WarpImage(dwimask, vol, xfm):
@@ -15,12 +14,71 @@ def _WarpImage(dwimask, vol, xfm):
     if dwimask:
         fslmaths[vol, '-mas', dwimask, vol]
 
-    volwarped = vol.stem + '-warped.nii.gz'
+    volwarped = vol.stem + '-warped' + TMP_EXT
     WarpImageMultiTransform('3', vol, volwarped, '-R', vol, xfm)
 
     return volwarped
 
 
+def antsApplyTransformsDWI(dwi, xfm, out, dwimask=None, nproc=8, debug=False):
+    '''Applies the transform xfm to each volume of the DWI and saves the warped DWI to out.
+    With debug, the temporary directory is copied to antsApplyTransformsDWi-<pid> next to out.'''
+
+    # the inputs are read from within the temporary directory
+    dwi, xfm, out= local.path(dwi), local.path(xfm), local.path(out)
+    dwimask= local.path(dwimask) if dwimask else dwimask
+    # diced volumes, their warped float copies, and the merged DWI
+    expected_size= 3*nifti_nbytes(dwi, 'float32')
+    with TemporaryDirectory(expected_size=expected_size) as tmpdir, local.cwd(tmpdir), intermediate_env():
+        tmpdir = local.path(tmpdir)
+        dicePrefix = 'vol'
+
+        logging.info("Dice DWI")
+        fslsplit[dwi] & FG
+
+        logging.info("Apply warp to each DWI volume")
+        vols = sorted(tmpdir // (dicePrefix + '*' + TMP_EXT))
+
+        # use the following multi-processed loop
+        pool= cpu_pool(nproc)
+        res= []
+        for vol in vols:
+            res.append(pool.apply_async(_WarpImage, (dwimask, vol, xfm)))
+
+        volsWarped= [r.get() for r in res]
+        pool.close()
+        pool.join()
+
+
+        # or use the following for loop
+        # volsWarped = []
+        # for vol in vols:
+        #     if dwimask:
+        #         fslmaths[vol, '-mas', dwimask, vol]
+        #     volwarped = vol.stem + '-warped' + TMP_EXT
+        #     WarpImageMultiTransform('3', vol, volwarped, '-R', vol, xfm)
+        #     volsWarped.append(volwarped)
+
+        logging.info("Join warped volumes together")
+
+        volsWarped.sort()
+        dwiwarped = tmpdir / ('dwiwarped' + TMP_EXT)
+        fslmerge['-t', dwiwarped, volsWarped] & FG
+
+        # only the final output is compressed
+        compress_nifti(dwiwarped, out)
+
+
+        logging.info('Made ' + str(out))
+
+        if debug:
+            from os import getpid
+            pid = str(getpid())
+            d = local.path(out.dirname /
+                           ('antsApplyTransformsDWi-' + pid))
+            tmpdir.copy(d)
+
+
 class App(cli.Application):
     """Applies a transformation to a DWI nrrd, with option of masking first.
     (Used by epi.py)"""
@@ -38,50 +96,7 @@ class App(cli.Application):
         becomes sluggish/you run into memory error, reduce --nproc''', default= 8)
 
     def main(self):
-        with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
-            tmpdir = local.path(tmpdir)
-            dicePrefix = 'vol'
-
-            logging.info("Dice DWI")
-            fslsplit[self.dwi] & FG
-
-            logging.info("Apply warp to each DWI volume")
-            vols = sorted(tmpdir // (dicePrefix + '*.nii.gz'))
-
-            # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
-            res= []
-            for vol in vols:
-                res.append(pool.apply_async(_WarpImage, (self.dwimask, vol, self.xfm)))
-
-            volsWarped= [r.get() for r in res]
-            pool.close()
-            pool.join()
-
-
-            # or use the following for loop
-            # volsWarped = []
-            # for vol in vols:
-            #     if self.dwimask:
-            #         fslmaths[vol, '-mas', self.dwimask, vol]
-            #     volwarped = vol.stem + '-warped.nii.gz'
-            #     WarpImageMultiTransform('3', vol, volwarped, '-R', vol, self.xfm)
-            #     volsWarped.append(volwarped)
-
-            logging.info("Join warped volumes together")
-
-            volsWarped.sort()
-            fslmerge['-t', self.out, volsWarped] & FG
-
-
-            logging.info('Made ' + str(self.out))
-
-            if self.debug:
-                from os import getpid
-                pid = str(getpid())
-                d = local.path(self.out.dirname /
-                               ('antsApplyTransformsDWi-' + pid))
-                tmpdir.copy(d)
+        antsApplyTransformsDWI(self.dwi, self.xfm, self.out, self.dwimask, self.nproc, self.debug)
 
 
 if __name__ == '__main__':
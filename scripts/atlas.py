@@ -1,32 +1,19 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from plumbum import local, cli, FG
-from plumbum.cmd import ComposeMultiTransform, antsApplyTransforms, MeasureImageSimilarity, \
-    head, cut, antsRegistration
+from plumbum.cmd import ComposeMultiTransform, antsApplyTransforms, antsRegistration
 from itertools import zip_longest
-import pandas as pd
 from glob import glob
-import numpy as np
-import sys, os
-import multiprocessing
+import sys, os, hashlib
 from math import exp
-from conversion.antsUtil import antsReg
-from util import logfmt, save_nifti, TemporaryDirectory, load_nifti, N_CPU, N_PROC, dirname, pjoin
+from util import logfmt, save_nifti, TemporaryDirectory, load_nifti, N_PROC, dirname, pjoin, cpu_pool, \
+    ANTSREG_OUTPUTS, cached, tool_identity, load_nifti_lazy, as_nifti, TMP_EXT, crop_to_mask, \
+    nifti_nbytes, TaskManager, thread_env
+from atlas_bundle import downsampled, isBundle, readBundle, bundleTable, TrainingBundle, BUNDLE_EXT
 
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
 
 
-# determine ANTS_VERSION
-# $ antsRegistration --version
-#   ANTs Version: 2.2.0.dev233-g19285
-#   Compiled: Sep  2 2018 23:23:33
-
-antsVerFile='/tmp/ANTS_VERSION_'+os.environ['USER']
-(antsRegistration['--version'] > antsVerFile) & FG
-with open(antsVerFile) as f:
-      content=f.read().split('\n')
-      ANTS_VERSION= content[0].split()[-1]
-
 import logging
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO, format=logfmt(__file__))
@@ -38,6 +25,30 @@ ANTSJOINTFUSION_PARAMS = ['--search-radius', 5
                          ,'--alpha', 0.4
                          ,'--beta', 3.0]
 
+# memory for the slabs of warped labelmaps fused at a time by fuseLabels(), and of warped images by mutual_information()
+FUSION_SLAB_BYTES= 256*1024**2
+
+# intensity bins of each image in the joint histograms of mutual_information()
+MI_BINS= 32
+
+# memory for the patches of all atlases at the voxels fused together by fuseJointLabels()
+JLF_BATCH_BYTES= 64*1024**2
+
+# voxel size (mm) of the grid on which selectAtlases() compares the training images to the target
+SELECT_VOXEL= 4.
+
+# antsRegistration stages of the rigid alignment of the training images to the target on that grid
+SELECT_RIGID= ['--transform', 'Rigid[0.1]', '--convergence', '[20x10,1e-6,5]', '--shrink-factors', '2x1',
+               '--smoothing-sigmas', '1x0vox']
+
+# a registration or fusion task that fails, or runs longer than PNLPIPE_ATLAS_TIMEOUT seconds (0 for no limit),
+# is run again up to PNLPIPE_ATLAS_RETRIES times
+TASK_RETRIES= int(os.getenv('PNLPIPE_ATLAS_RETRIES', 1))
+TASK_TIMEOUT= float(os.getenv('PNLPIPE_ATLAS_TIMEOUT', 0)) or None
+
+# warp from the target to the template with --template, in the target's tmpdir
+TEMPLATE_WARP= 'template-warp.nii.gz'
+
 # with the omission of subcommands, this function is not used anymore
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
@@ -48,7 +59,9 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(fillvalue=fillvalue, *args)
 
 
-def computeWarp(image, target, out):
+def computeWarp(image, target, out, crop=False):
+
+    from conversion.antsUtil import antsReg
 
     with TemporaryDirectory() as tmpdir:
         tmpdir = local.path(tmpdir)
@@ -56,8 +69,19 @@ def computeWarp(image, target, out):
         warp = pre + '1Warp.nii.gz'
         affine = pre + '0GenericAffine.mat'
 
+        # with crop, the registration runs on the head only, the warp is composed on the full grid of target below
+        fixed, moving= target, image
+        if crop:
+            fixed= crop_to_mask(target, tmpdir / ('fixed'+TMP_EXT))
+            moving= crop_to_mask(image, tmpdir / ('moving'+TMP_EXT))
+
         # pre is the prefix (directory) for saving 1Warp.nii.gz and 0GenericAffine.mat
-        antsReg(target, None, image, pre)
+        # the registration is reused from the cache if the same image was registered to the same target before
+        cached(lambda: antsReg(fixed, None, moving, pre),
+               ['antsReg', fixed, None, moving, pre],
+               inputs= [fixed, moving],
+               outputs= [pre+x for x in ANTSREG_OUTPUTS],
+               version= tool_identity('antsRegistration'))
 
         # out is Warp{idx}.nii.gz, saved in the specified output direcotry
         # ComposeMultiTransform combines the 1Warp.nii.gz and 0GenericAffine.mat into a Warp{idx}.nii.gz file
@@ -65,6 +89,37 @@ def computeWarp(image, target, out):
 
 
 
+def _templateWarp(image, template, warp, crop):
+
+    # a partial warp of an interrupted registration is never left under the final name
+    tmp= warp.with_suffix('.tmp.nii.gz', depth=2)
+    computeWarp(image, template, tmp, crop)
+    tmp.rename(warp)
+
+
+def templateWarps(template, images, warpdir, threads, crop=False, sources=None):
+    '''Warps from template to each of images, computed once, stored in warpdir, and reused by any later target'''
+
+    # images may be decoded copies, the warps are named after their sources, default: images,
+    # and those of cropped registrations are kept apart
+    warpdir= local.path(warpdir) / 'crop' if crop else local.path(warpdir)
+    warps= [warpdir / '{}-{}-warp.nii.gz'.format(os.path.basename(str(source)).split('.')[0],
+                                                   hashlib.sha1(os.path.abspath(str(source)).encode()).hexdigest()[:8])
+            for source in (sources or images)]
+    missing= [(image, template, warp, crop) for image, warp in zip(images, warps) if not warp.exists()]
+
+    if missing:
+        logging.info('Register {} training images to the template {}, saving warps to {}'
+                     .format(len(missing), template, warpdir))
+        warpdir.mkdir()
+        pool = cpu_pool(threads)
+        pool.starmap(_templateWarp, missing)
+        pool.close()
+        pool.join()
+
+    return warps
+
+
 def applyWarp(moving, warp, reference, out, interpolation='Linear'):
     '''Interpolation options:
     Linear
@@ -85,190 +140,734 @@ def applyWarp(moving, warp, reference, out, interpolation='Linear'):
                         '-o', out, '--interpolation', interpolation] & FG
 
 
-def computeMI(target, img, miFile):
+def _label_dtype(data):
+    # uint8/int16 labels are saved as such by save_nifti(), others as float32
+    if data.min()>=0 and data.max()<256:
+        return data.astype('uint8')
+    if data.min()>=-32768 and data.max()<32768:
+        return data.astype('int16')
+    return data
+
+
+def applyWarpLabels(labels, warp, reference, outs):
+    '''Warps the labelmaps of one training image by nearest neighbor into outs, in one call if on one grid'''
+
+    import numpy as np
+
+    imgs= [load_nifti_lazy(label) for label in labels]
+    if len(imgs)==1 or any(img.shape!=imgs[0].shape or len(img.shape)!=3 or not np.allclose(img.affine, imgs[0].affine)
+                           for img in imgs):
+        for label, out in zip(labels, outs):
+            applyWarp(label, warp, reference, out, interpolation='NearestNeighbor')
+        return
+
+    with TemporaryDirectory() as tmpdir:
+        tmpdir = local.path(tmpdir)
+        stacked= tmpdir / ('labels'+TMP_EXT)
+        warped= tmpdir / ('warped'+TMP_EXT)
+
+        data= _label_dtype(np.stack([np.asanyarray(img.dataobj) for img in imgs], axis=-1))
+        save_nifti(stacked, data, imgs[0].affine, imgs[0].header.copy())
+        del data
+
+        # -e 3: the input is a time series, each volume is warped by the same transform
+        antsApplyTransforms['-d', '3', '-e', '3', '-i', stacked, '-t', warp, '-r', reference,
+                            '-o', warped, '--interpolation', 'NearestNeighbor'] & FG
+
+        warped= load_nifti_lazy(warped)
+        hdr= load_nifti_lazy(reference).header
+        for k, out in enumerate(outs):
+            save_nifti(out, _label_dtype(np.asanyarray(warped.dataobj[..., k])), warped.affine, hdr.copy())
 
-    if ANTS_VERSION <= '2.1.0':
-        (MeasureImageSimilarity['3', '2', target, img] | head['-n', '-2'] | cut['-d ', '-f6'] > miFile)()
 
+def _bin_index(data, lo, hi, bins):
+    import numpy as np
+    scale= bins/(hi-lo) if hi>lo else 0
+    return np.clip(((data-lo)*scale).astype('int64'), 0, bins-1)
+
+
+def mutual_information(target, images, mask=None, bins=MI_BINS):
+    '''Negative mutual information between target and each of images on its grid, within mask if given'''
+
+    import numpy as np
+
+    target= np.asanyarray(as_nifti(target).dataobj, dtype='float32')
+    imgs= [as_nifti(img) for img in images]
+    if mask is None:
+        mask= np.ones(target.shape, dtype=bool)
+    elif isinstance(mask, np.ndarray):
+        mask= mask>0
     else:
-        (MeasureImageSimilarity['-d', '3', '-m', 'MI[{},{},1,256]'.format(target, img)] > miFile) & FG
+        mask= np.asanyarray(as_nifti(mask).dataobj)>0
+
+    N= len(imgs)
+    shape= target.shape
+    depth= max(1, int(FUSION_SLAB_BYTES//(N*shape[0]*shape[1]*(4+8))))
+    def slab(img, z):
+        return np.asanyarray(img.dataobj[..., z:z+depth], dtype='float32')[mask[..., z:z+depth]]
+
+    lo= np.full(N+1, np.inf)
+    hi= np.full(N+1, -np.inf)
+    t= target[mask]
+    if t.size:
+        lo[0], hi[0]= t.min(), t.max()
+    for z in range(0, shape[2], depth):
+        for k, img in enumerate(imgs, start=1):
+            data= slab(img, z)
+            if data.size:
+                lo[k], hi[k]= min(lo[k], data.min()), max(hi[k], data.max())
+
+    joint= np.zeros(N*bins*bins, dtype='int64')
+    for z in range(0, shape[2], depth):
+        t= _bin_index(target[..., z:z+depth][mask[..., z:z+depth]], lo[0], hi[0], bins)*bins
+        if not t.size:
+            continue
+        idx= np.concatenate([k*bins*bins+t+_bin_index(slab(img, z), lo[k+1], hi[k+1], bins)
+                             for k, img in enumerate(imgs)])
+        joint+= np.bincount(idx, minlength=N*bins*bins)
+
+    p= joint.reshape(N, bins, bins)/max(mask.sum(), 1)
+    pt= p.sum(axis=2, keepdims=True)
+    pi= p.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mi= np.where(p>0, p*np.log(p/(pt*pi)), 0).sum(axis=(1, 2))
+
+    return list(-mi)
+
+
+def correlation(target, images, mask=None):
+    '''Negative normalized cross correlation between target and each of images on its grid, within mask'''
+
+    import numpy as np
+
+    target= np.asanyarray(as_nifti(target).dataobj, dtype='float32')
+    mask= np.ones(target.shape, dtype=bool) if mask is None else mask>0
+    t= target[mask]-target[mask].mean()
+
+    ccs= []
+    for img in images:
+        data= np.asanyarray(as_nifti(img).dataobj, dtype='float32')[mask]
+        data-= data.mean()
+        norm= np.sqrt((t*t).sum()*(data*data).sum())
+        ccs.append(-float((t*data).sum()/norm) if norm else 0.)
+
+    return ccs
+
+
+def _center_of_mass(data, affine):
+    '''Intensity weighted center of data in world coordinates'''
+
+    import numpy as np
+
+    weights= np.clip(data, 0, None)
+    ijk= [(weights.sum(axis=tuple(a for a in range(3) if a!=axis))*np.arange(n)).sum() for axis, n in
+          enumerate(data.shape)]
+    return affine[:3, :3] @ (np.array(ijk)/max(weights.sum(), 1e-12)) + affine[:3, 3]
+
+
+def alignedToTarget(image, target_data, target_affine, voxel=SELECT_VOXEL):
+    '''image, or its (data, affine) preview, on the downsampled target grid after matching centers of mass'''
+
+    import numpy as np
+
+    data, affine= image if isinstance(image, tuple) else downsampled(image, voxel)
+    shift= _center_of_mass(data, affine)-_center_of_mass(target_data, target_affine)
+
+    ijk= np.stack(np.meshgrid(*[np.arange(n) for n in target_data.shape], indexing='ij'), axis=-1)
+    world= ijk @ target_affine[:3, :3].T + target_affine[:3, 3] + shift
+    ijk= np.rint((world-affine[:3, 3]) @ np.linalg.inv(affine[:3, :3]).T).astype(int)
+
+    inside= np.all((ijk>=0) & (ijk<data.shape), axis=-1)
+    out= np.zeros(target_data.shape, dtype='float32')
+    out[inside]= data[tuple(ijk[inside].T)]
+
+    return out
+
+
+def rigidToTarget(target, moving, prefix, out):
+    '''Registers moving to target rigidly by mutual information and saves it resampled on target to out'''
+
+    antsRegistration.with_env(**thread_env(1))['-d', '3', '--metric', 'MI[{},{},1,32]'.format(target, moving),
+                                                SELECT_RIGID, '--output', '[{},{}]'.format(prefix, out)]()
+
+
+def selectAtlases(target, trainingTable, K, metric='mi', previews=None, threads=1):
+    '''Rows of trainingTable of the K training images most similar to target by metric, mi or cc, once aligned'''
+
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from util import Nifti1Image
+
+    target_data, target_affine= downsampled(target, SELECT_VOXEL)
+    target_img= Nifti1Image(target_data, target_affine)
+
+    with TemporaryDirectory() as tmpdir:
+        tmpdir= local.path(tmpdir)
+        fixed= tmpdir / ('target' + TMP_EXT)
+        save_nifti(fixed, target_data, target_affine, target_img.header.copy())
+
+        def align(i, image):
+            # the centers of mass are matched, then the rigid alignment is refined on the downsampled images
+            moving= tmpdir / ('moving{}'.format(i) + TMP_EXT)
+            aligned= tmpdir / ('aligned{}'.format(i) + TMP_EXT)
+            data= alignedToTarget(previews[i] if previews else image, target_data, target_affine)
+            save_nifti(moving, data, target_affine, target_img.header.copy())
+            rigidToTarget(fixed, moving, tmpdir / 'rigid{}-'.format(i), aligned)
+            return Nifti1Image(np.array(load_nifti(str(aligned)).dataobj, dtype='float32'), target_affine)
+
+        with ThreadPoolExecutor(threads) as executor:
+            images= list(executor.map(align, trainingTable.index, trainingTable.iloc[:, 0]))
+
+    if metric=='mi':
+        scores= mutual_information(target_img, images)
+    else:
+        scores= correlation(target_img, images)
+
+    order= np.argsort(scores, kind='stable')
+    logging.info('Training images ranked by {} with the target, the lower, the more similar:'.format(metric))
+    for rank, i in enumerate(order, start=1):
+        logging.info('{:>4} {:>10.5f} {}{}'.format(rank, scores[i], trainingTable.iloc[i, 0],
+                                                  '' if rank<=K else '  (skipped)'))
+
+    return trainingTable.iloc[np.sort(order[:K])]
 
 
 def weightsFromMIExp(mis, alpha):
+    if max(mis) == min(mis):
+        return [1 / len(mis)] * len(mis)
     factor = alpha / (max(mis) - min(mis))
     weights = [exp(factor * (min(mis) - mi)) for mi in mis]
     return [w / sum(weights) for w in weights]
 
-def fuseWeightedAvg(labels, weights, out, target_header):
+def _vote(slab, weights, values):
+    '''Label of each voxel of slab with the largest sum of weights of the atlases voting for it, the lowest on ties'''
 
-    # for each label, fuse warped labelmaps to compute output labelmap
-    print("Apply weights to warped training {} et al., fuse, and threshold".format(labels[0]))
-    data= np.zeros(target_header['dim'][1:4], dtype= 'float32')
-    for label, w in zip(labels, weights):
-        data+= load_nifti(label._path).get_data()*w
+    import numpy as np
 
+    best= np.full(slab.shape[1:], -1, dtype='float32')
+    fused= np.zeros(slab.shape[1:], dtype=slab.dtype)
+    # the candidates are the labels, or the label of each atlas when there are fewer atlases than labels,
+    # and only the running best is kept, so that memory does not grow with the number of labels
+    for candidate in (values if len(values)<=len(slab) else slab):
+        vote= np.zeros(slab.shape[1:], dtype='float32')
+        for weight, atlas in zip(weights, slab):
+            vote+= weight*(atlas==candidate)
+        better= (vote>best) | ((vote==best) & (candidate<fused))
+        best[better]= vote[better]
+        np.copyto(fused, candidate, where=better)
 
-    # out is {labelname}.nii.gz
-    save_nifti(out, ((data>0.5)*1).astype('uint8'), target_header.get_best_affine(), target_header)
+    return fused
 
-    print("Made labelmap: " + out)
 
+def fuseLabels(labelmaps, weights, outs, target_header):
+    '''Fuses the warped labelmaps of every label column by weighted voting, slab by slab, into outs'''
 
-def fuseAntsJointFusion(target, images, labels, out):
-    from plumbum.cmd import antsJointFusion
+    import numpy as np
 
-    # images are the warped images atlas{idx}.nii.gz
-    # labelmaps are the warped labels {labelname}{idx}.nii.gz
-    # out is {labelname}.nii.gz
-    antsJointFusionArgs = \
-        ['-d', 3 ,'-t', target ,'-g'] + \
-        images + \
-        ['-l'] +  \
-        labels + \
-        ['-o', out] + \
-        ['--verbose']
+    weights= np.array(weights, dtype='float32')
+    shape= tuple(int(n) for n in target_header['dim'][1:4])
+    imgs= {labelname: [load_nifti_lazy(label) for label in labels] for labelname, labels in labelmaps.items()}
+    fused= {labelname: np.zeros(shape, dtype=np.result_type(*[img.get_data_dtype() for img in labels]))
+            for labelname, labels in imgs.items()}
 
-    antsJointFusion[antsJointFusionArgs] & FG
+    # a slab of every atlas and its float copy, and the votes, best votes, and labels of _vote()
+    itemsize= max(img.get_data_dtype().itemsize for labels in imgs.values() for img in labels)
+    depth= max(1, int(FUSION_SLAB_BYTES//(shape[0]*shape[1]*(len(weights)*(itemsize+4)+itemsize+10))))
 
-    print("Made labelmap: " + out)
+    print("Apply weights to warped training {} and fuse, {} slices at a time".format(', '.join(labelmaps), depth))
+    for z in range(0, shape[2], depth):
+        for labelname, labels in imgs.items():
+            slab= np.stack([np.asanyarray(img.dataobj[..., z:z+depth]) for img in labels])
+            values= np.unique(slab)
 
+            if set(values)<={0, 1}:
+                fused[labelname][..., z:z+depth]= np.tensordot(weights, slab, axes=1)>0.5
+            else:
+                fused[labelname][..., z:z+depth]= _vote(slab, weights, values)
 
-def fuseAvg(labels, out, target_header):
-    from plumbum.cmd import AverageImages
+    for labelname, data in fused.items():
+        # out is {labelname}.nii.gz
+        data= data.astype('uint8') if data.min()>=0 and data.max()<256 else data
+        save_nifti(outs[labelname], data, target_header.get_best_affine(), target_header.copy())
+        print("Made labelmap: " + outs[labelname])
 
-    with TemporaryDirectory() as tmpdir:
-        nii = local.path(tmpdir) / 'avg.nii.gz'
-        AverageImages['3', nii, '0', labels] & FG
 
-        img= load_nifti(nii._path)
-        # Binary operation, if out>0.5, pipe the output and save as {labelname}.nii.gz
-        # out is {labelname}.nii.gz
-        save_nifti(out, ((img.get_data()>0.5)*1).astype('uint8'), target_header.get_best_affine(), target_header)
+def fuseWeightedAvg(labels, weights, out, target_header):
 
+    # for each label, fuse warped labelmaps to compute output labelmap
+    fuseLabels({'label': labels}, weights, {'label': out}, target_header)
+
+
+def _jlf_params(args):
+    '''Parameters of fuseJointLabels() from the command line arguments of antsJointFusion'''
+
+    args= dict(zip(args[::2], args[1::2]))
+    return {'search': int(args['--search-radius']), 'patch': int(args['--patch-radius']),
+            'metric': args['--patch-metric'], 'nonneg': bool(int(args['--constrain-nonnegative'])),
+            'alpha': float(args['--alpha']), 'beta': float(args['--beta'])}
+
+
+def _box_sum(a, r):
+    '''Sums of a over its (2r+1)^3 windows, an array smaller than a by 2r along each axis'''
+
+    import numpy as np
+
+    w= 2*r+1
+    for axis in range(3):
+        c= np.cumsum(a, axis=axis)
+        head= [slice(None)]*3
+        tail= [slice(None)]*3
+        head[axis], tail[axis]= slice(w-1, None), slice(None, -w)
+        a= c[tuple(head)]
+        a[tuple([slice(None)]*axis+[slice(1, None)])]-= c[tuple(tail)]
+    return a
 
-    print("Made labelmap: " + out)
+
+def _patches(data, centers, r):
+    '''Flattened (2r+1)^3 patches of data around the voxels centers, an array of shape (len(centers), patch size)'''
+
+    import numpy as np
+
+    offsets= np.stack(np.meshgrid(*[np.arange(-r, r+1)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+    idx= centers[:, None, :]+offsets[None, :, :]
+    return data[idx[..., 0], idx[..., 1], idx[..., 2]]
+
+
+def _normalized(patches, pc):
+    import numpy as np
+
+    # the PC metric compares the patches after removing their mean and dividing by their standard deviation
+    if not pc:
+        return patches
+    patches= patches-patches.mean(axis=-1, keepdims=True)
+    std= np.sqrt((patches*patches).mean(axis=-1, keepdims=True))
+    return np.divide(patches, std, out=np.zeros_like(patches), where=std>0)
+
+
+def _jlf_weights(D, alpha, beta, nonneg):
+    '''Joint label fusion weights of each atlas at each voxel from the patch differences D'''
+
+    import numpy as np
+
+    u, N= D.shape[:2]
+    M= np.einsum('uip,ujp->uij', D, D)/D.shape[-1]
+    M= M**beta+alpha*np.eye(N)
+    active= np.ones((u, N), dtype=bool)
+
+    for _ in range(N if nonneg else 1):
+        # dropped atlases are decoupled from the others and given a zero right hand side
+        both= active[:, :, None] & active[:, None, :]
+        A= np.where(both, M, np.eye(N))
+        w= np.linalg.solve(A, active[..., None].astype('float64'))[..., 0]
+        w/= w.sum(axis=1, keepdims=True)
+        negative= w<0
+        if not nonneg or not negative.any():
+            break
+        active&= ~negative
+
+    return np.clip(w, 0, None) if nonneg else w
+
+
+def _joint_fusion_slab(target, images, labels, z, depth, params, scales):
+    '''Fuses the labelmaps of every label column between slices z and z+depth, see fuseJointLabels()'''
+
+    import numpy as np
+
+    r, s= params['patch'], params['search']
+    h= r+s
+    Z= target.shape[2]
+    end= min(z+depth, Z)
+    lo, hi= max(z-h, 0), min(end+h, Z)
+    pad= ((h, h), (h, h), (h-(z-lo), end+h-hi))
+
+    def read(img, dtype='float32'):
+        return np.pad(np.asanyarray(img.dataobj[..., lo:hi], dtype=dtype), pad)
+
+    core= (slice(None), slice(None), slice(z, end))
+    fused= {}
+    uncertain= np.zeros(target.shape[:2]+(end-z,), dtype=bool)
+    atlaslabels= {}
+    for labelname, imgs in labels.items():
+        slab= np.stack([np.asanyarray(img.dataobj[core]) for img in imgs])
+        fused[labelname]= slab[0].astype('int32')
+        # only the voxels where the atlases disagree need the patch search
+        uncertain|= (slab!=slab[0]).any(axis=0)
+        atlaslabels[labelname]= [read(img, img.get_data_dtype()) for img in imgs]
+
+    if not uncertain.any():
+        return fused
+
+    # intensities are brought to about unit range for the precision of the float32 box sums
+    T= read(target)/scales[0]
+    A= [read(img)/scale for img, scale in zip(images, scales[1:])]
+    N= len(A)
+    pc= params['metric']=='PC'
+    n= (2*r+1)**3
+
+    # the search runs over the bounding box of the uncertain voxels, in padded coordinates
+    where= np.argwhere(uncertain)
+    bmin, bmax= where.min(axis=0)+h, where.max(axis=0)+h+1
+    box= lambda m: tuple(slice(a-m, b+m) for a, b in zip(bmin, bmax))
+
+    Tbox= T[box(r)]
+    size= tuple(bmax-bmin)
+    # patch statistics at the uncertain voxels
+    queries= tuple((where+h-bmin).T)
+    Tmean= _box_sum(Tbox, r)[queries]/n
+    Tsq= _box_sum(Tbox*Tbox, r)[queries]/n
+    Tstd= np.sqrt(np.clip(Tsq-Tmean**2, 0, None))
+
+    # search offsets, the center first so that it wins ties
+    offsets= np.stack(np.meshgrid(*[np.arange(-s, s+1)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets= offsets[np.argsort(np.abs(offsets).sum(axis=1), kind='stable')]
+
+    best= np.zeros((N, len(where), 3), dtype=int)
+    for i, a in enumerate(A):
+        Abox= a[box(h)]
+        Amean= _box_sum(Abox, r)/n
+        Asq= _box_sum(Abox*Abox, r)/n
+        score= np.full(len(where), -np.inf)
+        for d in offsets:
+            shifted= tuple(slice(s+o, s+o+m+2*r) for o, m in zip(d, size))
+            cross= _box_sum(Tbox*Abox[shifted], r)[queries]/n
+            moved= tuple(q+s+o for q, o in zip(queries, d))
+            mean, sq= Amean[moved], Asq[moved]
+            if pc:
+                denom= Tstd*np.sqrt(np.clip(sq-mean**2, 0, None))
+                sim= np.divide(cross-Tmean*mean, denom, out=np.zeros_like(denom), where=denom>0)
+            else:
+                # minus the mean squared difference, from the mean squares of the two patches and their cross term
+                sim= 2*cross-Tsq-sq
+            better= sim>score
+            score[better]= sim[better]
+            best[i][better]= d
+
+    # the patches of all atlases at a batch of voxels at a time
+    batch= max(1, JLF_BATCH_BYTES//(N*n*8))
+    for k in range(0, len(where), batch):
+        centers= where[k:k+batch]+h
+        matches= best[:, k:k+batch]
+        Tp= _normalized(_patches(T, centers, r), pc)
+        D= np.stack([np.abs(_normalized(_patches(a, centers+matches[i], r), pc)-Tp) for i, a in enumerate(A)],
+                    axis=1)
+        weights= _jlf_weights(D, params['alpha'], params['beta'], params['nonneg'])
+
+        for labelname, imgs in atlaslabels.items():
+            # each atlas votes for its label at its best matching location
+            votes= np.stack([img[tuple((centers+matches[i]).T)] for i, img in enumerate(imgs)], axis=1)
+            values= np.unique(votes)
+            scores= np.stack([(weights*(votes==value)).sum(axis=1) for value in values])
+            fused[labelname][tuple(where[k:k+batch].T)]= values[np.argmax(scores, axis=0)]
+
+    return fused
+
+
+def fuseJointLabels(target, images, labelmaps, outs, target_header, threads=1, params=None):
+    '''Joint label fusion (Wang et al. 2013) of the warped labelmaps of every label column into outs'''
+
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+
+    params= params or _jlf_params(ANTSJOINTFUSION_PARAMS)
+    target= as_nifti(target)
+    images= [load_nifti_lazy(img) for img in images]
+    labels= {labelname: [load_nifti_lazy(label) for label in labelmaps[labelname]] for labelname in labelmaps}
+
+    shape= target.shape[:3]
+    h= params['patch']+params['search']
+
+    # PC is invariant to the scale of each image, MSQ needs the same scale for all
+    scales= [np.abs(np.asanyarray(img.dataobj[::4, ::4, ::4], dtype='float32')).max() or 1.
+             for img in [target]+images]
+    if params['metric']!='PC':
+        scales= [scales[0]]*len(scales)
+    # images and labelmaps of every atlas, their padded slabs, and the box sums of the search
+    depth= max(1, int(FUSION_SLAB_BYTES//(threads*(2*len(images)+4)*(shape[0]+2*h)*(shape[1]+2*h)*8))-2*h)
+
+    print("Joint label fusion of warped training {}, {} slices at a time".format(', '.join(labelmaps), depth))
+    fused= {labelname: np.zeros(shape, dtype='int32') for labelname in labelmaps}
+    with ThreadPoolExecutor(threads) as executor:
+        slabs= {z: executor.submit(_joint_fusion_slab, target, images, labels, z, depth, params, scales)
+                for z in range(0, shape[2], depth)}
+        for z, slab in slabs.items():
+            for labelname, data in slab.result().items():
+                fused[labelname][..., z:z+depth]= data
+
+    for labelname, data in fused.items():
+        data= data.astype('uint8') if data.min()>=0 and data.max()<256 else data
+        save_nifti(outs[labelname], data, target_header.get_best_affine(), target_header.copy())
+        print("Made labelmap: " + outs[labelname])
 
 
 def train2target(itr):
 
     idx, attr = itr
-    outdir, target= attr[-2: ]
-    r= attr[:-2]
+    outdir, target, warps, crop= attr[-4: ]
+    r= attr[:-4]
 
     print('Registering image {} to target'.format(idx))
     warp = outdir / 'warp{}.nii.gz'.format(idx)
-    atlas = outdir / 'atlas{}.nii.gz'.format(idx)
+    atlas = outdir / 'atlas{}{}'.format(idx, TMP_EXT)
     logging.info('Making {}'.format(atlas))
 
     # warp is computed among the first column images and the target image
     # then that warp is applied to images in other columns
     # assuming first column of the dictionary contains moving images
-    computeWarp(r[0], target, warp)  # first column of each row is used here
-    applyWarp(r[0], warp, target, atlas)  # first column of each row is used here
+    # pandas turns the None of warps into NaN
+    if not isinstance(warps, tuple):
+        computeWarp(r.iloc[0], target, warp, crop)  # first column of each row is used here
+    else:
+        # warps are (template to training image, target to template): their composition maps the target to the
+        # training image without registering them
+        ComposeMultiTransform('3', warp, '-R', target, *warps)
+    applyWarp(r.iloc[0], warp, target, atlas)  # first column of each row is used here
 
     # labelname is the column header and label is the image in the csv file
-    for labelname, label in r.iloc[1:].iteritems():  # rest of the columns of each row are used here
-        atlaslabel = outdir / '{}{}.nii.gz'.format(labelname,idx)
-        logging.info('Making {}'.format(atlaslabel))
+    labels= list(r.iloc[1:])  # rest of the columns of each row are used here
+    # warped labelmaps are left uncompressed for fuseLabels() to memory-map them
+    atlaslabels= [outdir / '{}{}{}'.format(labelname, idx, TMP_EXT) for labelname in r.index[1:]]
+    logging.info('Making {}'.format(', '.join(atlaslabels)))
+
+    # creates {labelname}{idx}.nii in the output directory
+    # applying Warp{idx}.nii.gz on each image under 'labelname' column in the csv file, all in one call
+    applyWarpLabels(labels, warp, target, atlaslabels)
+
+
+def _gunzip(src, dst):
+
+    import gzip, shutil
+    with gzip.open(src, 'rb') as fi, open(dst, 'wb') as fo:
+        shutil.copyfileobj(fi, fo, 4*1024*1024)
+
+
+def decodeTraining(trainingTable, outdir, pool):
+    '''Decompresses the training images and labelmaps into outdir and returns the table pointing to them'''
+
+    outdir= local.path(outdir)
+    decoded= trainingTable.copy()
+    jobs= []
+    for i, row in trainingTable.iterrows():
+        for column, path in row.items():
+            if str(path).endswith('.gz'):
+                # a directory per row keeps the names apart when training images share a basename
+                (outdir / str(i)).mkdir()
+                dst= outdir / str(i) / os.path.basename(str(path))[:-3]
+                jobs.append((str(path), str(dst)))
+                decoded.at[i, column]= str(dst)
+
+    pool.starmap(_gunzip, jobs)
+
+    return decoded
+
+
+def prepareTarget(target, trainingTable, tmpdir, threads, select=0, metric='mi',
+                  template=None, templateWarpDir=None, crop=False, bundle=None, sources=None):
+    '''Selects the training images for target and returns them with the rows of their registrations'''
+
+    # only the training images most similar to the target are registered and fused
+    if 0 < select < len(trainingTable):
+        trainingTable= selectAtlases(target, trainingTable, select, metric, bundle and bundle.previews, threads)
+    if bundle:
+        trainingTable= bundle.table(trainingTable.index)
+    if sources is not None:
+        sources= list(sources.loc[trainingTable.index])
+    trainingTable= trainingTable.reset_index(drop=True)
+
+    L= len(trainingTable)
+
+    if template:
+        # N registrations to the target are replaced by one, of the template, composed with the stored warps of
+        # the training images to the template
+        images= list(trainingTable.iloc[:, 0])
+        trainingWarps= templateWarps(template, images, templateWarpDir, threads, crop, sources)
+        # made by a task of makeAtlasesBatch() before the registrations of the rows
+        targetWarp= tmpdir / TEMPLATE_WARP
+        warps= [(trainingWarp, targetWarp) for trainingWarp in trainingWarps]
+    else:
+        warps= [None]*L
 
-        # creates {labelname}{idx}.nii.gz in the output directory
-        # applying Warp{idx}.nii.gz on each image under 'labelname' column in the csv file
+    import pandas as pd
+    multiDataFrame= pd.concat([trainingTable, pd.DataFrame({'tmpdir': [tmpdir]*L, 'target': [str(target)]*L,
+                                                            'warps': warps, 'crop': [crop]*L})], axis= 1)
 
+    return trainingTable, list(multiDataFrame.iterrows())
 
-        applyWarp(label,
-                  warp,
-                  target,
-                  atlaslabel,
-                  interpolation='NearestNeighbor')
 
+def fuseTarget(target, trainingTable, tmpdir, outPrefix, fusion, threads, debug, atlases=None):
+    '''Fuses the labelmaps warped to target in tmpdir, of atlases (default: all), into outPrefix'''
 
-def makeAtlases(target, trainingTable, outPrefix, fusion, threads, debug):
+    logging.info('Fuse warped labelmaps to compute output labelmaps')
+    if atlases is None:
+        atlases= range(len(trainingTable))
+    # the images and labelmaps of each label column are listed in the same order, for the weights to match them
+    atlasimages= [tmpdir / 'atlas{}{}'.format(idx, TMP_EXT) for idx in atlases]
 
-    with TemporaryDirectory() as tmpdir:
+    if fusion.lower() == 'wavg':
 
-        tmpdir = local.path(tmpdir)
+        ALPHA_DEFAULT= 0.45
 
-        L= len(trainingTable)
+        logging.info('Compute MI between warped images and target')
+        mis= mutual_information(target, atlasimages)
 
-        multiDataFrame= pd.concat([trainingTable, pd.DataFrame({'tmpdir': [tmpdir]*L, 'target': [str(target)]*L})], axis= 1)
+        with open(tmpdir+'/MI.txt','w') as fw:
+            for img, mi in zip(atlasimages, mis):
+                print('MI between {} and target: {}'.format(img, mi))
+                fw.write(img+','+str(mi)+'\n')
 
-        logging.info('Create {} atlases: compute transforms from images to target and apply over images'.format(L))
+        weights = weightsFromMIExp(mis, ALPHA_DEFAULT)
 
-        pool = multiprocessing.Pool(threads)  # Use all available cores, otherwise specify the number you want as an argument
+    target_header= load_nifti(str(target)).header
+    labelmaps= {}
+    outs= {}
+    for labelname in list(trainingTable)[1:]:  # list(d) gets column names
 
-        pool.map_async(train2target, multiDataFrame.iterrows())
+        outs[labelname] = os.path.abspath(outPrefix+ f'-{labelname}.nii.gz')
+        if os.path.exists(outs[labelname]):
+            os.remove(outs[labelname])
+        labelmaps[labelname]= [tmpdir / '{}{}{}'.format(labelname, idx, TMP_EXT) for idx in atlases]
 
-        pool.close()
-        pool.join()
+    if fusion.lower() == 'avg':
+        print(' ')
+        # all label columns are fused in one pass
+        fuseLabels(labelmaps, [1/len(atlasimages)]*len(atlasimages), outs, target_header)
 
-        logging.info('Fuse warped labelmaps to compute output labelmaps')
-        atlasimages = tmpdir // 'atlas*.nii.gz'
-        # sorting is required for applying weight to corresponding labelmap
-        atlasimages.sort()
+    elif fusion.lower() == 'wavg':
+        print(' ')
+        # all label columns are fused in one pass
+        fuseLabels(labelmaps, weights, outs, target_header)
 
-        if fusion.lower() == 'wavg':
+    elif fusion.lower() == 'antsjointfusion':
+        print(' ')
+        # atlasimages are the warped images
+        # labelmaps are the warped labels
+        # the patch search is done once for all label columns, in-process, with ANTSJOINTFUSION_PARAMS
+        fuseJointLabels(target, atlasimages, labelmaps, outs, target_header, threads)
 
-            ALPHA_DEFAULT= 0.45
+    else:
+        print('Unrecognized fusion option: {}. Skipping.'.format(fusion))
 
-            logging.info('Compute MI between warped images and target')
-            pool = multiprocessing.Pool(threads)
-            for img in atlasimages:
-                print('MI between {} and target'.format(img))
-                miFile= img+'.txt'
-                pool.apply_async(func= computeMI, args= (target, img, miFile, ))
+    if debug:
+        tmpdir.copy(pjoin(dirname(outPrefix), 'atlas-debug-' + str(os.getpid())))
 
-            pool.close()
-            pool.join()
 
-            mis= []
-            with open(tmpdir+'/MI.txt','w') as fw:
-
-                for img in atlasimages:
-                    with open(img+'.txt') as f:
-                        mi= f.read().strip()
-                        fw.write(img+','+mi+'\n')
-                        mis.append(float(mi))
-
-            weights = weightsFromMIExp(mis, ALPHA_DEFAULT)
-
-        target_header= load_nifti(target._path).header
-        pool = multiprocessing.Pool(threads)  # Use all available cores, otherwise specify the number you want as an argument
-        for labelname in list(trainingTable)[1:]:  # list(d) gets column names
-
-            out = os.path.abspath(outPrefix+ f'-{labelname}.nii.gz')
-            if os.path.exists(out):
-                os.remove(out)
-            labelmaps = tmpdir // (labelname + '*')
-            labelmaps.sort()
-
-            if fusion.lower() == 'avg':
-                print(' ')
-                # parellelize
-                # fuseAvg(labelmaps, out, target_header)
-                pool.apply_async(func= fuseAvg, args= (labelmaps, out, target_header, ))
-
-            elif fusion.lower() == 'antsjointfusion':
-                print(' ')
-                # atlasimages are the warped images
-                # labelmaps are the warped labels
-                # parellelize
-                # fuseAntsJointFusion(target, atlasimages, labelmaps, out)
-                pool.apply_async(func= fuseAntsJointFusion, args= (target, atlasimages, labelmaps, out, ))
-
-            elif fusion.lower() == 'wavg':
-                print(' ')
-                # parellelize
-                # fuseWeightedAvg(labelmaps, weights, out, target_header)
-                pool.apply_async(func= fuseWeightedAvg, args= (labelmaps, weights, out, target_header, ))
+def makeAtlases(target, trainingTable, outPrefix, fusion, threads, debug, select=0, metric='mi',
+                template=None, templateWarpDir=None, crop=False):
 
-            else:
-                print('Unrecognized fusion option: {}. Skipping.'.format(fusion))
+    makeAtlasesBatch([target], trainingTable, [outPrefix], fusion, threads, debug, select, metric,
+                     template, templateWarpDir, crop)
 
-        pool.close()
-        pool.join()
 
-        if debug:
-            tmpdir.copy(pjoin(dirname(outPrefix), 'atlas-debug-' + str(os.getpid())))
+def submitRegistrations(tasks, jobs, job):
+    '''Queues the train2target() tasks of the rows of job'''
+
+    logging.info('Create {} atlases of {}: compute transforms from images to target and apply over images'
+                 .format(len(job['rows']), job['target']))
+    name= os.path.basename(job['outPrefix'])
+    job['registrations']= [tasks.submit('{} atlas{} {}'.format(name, idx, os.path.basename(str(row.iloc[0]))),
+                                        train2target, (idx, row)) for idx, row in job['rows']]
+    job['left']= len(job['rows'])
+    for task in job['registrations']:
+        jobs[task]= job
+
+
+def makeAtlasesBatch(targets, trainingTable, outPrefixes, fusion, threads, debug, select=0, metric='mi',
+                     template=None, templateWarpDir=None, crop=False, bundle=None, retries=TASK_RETRIES,
+                     timeout=TASK_TIMEOUT):
+    '''Makes the labelmaps of several targets, registering and fusing them as tasks of one TaskManager'''
+
+    from contextlib import ExitStack
+
+    with ExitStack() as stack:
+
+        # the training images as listed in the csv or packed in the bundle, trainingTable may point to copies
+        sources= (bundleTable(bundle) if bundle else trainingTable).iloc[:, 0]
+
+        training= None
+        if bundle:
+            expected_size= sum(entry['nbytes'] for atlas in bundle['atlases'] for entry in atlas['files'].values())
+            decodedDir= local.path(stack.enter_context(TemporaryDirectory(expected_size=expected_size)))
+            logging.info('Read training images and labelmaps from the bundle {}'.format(bundle['path']))
+            training= TrainingBundle(bundle, decodedDir)
+            trainingTable= bundleTable(bundle)
+
+        elif len(targets) > 1:
+            expected_size= sum(nifti_nbytes(path) for path in trainingTable.values.ravel()
+                               if str(path).endswith('.gz'))
+            decodedDir= local.path(stack.enter_context(TemporaryDirectory(expected_size=expected_size)))
+            logging.info('Decode training images and labelmaps to {}'.format(decodedDir))
+            pool= cpu_pool(threads)
+            trainingTable= decodeTraining(trainingTable, decodedDir, pool)
+            pool.close()
+            pool.join()
+
+        if template:
+            # the training images are registered to the template once for all targets
+            images= training.table(trainingTable.index) if training else trainingTable
+            templateWarps(template, list(images.iloc[:, 0]), templateWarpDir, threads, crop, list(sources))
+
+        # each task runs antsRegistration with its share of the CPU budget, the target tmpdirs are entered in the
+        # outer stack so that the running tasks are killed before their temporary directories are removed
+        with TaskManager(threads, retries=retries, timeout=timeout) as tasks:
+            jobs= {}
+            for target, outPrefix in zip(targets, outPrefixes):
+                tmpdir = local.path(stack.enter_context(TemporaryDirectory()))
+                table, rows= prepareTarget(local.path(target), trainingTable, tmpdir, threads, select, metric,
+                                           template, templateWarpDir, crop, training, sources)
+
+                job= {'target': local.path(target), 'table': table, 'tmpdir': tmpdir, 'outPrefix': outPrefix,
+                      'rows': rows}
+                if template:
+                    # the registrations of the rows use the warp of the template to the target
+                    logging.info('Register template {} to {}'.format(template, target))
+                    job['template']= tasks.submit('{} template'.format(os.path.basename(outPrefix)), computeWarp,
+                                                  template, local.path(target), tmpdir / TEMPLATE_WARP, crop)
+                    jobs[job['template']]= job
+                else:
+                    submitRegistrations(tasks, jobs, job)
+
+            failed= []
+            try:
+                for task in tasks.finished():
+                    job= jobs[task]
+
+                    if task is job.get('template'):
+                        if task.status=='done':
+                            submitRegistrations(tasks, jobs, job)
+                        else:
+                            failed.append(job['outPrefix'])
+                        continue
+
+                    if task is job.get('fusion'):
+                        if task.status=='done':
+                            logging.info('Made ' + job['outPrefix'] + '-*.nii.gz')
+                        else:
+                            failed.append(job['outPrefix'])
+                        continue
+
+                    job['left']-= 1
+                    if job['left']:
+                        continue
+
+                    # only the atlases registered in the end are fused
+                    atlases= [idx for idx, t in enumerate(job['registrations']) if t.status=='done']
+                    if not atlases:
+                        logging.error('No atlas of {} could be made'.format(job['target']))
+                        failed.append(job['outPrefix'])
+                        continue
+                    if len(atlases) < len(job['registrations']):
+                        logging.warning('Fusing {} of the {} atlases of {}'.format(
+                            len(atlases), len(job['registrations']), job['target']))
+
+                    job['fusion']= tasks.submit('{} fusion'.format(os.path.basename(job['outPrefix'])), fuseTarget,
+                                                job['target'], job['table'], job['tmpdir'], job['outPrefix'], fusion,
+                                                tasks.threads, debug, atlases, front=True)
+                    jobs[job['fusion']]= job
+
+            finally:
+                print(tasks.report())
+
+        if failed:
+            raise RuntimeError('Failed to make the labelmaps of ' + ', '.join(failed))
 
 
 class Atlas(cli.Application):
@@ -299,7 +898,8 @@ class AtlasArgs(cli.Application):
         cli.Set("avg", "wavg", "antsJointFusion", case_sensitive=False),
         help='Also create predicted labelmap(s) by combining the atlas labelmaps: '
              'avg is naive mathematical average, wavg is weighted average where weights are computed from MI '
-             'between the warped atlases and target image, antsJointFusion is local weighted averaging', default='wavg')
+             'between the warped atlases and target image, antsJointFusion is joint label fusion, local weighted averaging '
+             'by patch similarity, in-process', default='wavg')
     out = cli.SwitchAttr(
         ['-o', '--outPrefix'],
         help='output prefix, output labelmaps are saved as outPrefix-mask.nii.gz, outPrefix-cingr.nii.gz, ...',
@@ -321,6 +921,17 @@ class AtlasArgs(cli.Application):
         help='number of processes/threads to use (-1 for all available)',
         default= N_PROC)
     debug = cli.Flag('-d', help='Debug mode, saves intermediate labelmaps to atlas-debug-<pid> in output directory')
+    select= cli.SwitchAttr('--select', int,
+        help='register and fuse only the K training images most similar to the target, ranked after a rigid '
+             'alignment on a downsampled grid (0 for all)',
+        default= 0)
+    metric= cli.SwitchAttr('--select-metric', cli.Set('mi', 'cc', case_sensitive=False),
+        help='similarity used to rank the training images for --select: '
+             'mi is mutual information, cc is normalized cross correlation',
+        default= 'mi')
+    crop= cli.Flag('--crop',
+        help='register the images cropped to the bounding box of the head, padded by PNLPIPE_CROP_PADDING mm, '
+             'which is faster on images with a large empty background')
 
     def main(self):
         images = self.images.split()
@@ -344,14 +955,11 @@ class AtlasArgs(cli.Application):
         trainingTable['image']= images
         for i, values in enumerate(labelcols):
             trainingTable[labelnames[i]]= values
+        import pandas as pd
         trainingTable= pd.DataFrame(trainingTable, columns=['image']+labelnames)
 
-        self.threads= int(self.threads)
-        if self.threads==-1 or self.threads>N_CPU:
-            self.threads= N_CPU
-
-        makeAtlases(self.target, trainingTable, self.out, self.fusions, self.threads, self.debug)
-        logging.info('Made ' + self.out + '-*.nii.gz')
+        makeAtlases(self.target, trainingTable, self.out, self.fusions, int(self.threads), self.debug,
+                    self.select, self.metric.lower(), crop=self.crop)
 
 
 # @Atlas.subcommand("csv")
@@ -367,29 +975,65 @@ class AtlasCsv(cli.Application):
     target = cli.SwitchAttr(
         ['-t', '--target'],
         cli.ExistingFile,
-        help='target image',
-        mandatory=True)
+        help='target image, required unless --targets is given')
+    targets = cli.SwitchAttr(
+        ['--targets'],
+        cli.ExistingFile,
+        help='text file with one target image and its output prefix per line, separated by a comma: '
+             'the registrations of all targets share one pool and the decoded training images')
     fusions = cli.SwitchAttr(
         ['--fusion'],
         cli.Set("avg", "wavg", "antsJointFusion", case_sensitive=False),
         help='Also create predicted labelmap(s) by combining the atlas labelmaps: '
              'avg is naive mathematical average, wavg is weighted average where weights are computed from MI '
-             'between the warped atlases and target image, antsJointFusion is local weighted averaging', default='wavg')
+             'between the warped atlases and target image, antsJointFusion is joint label fusion, local weighted averaging '
+             'by patch similarity, in-process', default='wavg')
     out = cli.SwitchAttr(
         ['-o', '--outPrefix'],
-        help='output prefix, output labelmaps are saved as outPrefix-mask.nii.gz, outPrefix-cingr.nii.gz, ...',
-        mandatory=True)
+        help='output prefix, output labelmaps are saved as outPrefix-mask.nii.gz, outPrefix-cingr.nii.gz, ...; '
+             'required with --target')
     threads= cli.SwitchAttr(['-n', '--nproc'],
         help='number of processes/threads to use (-1 for all available)',
         default= N_PROC)
     debug = cli.Flag('-d', help='Debug mode, saves intermediate labelmaps to atlas-debug-<pid> in output directory')
+    select= cli.SwitchAttr('--select', int,
+        help='register and fuse only the K training images most similar to the target, ranked after a rigid '
+             'alignment on a downsampled grid (0 for all)',
+        default= 0)
+    metric= cli.SwitchAttr('--select-metric', cli.Set('mi', 'cc', case_sensitive=False),
+        help='similarity used to rank the training images for --select: '
+             'mi is mutual information, cc is normalized cross correlation',
+        default= 'mi')
+    crop= cli.Flag('--crop',
+        help='register the images cropped to the bounding box of the head, padded by PNLPIPE_CROP_PADDING mm, '
+             'which is faster on images with a large empty background')
     csvFile = cli.SwitchAttr(['--train'],
-        help='--train t1; --train t2; --train trainingImages.csv; '
-        'see pnlNipype/docs/TUTORIAL.md to know what each value means')
+        help='--train t1; --train t2; --train trainingImages.csv; --train trainingImages.atlas, a bundle made by '
+        'atlas_bundle.py; see pnlNipype/docs/TUTORIAL.md to know what each value means')
+    template= cli.SwitchAttr('--template', cli.ExistingFile,
+        help='register the target to this template only, and compose that with the warps of the training images '
+             'to the template, computed on the first use and then reused')
+    templateWarpDir= cli.SwitchAttr('--template-warps',
+        help='directory of the warps of the training images to --template, '
+             'default: <training csv>-<template>-warps next to the training csv')
 
     # @cli.positional(cli.ExistingFile)
     def main(self):
-        
+
+        if self.targets:
+            targets, outPrefixes= [], []
+            with open(self.targets) as f:
+                for line in f:
+                    if line.strip():
+                        target, outPrefix= [x.strip() for x in line.split(',')]
+                        targets.append(target)
+                        outPrefixes.append(outPrefix)
+        elif self.target and self.out:
+            targets, outPrefixes= [self.target], [self.out]
+        else:
+            logging.error('Specify either --target and --outPrefix, or --targets')
+            sys.exit(1)
+
         if self.csvFile=='t1' or self.csvFile=='t2':
             PNLPIPE_SOFT = os.getenv('PNLPIPE_SOFT')
             if not PNLPIPE_SOFT:
@@ -399,10 +1043,25 @@ class AtlasCsv(cli.Application):
             self.csvFile=glob(PNLPIPE_SOFT+'/trainingDataT1AHCC-*/trainingDataT1Masks-hdr.csv')[0]
         elif self.csvFile=='t2':
             self.csvFile=glob(PNLPIPE_SOFT+'/trainingDataT2Masks-*/trainingDataT2Masks-hdr.csv')[0]
+
+        # a bundle packed next to the training csv, after its last change, is read in place of it
+        bundle= None
+        packed= os.path.splitext(self.csvFile)[0]+BUNDLE_EXT
+        if os.path.exists(packed) and os.path.getmtime(packed)>=os.path.getmtime(self.csvFile) \
+                and isBundle(packed):
+            self.csvFile= packed
+        if isBundle(self.csvFile):
+            bundle= readBundle(self.csvFile)
         
-        trainingTable = pd.read_csv(self.csvFile)
-        makeAtlases(self.target, trainingTable, self.out, self.fusions, int(self.threads), self.debug)
-        logging.info('Made ' + self.out + '-*.nii.gz')
+        templateWarpDir= self.templateWarpDir
+        if self.template and not templateWarpDir:
+            templateWarpDir= '{}-{}-warps'.format(os.path.splitext(self.csvFile)[0],
+                                                  os.path.basename(str(self.template)).split('.')[0])
+
+        import pandas as pd
+        trainingTable = bundleTable(bundle) if bundle else pd.read_csv(self.csvFile)
+        makeAtlasesBatch(targets, trainingTable, outPrefixes, self.fusions, int(self.threads), self.debug,
+                         self.select, self.metric.lower(), self.template, templateWarpDir, self.crop, bundle)
 
 
 if __name__ == '__main__':
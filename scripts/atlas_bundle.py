@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+from plumbum import cli, local
+import os, json, struct, gzip, shutil, mmap, tempfile
+from util import logfmt, as_nifti, load_nifti_lazy
+
+import logging
+logger = logging.getLogger()
+
+# A training bundle packs the images and labelmaps of a training csv into one file:
+#   MAGIC, offset and length of the index (uint64, little endian)
+#   the uncompressed nifti file of each image and labelmap, each starting on an ALIGN boundary,
+#   so that its data can be memory-mapped in place or copied out without decoding
+#   the float32 preview of each image, C order, on an ALIGN boundary
+#   the index, json: columns, and per row the offsets of its files, the affine, shape, and
+#   intensity statistics of its image, and the offset, shape, and affine of its preview
+MAGIC= b'PNLATLAS'
+_HEAD= struct.Struct('<8sQQ')
+ALIGN= 4096
+BUNDLE_EXT= '.atlas'
+
+# voxel size (mm) of the previews, atlas.selectAtlases() ranks the training images on them
+PREVIEW_VOXEL= 4.
+
+
+def downsampled(img, voxel):
+    '''Data of img on a grid of about voxel mm, subsampled by whole voxel steps, and the affine of that grid'''
+
+    import numpy as np
+
+    img= as_nifti(img)
+    zooms= np.array(img.header.get_zooms()[:3])
+    step= np.maximum(1, np.round(voxel/zooms)).astype(int)
+    data= np.asanyarray(img.dataobj[::step[0], ::step[1], ::step[2]], dtype='float32')
+    affine= img.affine.copy()
+    affine[:3, :3]= affine[:3, :3]*step
+
+    return data, affine
+
+
+def _pad(f):
+    f.write(b'\0'*(-f.tell() % ALIGN))
+    return f.tell()
+
+
+def packBundle(trainingTable, out, voxel=PREVIEW_VOXEL):
+    '''Packs the images (first column) and labelmaps (other columns) of trainingTable into the bundle out'''
+
+    import numpy as np
+
+    index= {'columns': list(trainingTable), 'preview_voxel': voxel, 'atlases': []}
+    # written under a temporary name and renamed, an interrupted pack must not leave a newer, broken bundle
+    # that atlas.py would prefer to the csv
+    out= os.path.abspath(str(out))
+    fd, tmp= tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(out), dir=os.path.dirname(out))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEAD.pack(MAGIC, 0, 0))
+
+            for _, row in trainingTable.iterrows():
+                atlas= {'files': {}}
+                for column, path in row.items():
+                    offset= _pad(f)
+                    opener= gzip.open if str(path).endswith('.gz') else open
+                    with opener(str(path), 'rb') as src:
+                        shutil.copyfileobj(src, f, 4*1024*1024)
+                    atlas['files'][column]= {'source': os.path.abspath(str(path)), 'offset': offset,
+                                             'nbytes': f.tell()-offset}
+
+                img= load_nifti_lazy(row.iloc[0])
+                data= np.asanyarray(img.dataobj, dtype='float32')
+                p1, p99= np.percentile(data, [1, 99])
+                atlas.update(affine= img.affine.tolist(), shape= list(img.shape),
+                             stats= {'min': float(data.min()), 'max': float(data.max()), 'mean': float(data.mean()),
+                                     'std': float(data.std()), 'p1': float(p1), 'p99': float(p99)})
+                del data
+
+                preview, affine= downsampled(img, voxel)
+                atlas['preview']= {'offset': _pad(f), 'shape': list(preview.shape), 'affine': affine.tolist()}
+                f.write(np.ascontiguousarray(preview, dtype='<f4').tobytes())
+
+                index['atlases'].append(atlas)
+                logging.info('Packed {}'.format(', '.join(str(x) for x in row)))
+
+            index_offset= f.tell()
+            data= json.dumps(index).encode()
+            f.write(data)
+            f.seek(0)
+            f.write(_HEAD.pack(MAGIC, index_offset, len(data)))
+        # mkstemp() makes the file private, a bundle gets the permissions of a file created by open()
+        umask= os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, out)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def isBundle(path):
+    with open(path, 'rb') as f:
+        head= f.read(_HEAD.size)
+    if len(head)<_HEAD.size:
+        return False
+    magic, offset, _= _HEAD.unpack(head)
+    # the index offset is only written once the bundle is complete
+    return magic==MAGIC and offset>0
+
+
+def readBundle(path):
+    '''Index of the bundle path, see packBundle()'''
+
+    with open(path, 'rb') as f:
+        magic, offset, length= _HEAD.unpack(f.read(_HEAD.size))
+        if magic!=MAGIC:
+            raise ValueError('{} is not a training bundle'.format(path))
+        if not offset:
+            raise ValueError('{} is an incomplete training bundle'.format(path))
+        f.seek(offset)
+        index= json.loads(f.read(length).decode())
+
+    index['path']= os.path.abspath(str(path))
+    return index
+
+
+def bundleTable(index):
+    '''Training table of the source files of a bundle, for logging and naming'''
+
+    import pandas as pd
+    return pd.DataFrame([[atlas['files'][column]['source'] for column in index['columns']]
+                         for atlas in index['atlases']], columns=index['columns'])
+
+
+def bundlePreview(index, row):
+    '''Preview of the image of row of a bundle and its affine'''
+
+    import numpy as np
+
+    preview= index['atlases'][row]['preview']
+    data= np.memmap(index['path'], dtype='<f4', mode='r', offset=preview['offset'], shape=tuple(preview['shape']))
+    return np.array(data), np.array(preview['affine'])
+
+
+def extractBundle(index, rows, outdir):
+    '''Copies the files of rows of a bundle to outdir/<row>/, as uncompressed nifti files named after their sources,
+    and returns the training table pointing to them'''
+
+    outdir= local.path(outdir)
+    table= bundleTable(index).loc[list(rows)]
+    with open(index['path'], 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        for row in rows:
+            (outdir / str(row)).mkdir()
+            for column, entry in index['atlases'][row]['files'].items():
+                name= os.path.basename(entry['source'])
+                dst= outdir / str(row) / (name[:-3] if name.endswith('.gz') else name)
+                with open(dst, 'wb') as out:
+                    out.write(buf[entry['offset']:entry['offset']+entry['nbytes']])
+                table.at[row, column]= str(dst)
+
+    return table
+
+
+class TrainingBundle(object):
+    '''Training set of atlas.py in a bundle: previews read in place, files extracted to outdir for ANTs on first use'''
+
+    def __init__(self, index, outdir):
+        self.index= index
+        self.outdir= outdir
+        self.previews= [bundlePreview(index, row) for row in range(len(index['atlases']))]
+        self.extracted= {}
+
+    def table(self, rows):
+        '''Training table of rows pointing to their files in outdir'''
+
+        import pandas as pd
+        missing= [row for row in rows if row not in self.extracted]
+        if missing:
+            for row, paths in extractBundle(self.index, missing, self.outdir).iterrows():
+                self.extracted[row]= paths
+
+        return pd.DataFrame([self.extracted[row] for row in rows], index=list(rows))
+
+
+class App(cli.Application):
+    '''Packs the training images and labelmaps of a training csv into one bundle, uncompressed and memory-mappable,
+    with the affine, intensity statistics, and downsampled preview of each training image.
+    atlas.py --train reads it in place of the csv, and --train t1/t2 use trainingData*-hdr.atlas next to the csv
+    if present. atlas.py ranks the training images on the previews read from the bundle, and extracts the files
+    of the selected ones, uncompressed, for ANTs.'''
+
+    csvFile= cli.SwitchAttr(['--train'], cli.ExistingFile,
+        help='training csv: images in the first column, labelmaps in the others', mandatory=True)
+    out= cli.SwitchAttr(['-o', '--output'],
+        help='output bundle, default: the training csv with extension '+BUNDLE_EXT)
+    voxel= cli.SwitchAttr('--voxel', float, help='voxel size (mm) of the previews', default=PREVIEW_VOXEL)
+
+    def main(self):
+
+        import pandas as pd
+        out= self.out or os.path.splitext(self.csvFile)[0]+BUNDLE_EXT
+        packBundle(pd.read_csv(self.csvFile), out, self.voxel)
+        logging.info('Made ' + out)
+
+
+if __name__ == '__main__':
+    # atlas.py imports this module and configures logging itself
+    logging.basicConfig(level=logging.INFO, format=logfmt(__file__))
+    App.run()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+from plumbum import local, cli
+from subprocess import STDOUT
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os.path import basename, dirname, abspath, isfile, getsize
+import os, sys, json, time, socket, hashlib
+
+from util import logfmt, FILEDIR, pjoin, N_CPU, N_PROC
+
+import logging
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format=logfmt(__file__))
+
+
+def read_caselist(filename):
+    '''Reads a caselist like conversion.read_imgs_masks does: one case per line, its files separated by commas,
+    e.g. dwi1,mask1\\ndwi2,mask2. Returns a list of rows.'''
+
+    with open(filename) as f:
+        return [[x.strip() for x in line.split(',')] for line in f.read().split('\n') if line.strip()]
+
+
+def case_id(row):
+    # prefix of the first file, as dwi_quality_batch.py names cases
+    return basename(row[0]).split('.')[0]
+
+
+def case_cmd(script, args, row):
+    '''Command line of script for one case, args may refer to the columns {0}, {1}, ... of the row,
+    the case id {case}, and the directory of the first column {dir}'''
+
+    if isfile(pjoin(FILEDIR, script)):
+        script= pjoin(FILEDIR, script)
+
+    fields= {'case': case_id(row), 'dir': dirname(abspath(row[0]))}
+    return [script]+[x.format(*row, **fields) for x in args]
+
+
+def read_state(stateDir, case):
+    try:
+        with open(pjoin(stateDir, case+'.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(fname, obj):
+    # rename is atomic, a crash never leaves a half written file for readers
+    tmp= pjoin(dirname(fname), '.'+basename(fname))
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, fname)
+
+
+def write_state(stateDir, case, state):
+    _write_json(pjoin(stateDir, case+'.json'), state)
+
+
+def run_case(case, cmd, stateDir, cores=1):
+    '''Runs cmd for one case with a CPU budget of cores, logging to stateDir/<case>.log,
+    and persists the outcome to stateDir/<case>.json. A failure is recorded, not raised.'''
+
+    start= time.time()
+    write_state(stateDir, case, {'status': 'running', 'cmd': cmd, 'start': start})
+
+    with open(pjoin(stateDir, case+'.log'), 'w') as log:
+        try:
+            p= local[cmd[0]][cmd[1:]].with_env(PNLPIPE_NCPU=str(cores)).popen(stdout=log, stderr=STDOUT)
+            returncode= p.wait()
+        except Exception as e:
+            # e.g. the script is not found, the case fails but the batch goes on
+            log.write(repr(e)+'\n')
+            returncode= -1
+
+    state= {'status': 'failed' if returncode else 'done', 'cmd': cmd, 'start': start,
+            'duration': time.time()-start, 'returncode': returncode}
+    write_state(stateDir, case, state)
+
+    return case, state
+
+
+def job_cores(cmd):
+    '''Cores a script asks for through its --nproc/-n argument, 1 if it has none, the CPU budget for -1'''
+
+    for i, arg in enumerate(cmd[1:], 1):
+        if arg in ['-n', '--nproc'] and i+1<len(cmd):
+            value= cmd[i+1]
+        elif arg.startswith('--nproc='):
+            value= arg.split('=', 1)[1]
+        else:
+            continue
+        try:
+            return N_CPU if int(value)==-1 else int(value)
+        except ValueError:
+            break
+    return 1
+
+
+def total_memory():
+    import psutil
+    return psutil.virtual_memory().total/1024**3
+
+
+class Job(object):
+    '''A case to run with the cores and memory (GB) it needs'''
+
+    def __init__(self, case, cmd, stateDir, cores=1, mem=0):
+        self.case= case
+        self.cmd= cmd
+        self.stateDir= stateDir
+        self.cores= cores
+        self.mem= mem
+
+    def run(self, cores=None):
+        return run_case(self.case, self.cmd, self.stateDir, cores or self.cores)
+
+    def to_dict(self):
+        return {'case': self.case, 'cmd': self.cmd, 'stateDir': self.stateDir, 'cores': self.cores, 'mem': self.mem}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
+class Packer(object):
+    '''Runs jobs on threads while their cores and memory fit in the capacity. Jobs are taken in the order given,
+    smaller later jobs are started ahead when a larger one does not fit. A job larger than the capacity
+    runs alone, clamped to it.'''
+
+    def __init__(self, cores, mem, max_jobs=None):
+        self.cores= cores
+        self.mem= mem
+        self.max_jobs= max_jobs or cores
+        self.running= {}
+        self.executor= ThreadPoolExecutor(self.max_jobs)
+
+    def free(self):
+        return (self.cores-sum(j.cores for j in self.running.values()),
+                self.mem-sum(j.mem for j in self.running.values()))
+
+    def fits(self, job):
+        cores, mem= self.free()
+        if len(self.running)>=self.max_jobs:
+            return False
+        if not self.running:
+            return True
+        return min(job.cores, self.cores)<=cores and (not job.mem or min(job.mem, self.mem)<=mem)
+
+    def start(self, job):
+        self.running[self.executor.submit(job.run, min(job.cores, self.cores))]= job
+
+    def finished(self, timeout=None):
+        '''Waits up to timeout for running jobs to finish, returns [(job, (case, state)), ...]'''
+
+        done, _= wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        return [(self.running.pop(f), f.result()) for f in done]
+
+
+class LocalBackend(object):
+    '''Runs the jobs on this machine, as many at a time as fit in its cores and memory'''
+
+    def __init__(self, cores=N_CPU, mem=None, max_jobs=None):
+        self.packer= Packer(cores, mem or total_memory(), max_jobs)
+
+    def run(self, jobs):
+        '''Yields (case, state) as jobs finish'''
+
+        pending= list(jobs)
+        while pending or self.packer.running:
+            for job in [j for j in pending]:
+                if self.packer.fits(job):
+                    pending.remove(job)
+                    self.packer.start(job)
+
+            for _, result in self.packer.finished():
+                yield result
+
+
+# seconds after which a running spool job whose worker stopped renewing it is queued again
+SPOOL_LEASE= 600
+
+
+def spool_key(job):
+    '''Name of a job in the spool without its queue position: the case and a hash of its state directory and command,
+    the same for a resubmission of the job'''
+
+    digest= hashlib.sha1(json.dumps([job.stateDir, job.cmd]).encode()).hexdigest()[:12]
+    return '{}-{}'.format(job.case, digest)
+
+
+def requeue_stale(spoolDir, lease=SPOOL_LEASE):
+    '''Moves the jobs of spoolDir/running whose worker has not renewed them for lease seconds, e.g. because it died,
+    back to spoolDir/queue'''
+
+    queue, running= pjoin(spoolDir, 'queue'), pjoin(spoolDir, 'running')
+    now= time.time()
+    for name in os.listdir(running):
+        try:
+            if now-os.path.getmtime(pjoin(running, name))>lease:
+                os.rename(pjoin(running, name), pjoin(queue, name))
+                logging.warning('Queued {} again, its worker stopped renewing it'.format(name))
+        except OSError:
+            # renewed, finished, or queued again by another process meanwhile
+            pass
+
+
+class SpoolBackend(object):
+    '''Queues the jobs as files in spoolDir/queue, from where spool_worker() processes on any machine sharing
+    spoolDir claim them by renaming them into spoolDir/running. Finished jobs are reported in spoolDir/done.'''
+
+    def __init__(self, spoolDir, poll=5, lease=SPOOL_LEASE):
+        self.spoolDir= spoolDir
+        self.poll= poll
+        self.lease= lease
+        for d in ['queue', 'running', 'done']:
+            os.makedirs(pjoin(spoolDir, d), exist_ok=True)
+
+    def run(self, jobs):
+        '''Yields (case, state) as workers finish jobs'''
+
+        # a job left queued or running by an earlier submission of the same batch is waited for instead of queued
+        # again, the outcome it left in done is already in the state directory and the job is queued again
+        spooled= {}
+        for d in ['queue', 'running', 'done']:
+            for name in os.listdir(pjoin(self.spoolDir, d)):
+                if not name.startswith('.'):
+                    spooled[name.split('-', 1)[-1]]= (d, name)
+
+        # the name orders the queue, workers claim the jobs in this order
+        names= {}
+        for i, job in enumerate(jobs):
+            key= spool_key(job)+'.json'
+            if key in spooled:
+                d, name= spooled[key]
+                if d!='done':
+                    logging.info('{} is already in the spool as {}/{}'.format(job.case, d, name))
+                    names[name]= job.case
+                    continue
+                os.remove(pjoin(self.spoolDir, d, name))
+            name= '{:06d}-{}'.format(i, key)
+            _write_json(pjoin(self.spoolDir, 'queue', name), job.to_dict())
+            names[name]= job.case
+
+        while names:
+            for name in [n for n in names if os.path.exists(pjoin(self.spoolDir, 'done', n))]:
+                with open(pjoin(self.spoolDir, 'done', name)) as f:
+                    state= json.load(f)
+                os.remove(pjoin(self.spoolDir, 'done', name))
+                yield names.pop(name), state
+            if names:
+                requeue_stale(self.spoolDir, self.lease)
+                time.sleep(self.poll)
+
+
+def spool_worker(spoolDir, cores=N_CPU, mem=None, max_jobs=None, poll=5, exit_when_empty=False, lease=SPOOL_LEASE):
+    '''Claims and runs jobs from spoolDir/queue while they fit in cores and mem (GB), until the queue is empty
+    if exit_when_empty, forever otherwise. The jobs it runs are renewed every poll seconds, and those of
+    a worker that stopped renewing them for lease seconds are queued again.'''
+
+    queue, running, done= [pjoin(spoolDir, d) for d in ['queue', 'running', 'done']]
+    for d in [queue, running, done]:
+        os.makedirs(d, exist_ok=True)
+
+    worker= '{}-{}'.format(socket.gethostname(), os.getpid())
+    packer= Packer(cores, mem or total_memory(), max_jobs)
+    names= {}
+
+    while True:
+        # renew the jobs this worker runs
+        for name in names.values():
+            try:
+                os.utime(pjoin(running, name))
+            except OSError:
+                pass
+        requeue_stale(spoolDir, lease)
+
+        for name in sorted(x for x in os.listdir(queue) if x.endswith('.json')):
+            try:
+                with open(pjoin(queue, name)) as f:
+                    job= Job.from_dict(json.load(f))
+            except (OSError, ValueError):
+                continue
+            if not packer.fits(job):
+                continue
+
+            # only one worker succeeds in renaming the job out of the queue
+            try:
+                os.rename(pjoin(queue, name), pjoin(running, name))
+                os.utime(pjoin(running, name))
+            except OSError:
+                continue
+            logging.info('{} runs {}'.format(worker, job.case))
+            packer.start(job)
+            names[job]= name
+
+        if packer.running:
+            for job, (case, state) in packer.finished(timeout=poll):
+                name= names.pop(job)
+                state['worker']= worker
+                _write_json(pjoin(done, name), state)
+                try:
+                    os.remove(pjoin(running, name))
+                except OSError:
+                    # queued again meanwhile, its lease had expired
+                    pass
+                logging.info('{} {} {}'.format(worker, case, state['status']))
+        elif exit_when_empty and not os.listdir(queue):
+            return
+        else:
+            time.sleep(poll)
+
+
+def expected_durations(cases, stateDir):
+    '''Expected duration of each case: its duration in an earlier batch if known, otherwise estimated from
+    the size of its files at the median seconds per byte of the cases with a known duration.
+    Without any known duration, the sizes alone rank the cases.'''
+
+    size= {}
+    for case, row in cases.items():
+        size[case]= sum(getsize(x) for x in row if isfile(x)) or 1
+
+    known= {case: read_state(stateDir, case).get('duration') for case in cases}
+    rates= sorted(known[c]/size[c] for c in cases if known[c])
+    rate= rates[len(rates)//2] if rates else 1
+
+    return {c: known[c] if known[c] else rate*size[c] for c in cases}
+
+
+class App(cli.Application):
+    '''Runs a pnlNipype script for every case of a caselist.
+    The outcome of each case is saved in the state directory, so a rerun skips the cases that are done.
+    Cases expected to take longest are started first.
+
+    Usage: batch.py -i caselist.csv [-n NJOBS] [--backend spool --spool DIR] -- script.py [script arguments]
+           batch.py --worker --spool DIR [--cores N] [--memory GB]
+
+    script.py is looked up in pnlNipype/scripts first. Its arguments may refer to the files of a case
+    by column {0}, {1}, ..., to the case id (prefix of the first file) by {case}, and to the directory of the
+    first file by {dir}, e.g.
+
+        batch.py -i caselist.csv -n 4 -- bse.py -i {0} -m {1} -o {dir}/{case}_bse.nii.gz
+
+    Each case needs the cores given to the script by its --nproc/-n argument (1 if none) and --mem GB.
+    The local backend runs as many cases at a time as fit in the cores and memory of this machine.
+    The spool backend queues the cases in a directory, from where `batch.py --worker` processes,
+    on this or other machines sharing the directory, run them.'''
+
+    caselist = cli.SwitchAttr(['-i', '--input'], cli.ExistingFile,
+        help='csv/txt file with the files of one case per line: dwi1,mask1\\ndwi2,mask2\\n...')
+    stateDir = cli.SwitchAttr(['-s', '--state'],
+        help='directory to save the state and log of each case (default: caselist prefix + .batch)')
+    nproc = cli.SwitchAttr(['-n', '--nproc'],
+        help='maximum number of cases to process in parallel (-1 for as many as fit)', default=N_PROC)
+    mem = cli.SwitchAttr(['--mem'], float, help='memory needed by each case in GB', default=0)
+    force = cli.Flag(['--force'], help='rerun the cases that are already done', default=False)
+
+    backend = cli.SwitchAttr(['--backend'], cli.Set('local', 'spool'), help='where the cases run', default='local')
+    spoolDir = cli.SwitchAttr(['--spool'], help='spool directory shared by the batch and the workers')
+    poll = cli.SwitchAttr(['--poll'], float, help='seconds between polls of the spool directory', default=5)
+    lease = cli.SwitchAttr(['--lease'], float, default=SPOOL_LEASE,
+        help='seconds after which a spool job whose worker stopped renewing it, e.g. because it died, is queued again')
+
+    worker = cli.Flag(['--worker'], help='run the jobs queued in --spool instead of submitting a batch', default=False)
+    cores = cli.SwitchAttr(['--cores'], int, help='cores available to the worker', default=N_CPU)
+    memory = cli.SwitchAttr(['--memory'], float, help='memory available to the worker in GB (default: all)')
+    exit_when_empty = cli.Flag(['--exit-when-empty'], help='worker exits when the queue is empty', default=False)
+
+    def main(self, *args):
+
+        max_jobs= None if int(self.nproc)==-1 else int(self.nproc)
+
+        if self.worker:
+            if not self.spoolDir:
+                logging.error('--worker needs --spool')
+                sys.exit(1)
+            spool_worker(self.spoolDir, self.cores, self.memory, max_jobs, self.poll, self.exit_when_empty,
+                         self.lease)
+            return
+
+        if not self.caselist or not args:
+            logging.error('Provide a caselist with -i and a script to run after --')
+            sys.exit(1)
+        script, args= args[0], args[1:]
+
+        if not self.stateDir:
+            self.stateDir= os.path.splitext(self.caselist._path)[0]+'.batch'
+        self.stateDir= abspath(self.stateDir)
+        os.makedirs(self.stateDir, exist_ok=True)
+
+        cases= {}
+        for row in read_caselist(self.caselist):
+            case= case_id(row)
+            if case in cases:
+                logging.error('Duplicate case {} in {}'.format(case, self.caselist))
+                sys.exit(1)
+            cases[case]= row
+
+        cmds= {case: case_cmd(script, args, row) for case, row in cases.items()}
+        def done(case):
+            state= read_state(self.stateDir, case)
+            return state.get('status')=='done' and state.get('cmd')==cmds[case]
+
+        todo= [case for case in cases if self.force or not done(case)]
+        logging.info('{} cases, {} already done'.format(len(cases), len(cases)-len(todo)))
+
+        # longest expected first, so that the long cases do not start last and stretch the batch
+        expected= expected_durations({c: cases[c] for c in todo}, self.stateDir)
+        todo.sort(key=lambda c: -expected[c])
+        jobs= [Job(case, cmds[case], self.stateDir, job_cores(cmds[case]), self.mem) for case in todo]
+
+        if self.backend=='spool':
+            if not self.spoolDir:
+                logging.error('--backend spool needs --spool')
+                sys.exit(1)
+            backend= SpoolBackend(self.spoolDir, self.poll, self.lease)
+        else:
+            backend= LocalBackend(N_CPU, None, max_jobs)
+
+        failed= []
+        for case, state in backend.run(jobs):
+            logging.info('{} {} in {:.1f} s'.format(case, state['status'], state['duration']))
+            if state['status']!='done':
+                failed.append(case)
+
+        if failed:
+            logging.error('Failed cases, see their logs in {}: {}'.format(self.stateDir, ', '.join(failed)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    App.run()
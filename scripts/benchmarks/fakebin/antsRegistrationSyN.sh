@@ -0,0 +1 @@
+fake_tool.py
\ No newline at end of file
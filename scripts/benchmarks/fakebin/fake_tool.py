@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+'''Lightweight stand-in for the FSL and ANTs executables called by the pipeline scripts.
+
+Every tool of this directory is a symlink to this file, which dispatches on the name it is called by.
+The stand-ins accept the command lines the scripts use and write outputs of the right shape, type, and format,
+copying the input data where the real tool would resample it, so that everything around them, i.e. splitting,
+merging, temporary files, compression, pools, and process spawning, runs as with the real tools.
+No registration or correction is performed. Only the standard library and numpy are imported, nibabel is not,
+to keep the cost of each call close to that of spawning a process.
+'''
+
+import sys, os, gzip, struct
+from os.path import basename, exists
+import numpy as np
+
+# NIfTI-1 datatype codes
+DTYPES= {2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32', 64: 'float64', 256: 'int8', 512: 'uint16', 768: 'uint32'}
+CODES= {np.dtype(v): k for k, v in DTYPES.items()}
+
+# FSL -odt names
+ODT= {'char': 'uint8', 'short': 'int16', 'int': 'int32', 'float': 'float32', 'double': 'float64'}
+
+# zlib level of FSL and ITK
+GZIP_LEVEL= 6
+
+
+class Image(object):
+    '''Header bytes and data of a single-file NIfTI-1 image'''
+
+    def __init__(self, hdr, data):
+        self.hdr= bytearray(hdr)
+        self.data= data
+
+
+def _open(fname, mode):
+    return gzip.open(fname, mode, compresslevel=GZIP_LEVEL) if fname.endswith('.gz') else open(fname, mode)
+
+
+def read(fname):
+
+    with _open(fname, 'rb') as f:
+        raw= f.read()
+
+    endian= '<' if struct.unpack('<i', raw[:4])[0]==348 else '>'
+    dim= struct.unpack(endian+'8h', raw[40:56])
+    datatype= struct.unpack(endian+'h', raw[70:72])[0]
+    vox_offset= int(struct.unpack(endian+'f', raw[108:112])[0])
+    slope, inter= struct.unpack(endian+'2f', raw[112:120])
+
+    shape= dim[1:dim[0]+1]
+    dtype= np.dtype(DTYPES[datatype]).newbyteorder(endian)
+    data= np.frombuffer(raw, dtype, int(np.prod(shape)), vox_offset).reshape(shape, order='F')
+    if slope not in (0, 1) or inter:
+        data= data*np.float32(slope)+np.float32(inter)
+
+    hdr= raw[:348]
+    if endian=='>':
+        # rewrite the header little endian, like the data written back
+        hdr= _swap_header(hdr)
+
+    return Image(hdr, data.astype(data.dtype.newbyteorder('<')))
+
+
+def _swap_header(hdr):
+    hdr= bytearray(hdr)
+    for offset, fmt in [(0, 'i'), (40, '8h'), (56, '3f'), (68, '3h'), (76, '8f'), (108, '3f'), (120, 'h'),
+                        (124, '2f'), (132, '2i'), (252, '2h'), (256, '6f'), (280, '12f')]:
+        values= struct.unpack_from('>'+fmt, hdr, offset)
+        struct.pack_into('<'+fmt, hdr, offset, *values)
+    return bytes(hdr)
+
+
+def write(fname, img, data=None, dtype=None):
+    '''Writes data (default: img.data) as dtype (default: the type of data) with the header of img'''
+
+    data= img.data if data is None else data
+    data= np.asarray(data, dtype=dtype or data.dtype)
+    if data.dtype not in CODES:
+        data= data.astype('float32')
+
+    hdr= bytearray(img.hdr)
+    dim= [data.ndim]+list(data.shape)+[1]*(7-data.ndim)
+    struct.pack_into('<8h', hdr, 40, *dim)
+    struct.pack_into('<2h', hdr, 70, CODES[data.dtype], 8*data.dtype.itemsize)
+    # vox_offset, scl_slope, scl_inter
+    struct.pack_into('<3f', hdr, 108, 352, 1, 0)
+    hdr[344:348]= b'n+1\x00'
+
+    with _open(fname, 'wb') as f:
+        f.write(hdr)
+        f.write(b'\x00'*4)
+        f.write(np.asfortranarray(data).tobytes(order='F'))
+
+
+def resample(img, ref, dtype=None):
+    '''Data of img on the grid of ref, volumes along the 4th axis are kept'''
+
+    shape= ref.data.shape[:3]+img.data.shape[3:]
+    if img.data.shape[:3]==ref.data.shape[:3]:
+        data= img.data
+    else:
+        data= np.zeros(shape, dtype=img.data.dtype)
+        common= tuple(slice(0, min(a, b)) for a, b in zip(img.data.shape[:3], ref.data.shape[:3]))
+        data[common]= img.data[common]
+
+    return np.asarray(data, dtype=dtype or 'float32')
+
+
+def fsl_ext():
+    return {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}[os.getenv('FSLOUTPUTTYPE', 'NIFTI_GZ')]
+
+
+def fsl_input(name):
+    # FSL tools find an image by its prefix
+    for ext in ['', '.nii.gz', '.nii']:
+        if exists(name+ext):
+            return name+ext
+    raise FileNotFoundError(name)
+
+
+def fsl_output(name):
+    return name if name.endswith('.nii') or name.endswith('.nii.gz') else name+fsl_ext()
+
+
+def option(args, *names, default=None):
+    '''Value following any of names in args, the value after = for --name=value'''
+
+    for i, a in enumerate(args):
+        for name in names:
+            if a==name and i+1<len(args):
+                return args[i+1]
+            if name.startswith('--') and a.startswith(name+'='):
+                return a.split('=', 1)[1]
+    return default
+
+
+def options(args, *names):
+    return [args[i+1] for i, a in enumerate(args[:-1]) if a in names]
+
+
+def bracket_args(value):
+    # MI[fixed,moving,1,32] -> [fixed, moving, 1, 32]
+    return value[value.index('[')+1:value.rindex(']')].split(',') if '[' in value else [value]
+
+
+def identity_mat(fname):
+    np.savetxt(fname, np.eye(4), fmt='%.6f')
+
+
+def itk_affine(fname):
+    with open(fname, 'w') as f:
+        f.write('#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n'
+                'Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\nFixedParameters: 0 0 0\n')
+
+
+def warp_field(fname, ref):
+    write(fname, ref, np.zeros(ref.data.shape[:3]+(1, 3), dtype='float32'))
+
+
+def flirt(args):
+    img= read(option(args, '-in'))
+    ref= read(option(args, '-ref'))
+    out= option(args, '-out', '-o')
+    if out:
+        write(fsl_output(out), ref, resample(img, ref))
+    if option(args, '-omat'):
+        identity_mat(option(args, '-omat'))
+
+
+def fslsplit(args):
+    img= read(fsl_input(args[0]))
+    prefix= args[1] if len(args)>1 and not args[1].startswith('-') else 'vol'
+    data= img.data if img.data.ndim==4 else img.data[..., None]
+    for i in range(data.shape[3]):
+        write(prefix+'{:04d}'.format(i)+fsl_ext(), img, data[..., i])
+
+
+def fslmerge(args):
+    axis= {'-t': 3, '-x': 0, '-y': 1, '-z': 2}[args[0]]
+    imgs= [read(fsl_input(x)) for x in args[2:]]
+    data= np.stack if axis==3 and imgs[0].data.ndim==3 else np.concatenate
+    write(fsl_output(args[1]), imgs[0], data([img.data for img in imgs], axis=axis))
+
+
+def fslmaths(args):
+    img= read(fsl_input(args[0]))
+    data= img.data.astype('float32')
+    i= 1
+    while i<len(args)-1 and args[i].startswith('-'):
+        op= args[i]
+        if op in ['-Tmean', '-bin', '-abs']:
+            data= {'-Tmean': lambda x: x.mean(-1) if x.ndim==4 else x,
+                   '-bin': lambda x: (x!=0).astype('float32'),
+                   '-abs': np.abs}[op](data)
+            i+= 1
+            continue
+
+        value= args[i+1]
+        try:
+            value= float(value)
+        except ValueError:
+            value= read(fsl_input(value)).data
+            if value.ndim<data.ndim:
+                value= value.reshape(value.shape+(1,)*(data.ndim-value.ndim))
+        if op=='-mas':
+            data= data*(value>0)
+        elif op=='-mul':
+            data= data*value
+        elif op=='-add':
+            data= data+value
+        elif op=='-sub':
+            data= data-value
+        elif op=='-div':
+            data= data/np.where(value==0, 1, value)
+        elif op=='-thr':
+            data= np.where(data<value, 0, data)
+        i+= 2
+
+    out= args[i]
+    # the output type is that of the input unless -odt is given
+    dtype= ODT[option(args, '-odt')] if option(args, '-odt') else img.data.dtype
+    write(fsl_output(out), img, data, dtype)
+
+
+def bet(args):
+    img= read(fsl_input(args[0]))
+    out= args[1][:-7] if args[1].endswith('.nii.gz') else args[1][:-4] if args[1].endswith('.nii') else args[1]
+    data= img.data if img.data.ndim==3 else img.data[..., 0]
+    mask= (data>np.percentile(data, 50)).astype('uint8')
+    if '-n' not in args:
+        write(fsl_output(out), img, data*mask)
+    if '-m' in args:
+        write(fsl_output(out+'_mask'), img, mask)
+
+
+def eddy_openmp(args):
+    imain= option(args, '--imain')
+    out= option(args, '--out')
+    img= read(fsl_input(imain))
+    write(out+'.nii.gz', img, img.data.astype('float32'))
+    with open(option(args, '--bvecs')) as f, open(out+'.eddy_rotated_bvecs', 'w') as g:
+        g.write(f.read())
+    np.savetxt(out+'.eddy_parameters', np.zeros((img.data.shape[-1], 16)))
+
+
+def ants_output(args):
+    # -o prefix or -o [prefix,warped,inverseWarped]
+    value= option(args, '-o', '--output')
+    parts= bracket_args(value)
+    return parts[0], parts[1] if len(parts)>1 else None, parts[2] if len(parts)>2 else None
+
+
+def antsRegistration(args):
+    if '--version' in args:
+        print('ANTs Version: 2.3.0.fake\nCompiled: fake')
+        return
+
+    prefix, warped, inverse_warped= ants_output(args)
+    fixed, moving= bracket_args(options(args, '-m', '--metric')[0])[:2]
+    fixed, moving= read(fixed), read(moving)
+
+    # with the default --collapse-output-transforms 1, linear stages make 0GenericAffine.mat,
+    # and a deformable stage the next index
+    transforms= [t.split('[')[0].lower() for t in options(args, '-t', '--transform')]
+    index= 0
+    if any(t in ['rigid', 'affine', 'similarity', 'translation'] for t in transforms):
+        itk_affine(prefix+'0GenericAffine.mat')
+        index= 1
+    if any(t in ['syn', 'bsplinesyn', 'timevaryingvelocityfield'] for t in transforms):
+        warp_field(prefix+'{}Warp.nii.gz'.format(index), fixed)
+        warp_field(prefix+'{}InverseWarp.nii.gz'.format(index), moving)
+
+    if warped:
+        write(warped, fixed, resample(moving, fixed))
+    if inverse_warped:
+        write(inverse_warped, moving, resample(fixed, moving))
+
+
+def antsRegistrationSyN(args):
+    # antsRegistrationSyN[Quick].sh -d 3 -f fixed -m moving -o prefix [-t s|r|a|...]
+    prefix= option(args, '-o')
+    fixed, moving= read(option(args, '-f')), read(option(args, '-m'))
+    itk_affine(prefix+'0GenericAffine.mat')
+    if option(args, '-t', default='s') in ['s', 'b', 'so', 'bo', 'sr', 'br']:
+        warp_field(prefix+'1Warp.nii.gz', fixed)
+        warp_field(prefix+'1InverseWarp.nii.gz', moving)
+    write(prefix+'Warped.nii.gz', fixed, resample(moving, fixed))
+    write(prefix+'InverseWarped.nii.gz', moving, resample(fixed, moving))
+
+
+def antsApplyTransforms(args):
+    img= read(option(args, '-i', '--input'))
+    ref= read(option(args, '-r', '--reference-image'))
+    write(bracket_args(option(args, '-o', '--output'))[0], ref, resample(img, ref))
+
+
+def WarpImageMultiTransform(args):
+    # dim moving out -R reference transforms
+    img= read(args[1])
+    ref= read(option(args, '-R'))
+    write(args[2], ref, resample(img, ref))
+
+
+WarpTimeSeriesImageMultiTransform= WarpImageMultiTransform
+
+
+def ComposeMultiTransform(args):
+    # dim out -R reference transforms
+    warp_field(args[1], read(option(args, '-R')))
+
+
+def MeasureImageSimilarity(args):
+    if '-m' in args:
+        fixed, moving= bracket_args(option(args, '-m'))[:2]
+    else:
+        fixed, moving= args[2:4]
+    a, b= read(fixed).data.ravel(), read(moving).data.ravel()
+    n= min(len(a), len(b))
+    mi= -abs(np.corrcoef(a[:n], b[:n])[0, 1]) if n>1 else 0.
+    print(mi)
+
+
+def ResampleImageBySpacing(args):
+    # dim in out sx sy sz ...
+    img= read(args[1])
+    spacing= np.array(struct.unpack_from('<3f', img.hdr, 80))
+    new_spacing= np.array([float(x) for x in args[3:6]])
+    shape= np.maximum(np.round(np.array(img.data.shape[:3])*spacing/new_spacing), 1).astype(int)
+    idx= np.ix_(*[np.minimum((np.arange(n)*new_spacing[i]/spacing[i]).astype(int), img.data.shape[i]-1)
+                  for i, n in enumerate(shape)])
+    struct.pack_into('<3f', img.hdr, 80, *new_spacing)
+    write(args[2], img, img.data[idx])
+
+
+def PrintHeader(args):
+    img= read(args[0])
+    if len(args)>1 and args[1]=='2':
+        print('x'.join(str(n) for n in img.data.shape[:3]))
+
+
+if __name__ == '__main__':
+    tool= basename(sys.argv[0])
+    if tool in ['eddy_cuda', 'eddy']:
+        tool= 'eddy_openmp'
+    elif tool in ['antsRegistrationSyN.sh', 'antsRegistrationSyNQuick.sh']:
+        tool= 'antsRegistrationSyN'
+    globals()[tool](sys.argv[1:])
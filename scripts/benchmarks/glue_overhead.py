@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+from plumbum import cli, local
+import sys, os, json, time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import TemporaryDirectory, save_nifti, FILEDIR, pjoin, N_PROC
+from _proctrace import read_trace, summarize
+from hot_paths import gradients, dwi_phantom, _nifti_header
+
+# stand-ins of the FSL and ANTs executables, see fakebin/fake_tool.py
+FAKEBIN= pjoin(os.path.dirname(os.path.abspath(__file__)), 'fakebin')
+
+
+def make_inputs(inDir, shape, nvols, ntrain):
+    '''Synthetic DWI, T2, their masks, and a training csv of ntrain T2/mask pairs, saved in inDir'''
+
+    inDir= local.path(inDir)
+    bvals, bvecs= gradients(nvols)
+    dwi, brain= dwi_phantom(shape, bvals, bvecs)
+    affine= np.diag([2., 2., 2., 1.])
+    affine[:3, 3]= -np.array(shape)
+
+    save_nifti(inDir / 'dwi.nii.gz', dwi, affine, _nifti_header())
+    np.savetxt(inDir / 'dwi.bval', bvals[None, :], fmt='%d')
+    np.savetxt(inDir / 'dwi.bvec', bvecs.T, fmt='%.6f')
+    save_nifti(inDir / 'dwi_mask.nii.gz', brain.astype('uint8'), affine, _nifti_header())
+
+    # T2 on a finer grid than the DWI
+    t2_shape= tuple(int(1.5*n) for n in shape)
+    t2, t2brain= dwi_phantom(t2_shape, [0], [[0, 0, 0]])
+    t2_affine= np.diag([4/3, 4/3, 4/3, 1.])
+    t2_affine[:3, 3]= affine[:3, 3]
+    save_nifti(inDir / 't2.nii.gz', t2[..., 0], t2_affine, _nifti_header())
+    save_nifti(inDir / 't2_mask.nii.gz', t2brain.astype('uint8'), t2_affine, _nifti_header())
+
+    with open(inDir / 'training.csv', 'w') as f:
+        f.write('image,mask\n')
+        for i in range(ntrain):
+            shift= (i-ntrain//2, 0, 0)
+            save_nifti(inDir / 'train{}.nii.gz'.format(i), np.roll(t2[..., 0], shift, (0, 1, 2)), t2_affine,
+                       _nifti_header())
+            save_nifti(inDir / 'train{}_mask.nii.gz'.format(i), np.roll(t2brain, shift, (0, 1, 2)).astype('uint8'),
+                       t2_affine, _nifti_header())
+            f.write('{},{}\n'.format(inDir / 'train{}.nii.gz'.format(i), inDir / 'train{}_mask.nii.gz'.format(i)))
+
+    with open(inDir / 'acqp.txt', 'w') as f:
+        f.write('0 -1 0 0.05\n')
+    with open(inDir / 'index.txt', 'w') as f:
+        f.write(' '.join(['1']*nvols)+'\n')
+
+
+def script_args(inDir, outDir, nproc):
+    '''Command line of each script on the inputs of make_inputs()'''
+
+    i= lambda name: inDir / name
+    o= lambda name: outDir / name
+    dwi= ['--bvals', i('dwi.bval'), '--bvecs', i('dwi.bvec')]
+
+    return {
+        'pnl_eddy': ['pnl_eddy.py', '-i', i('dwi.nii.gz')]+dwi+['-o', o('dwi-ed'), '-n', nproc, '--force'],
+
+        'antsApplyTransformsDWI': ['antsApplyTransformsDWI.py', '-i', i('dwi.nii.gz'), '-m', i('dwi_mask.nii.gz'),
+                                   '-t', i('warp.nii.gz'), '-o', o('dwi-warped.nii.gz'), '-n', nproc],
+
+        'fsl_eddy': ['fsl_eddy.py', '--dwi', i('dwi.nii.gz')]+dwi+['--mask', i('dwi_mask.nii.gz'),
+                     '--acqp', i('acqp.txt'), '--index', i('index.txt'), '--config', pjoin(FILEDIR, 'eddy_config.txt'),
+                     '--out', o('fsl_eddy')],
+
+        'pnl_epi': ['pnl_epi.py', '--dwi', i('dwi.nii.gz')]+dwi+['--dwimask', i('dwi_mask.nii.gz'),
+                    '--t2', i('t2.nii.gz'), '--t2mask', i('t2_mask.nii.gz'), '-o', o('dwi-epi'), '-n', nproc, '--force'],
+
+        'atlas': ['atlas.py', '-t', i('t2.nii.gz'), '--train', i('training.csv'), '-o', o('t2'), '-n', nproc],
+    }
+
+
+def busy_time(records):
+    '''Length of the union of the intervals during which at least one external command was running'''
+
+    total= 0.
+    end= None
+    for start, stop in sorted((r['start'], r['start']+r['wall']) for r in records):
+        if end is None or start>end:
+            total+= stop-start
+            end= stop
+        elif stop>end:
+            total+= stop-end
+            end= stop
+
+    return total
+
+
+def run_script(name, args, outDir, traceDir):
+    '''Runs a script with the stand-in tools on PATH, returns its wall time, return code, and traced commands'''
+
+    traceDir= local.path(traceDir) / name
+    traceDir.mkdir()
+    cmd= local[sys.executable][pjoin(FILEDIR, args[0])][args[1:]].with_env(
+        PATH=FAKEBIN+os.pathsep+os.environ['PATH'], ANTSPATH=FAKEBIN+os.sep, PNLPIPE_TRACE=str(traceDir),
+        # every run must call the tools
+        PNLPIPE_CACHE_SIZE='0')
+
+    log= outDir / (name+'.log')
+    start= time.time()
+    with open(log, 'w') as f:
+        p= cmd.popen(stdout=f, stderr=f)
+        p.wait()
+    wall= time.time()-start
+
+    records= []
+    for trace in traceDir // '*.jsonl':
+        records+= read_trace(trace)
+
+    return wall, p.returncode, records, log
+
+
+class GlueOverhead(cli.Application):
+    '''Runs the scripts that orchestrate FSL and ANTs end to end on a synthetic DWI, with lightweight stand-ins
+    of the tools (scripts/benchmarks/fakebin) on PATH, and reports the time each script spends outside
+    the external commands: splitting, temporary files, compression, pools, and process spawning.
+    The stand-ins write correctly sized outputs without registering anything, so neither FSL nor ANTs is needed.'''
+
+    shape= cli.SwitchAttr(['-s', '--shape'], help='spatial shape of the DWI', default='96x96x60')
+    nvols= cli.SwitchAttr(['-N', '--nvols'], int, help='number of volumes of the DWI', default=30)
+    ntrain= cli.SwitchAttr('--ntrain', int, help='number of training images for atlas.py', default=4)
+    scripts= cli.SwitchAttr('--scripts', help='comma separated scripts to run, default: all of '
+                            'pnl_eddy, antsApplyTransformsDWI, fsl_eddy, pnl_epi, atlas')
+    nproc= cli.SwitchAttr(['-n', '--nproc'], help='--nproc passed to each script', default=N_PROC)
+    verbose= cli.Flag(['-v', '--verbose'], help='print the commands run by each script, per tool')
+    out= cli.SwitchAttr(['-o', '--output'], help='save results to this json file')
+
+    def main(self):
+
+        shape= tuple(int(x) for x in self.shape.split('x'))
+        with TemporaryDirectory() as tmpdir:
+            tmpdir= local.path(tmpdir)
+            inDir, outDir, traceDir= tmpdir / 'inputs', tmpdir / 'outputs', tmpdir / 'traces'
+            for d in [inDir, outDir, traceDir]:
+                d.mkdir()
+
+            make_inputs(inDir, shape, self.nvols, self.ntrain)
+            # warp applied by antsApplyTransformsDWI
+            save_nifti(inDir / 'warp.nii.gz', np.zeros(shape+(1, 3), dtype='float32'), np.eye(4), _nifti_header())
+
+            all_args= script_args(inDir, outDir, self.nproc)
+            names= self.scripts.split(',') if self.scripts else list(all_args)
+
+            results= {}
+            print('{:<24}{:>10}{:>8}{:>12}{:>11}{:>8}'.format(
+                'script', 'wall (s)', 'calls', 'tools (s)', 'glue (s)', 'glue'))
+            for name in names:
+                wall, returncode, records, log= run_script(name, all_args[name], outDir, traceDir)
+                tools= busy_time(records)
+                results[name]= {'wall': wall, 'calls': len(records), 'tools': tools, 'glue': wall-tools,
+                                'returncode': returncode}
+
+                print('{:<24}{:>10.2f}{:>8}{:>12.2f}{:>11.2f}{:>7.0f}%{}'.format(
+                    name, wall, len(records), tools, wall-tools, 100*(wall-tools)/wall,
+                    '' if returncode==0 else '  failed with exit code {}'.format(returncode)))
+                if returncode:
+                    with open(log) as f:
+                        print(''.join(f.readlines()[-20:]))
+                if self.verbose and records:
+                    print(summarize(records)+'\n')
+
+        if self.out:
+            with open(self.out, 'w') as f:
+                json.dump({'shape': shape, 'nvols': self.nvols, 'ntrain': self.ntrain, 'nproc': self.nproc,
+                           'scripts': results}, f, indent=2)
+
+        if any(r['returncode'] for r in results.values()):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    GlueOverhead.run()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+from plumbum import cli, local
+from contextlib import redirect_stdout
+import sys, os, json, time, platform, logging
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DWIqc'))
+from util import TemporaryDirectory, save_nifti, load_nifti, load_nifti_lazy, N_CPU
+from intermediate_format import best_of
+
+# b-shells of the synthetic DWI, one b0 every B0_EVERY volumes
+SHELLS= [1000, 2000, 3000]
+B0_EVERY= 10
+
+# results of the default sizes, committed with this script and compared against by default
+BASELINE= os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hot_paths_baseline.json')
+
+# isotropic diffusivity of the phantom, and the extra one along x in its fibre slab (mm^2/s)
+D_ISO= 0.0007
+D_FIBRE= 0.0015
+
+
+def gradients(nvols):
+    '''Multi-shell scheme: b0 every B0_EVERY volumes, the others cycling through SHELLS,
+    with directions spread over the sphere by a golden spiral'''
+
+    bvals= np.zeros(nvols)
+    dwis= [i for i in range(nvols) if i%B0_EVERY]
+    for j, i in enumerate(dwis):
+        bvals[i]= SHELLS[j%len(SHELLS)]
+
+    bvecs= np.zeros((nvols, 3))
+    n= max(len(dwis), 1)
+    for j, i in enumerate(dwis):
+        z= 1-2*(j+0.5)/n
+        phi= j*np.pi*(3-np.sqrt(5))
+        bvecs[i]= [np.sqrt(1-z**2)*np.cos(phi), np.sqrt(1-z**2)*np.sin(phi), z]
+
+    return bvals, bvecs
+
+
+def dwi_phantom(shape, bvals, bvecs):
+    '''Ellipsoid brain with a fibre slab along x, signal S0*exp(-b*ADC) plus noise in the brain,
+    zero background, float32 like FSL outputs'''
+
+    grid= np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    r2= sum(g**2 for g in grid)
+    brain= r2<0.8
+    s0= np.where(brain, 1000*(1.2-r2), 0).astype('float32')
+    fibre= brain & (abs(grid[2])<0.2)
+
+    rng= np.random.RandomState(0)
+    data= np.empty(tuple(shape)+(len(bvals),), dtype='float32')
+    for i, (b, g) in enumerate(zip(bvals, bvecs)):
+        adc= D_ISO+D_FIBRE*g[0]**2*fibre
+        data[..., i]= s0*np.exp(-b*adc) + brain*rng.normal(0, 20, shape)
+
+    return data, brain
+
+
+def flirt_matrices(n, rng):
+    '''Affine matrices like flirt -omat of eddy current registrations: small rotations, shears, and translations'''
+
+    mats= []
+    for _ in range(n):
+        a= rng.normal(0, 0.02, 3)
+        rx= np.array([[1, 0, 0], [0, np.cos(a[0]), -np.sin(a[0])], [0, np.sin(a[0]), np.cos(a[0])]])
+        ry= np.array([[np.cos(a[1]), 0, np.sin(a[1])], [0, 1, 0], [-np.sin(a[1]), 0, np.cos(a[1])]])
+        rz= np.array([[np.cos(a[2]), -np.sin(a[2]), 0], [np.sin(a[2]), np.cos(a[2]), 0], [0, 0, 1]])
+        mat= np.eye(4)
+        mat[:3, :3]= rx@ry@rz@(np.eye(3)+rng.normal(0, 0.01, (3, 3)))
+        mat[:3, 3]= rng.normal(0, 1, 3)
+        mats.append(mat)
+
+    return mats
+
+
+class Case(object):
+    '''A synthetic DWI of one size and the files derived from it, saved in tmpdir'''
+
+    def __init__(self, tmpdir, shape, nvols, ntrain, nlabels):
+        self.tmpdir= local.path(tmpdir)
+        self.shape= shape
+        self.nvols= nvols
+        self.ntrain= ntrain
+        self.nlabels= nlabels
+        rng= np.random.RandomState(0)
+
+        self.bvals, self.bvecs= gradients(nvols)
+        self.data, self.brain= dwi_phantom(shape, self.bvals, self.bvecs)
+        self.affine= np.diag([2., 2., 2., 1.])
+        self.affine[:3, 3]= -np.array(shape)
+
+        self.dwi= self.tmpdir / 'dwi.nii'
+        self.hdr= _nifti_header()
+        save_nifti(self.dwi, self.data, self.affine, self.hdr)
+        self.hdr= load_nifti(str(self.dwi)).header
+
+        self.transforms= []
+        for i, mat in enumerate(flirt_matrices(nvols, rng)):
+            self.transforms.append(self.tmpdir / 'vol{:04d}.txt'.format(i))
+            np.savetxt(self.transforms[-1], mat)
+
+        # warped training images and labelmaps: the b0 and the brain with their boundary shifted
+        self.target= self.tmpdir / 'target.nii.gz'
+        save_nifti(self.target, self.data[..., 0], self.affine, _nifti_header())
+        self.atlases= []
+        self.labels= []
+        for i in range(ntrain):
+            shift= rng.randint(-2, 3, 3)
+            self.atlases.append(self.tmpdir / 'atlas{}.nii'.format(i))
+            save_nifti(self.atlases[-1], np.roll(self.data[..., 0], shift, axis=(0, 1, 2)), self.affine,
+                       _nifti_header())
+            label= np.roll(self.brain, shift, axis=(0, 1, 2)).astype('uint8')
+            self.labels.append(self.tmpdir / 'mask{}.nii.gz'.format(i))
+            save_nifti(self.labels[-1], label, self.affine, _nifti_header())
+        self.mis= list(rng.uniform(-0.9, -0.3, ntrain))
+
+        # diffusion maps and a labelmap of nlabels slabs along z
+        self.maps= [rng.uniform(0, 1, shape).astype('float32') for _ in range(6)]
+        self.labelMap= np.zeros(shape, dtype='int16')
+        for label, slab in enumerate(np.array_split(np.arange(shape[2]), nlabels), start=1):
+            self.labelMap[..., slab]= label
+
+
+def _nifti_header():
+    from util import Nifti1Image
+    return Nifti1Image(np.zeros((1, 1, 1), dtype='float32'), np.eye(4)).header.copy()
+
+
+# benchmarks: name -> setup(case) returning (function to time, number of calls per timing)
+# setups import the script they time, a benchmark is skipped if the script cannot be imported
+
+def eddy_bvec_rotation(case):
+    from pnl_eddy import rotate_bvecs
+    bvecs= case.bvecs.tolist()
+    return (lambda: rotate_bvecs(bvecs, case.transforms)), 1
+
+
+def atlas_weightsFromMIExp(case):
+    from atlas import weightsFromMIExp
+    return (lambda: weightsFromMIExp(case.mis, 0.1)), 1000
+
+
+def atlas_mutual_information(case):
+    from atlas import mutual_information
+    return (lambda: mutual_information(case.target, case.atlases)), 1
+
+
+def atlas_fuseWeightedAvg(case):
+    from atlas import fuseWeightedAvg, weightsFromMIExp
+    weights= weightsFromMIExp(case.mis, 0.1)
+    out= case.tmpdir / 'fused.nii.gz'
+    return (lambda: fuseWeightedAvg(case.labels, weights, out, case.hdr.copy())), 1
+
+
+def dwi_quality_minOverGrads(case):
+    from dwi_quality import min_over_grads
+    where_b0s= np.where(case.bvals==0)[0]
+    where_dwi= np.where(case.bvals!=0)[0]
+    bse_data= case.data[..., where_b0s].mean(-1)
+    return (lambda: min_over_grads(case.data, bse_data, where_dwi, 3)), 1
+
+
+def dwi_quality_roi_stats(case):
+    from dwi_quality import roi_stats
+    label2name= {label: 'region{}'.format(label) for label in range(1, case.nlabels+1)}
+    fa, md, ad, rd, mk, evals= case.maps
+    negative= (rd<0.1)*1
+    evals_zero= (evals<0.1)*1
+    return (lambda: roi_stats(case.labelMap, label2name, fa, md, ad, rd, negative, evals_zero, mk)), 1
+
+
+def bse_avg(case):
+    from bse import bse
+    bvals= case.bvals.tolist()
+    out= case.tmpdir / 'bse.nii'
+    return (lambda: bse(case.dwi, bvals, out, method='avg')), 1
+
+
+def align_header_update(case):
+    from align import get_spcdir_new, update_hdr
+
+    def align():
+        spcdir_new, _= get_spcdir_new(case.hdr)
+        offset_new= -spcdir_new @ np.matrix((case.hdr['dim'][1:4]-1)/2).T
+        update_hdr(case.hdr, spcdir_new, offset_new)
+
+    return align, 100
+
+
+def util_save_nii(case):
+    out= case.tmpdir / 'save.nii'
+    return (lambda: save_nifti(out, case.data, case.affine, case.hdr.copy())), 1
+
+
+def util_save_niigz(case):
+    out= case.tmpdir / 'save.nii.gz'
+    return (lambda: save_nifti(out, case.data, case.affine, case.hdr.copy())), 1
+
+
+def util_load_nii(case):
+    return (lambda: load_nifti(str(case.dwi), mmap=False).get_fdata(dtype='float32')), 1
+
+
+def util_load_niigz(case):
+    fname= case.tmpdir / 'load.nii.gz'
+    save_nifti(fname, case.data, case.affine, case.hdr.copy())
+    return (lambda: load_nifti(str(fname)).get_fdata(dtype='float32')), 1
+
+
+def util_load_niigz_parallel(case):
+    from util import load_nifti_parallel
+    fname= case.tmpdir / 'load_parallel.nii.gz'
+    save_nifti(fname, case.data, case.affine, case.hdr.copy())
+    return (lambda: np.asanyarray(load_nifti_parallel(fname).dataobj)), 1
+
+
+def util_load_lazy_volume(case):
+    return (lambda: np.array(load_nifti_lazy(case.dwi).dataobj[..., case.nvols//2])), 1
+
+
+BENCHMARKS= [eddy_bvec_rotation, atlas_mutual_information, atlas_weightsFromMIExp, atlas_fuseWeightedAvg,
+             dwi_quality_minOverGrads, dwi_quality_roi_stats, bse_avg, align_header_update,
+             util_save_nii, util_save_niigz, util_load_nii, util_load_niigz, util_load_niigz_parallel,
+             util_load_lazy_volume]
+
+
+def run_case(case, names, repeat):
+    '''Times the benchmarks names on case, returns name -> {'time': seconds per call} or {'skipped': reason}'''
+
+    results= {}
+    for bench in BENCHMARKS:
+        if bench.__name__ not in names:
+            continue
+        try:
+            fun, number= bench(case)
+        except ImportError as e:
+            results[bench.__name__]= {'skipped': str(e)}
+            continue
+
+        def loop():
+            # silence the progress prints of the scripts
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                for _ in range(number):
+                    fun()
+
+        results[bench.__name__]= {'time': best_of(loop, repeat)/number}
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''Rows (size, benchmark, baseline time, time, ratio, regressed) of the benchmarks timed in both results and
+    baseline. A benchmark regressed if it is slower than its baseline by more than the fraction threshold.'''
+
+    rows= []
+    for size, benches in results['sizes'].items():
+        for name, r in benches.items():
+            b= baseline['sizes'].get(size, {}).get(name, {})
+            if 'time' not in r or 'time' not in b:
+                continue
+            ratio= r['time']/b['time']
+            rows.append((size, name, b['time'], r['time'], ratio, ratio>1+threshold))
+
+    return rows
+
+
+def machine():
+    import nibabel
+    return {'host': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'nibabel': nibabel.__version__, 'ncpu': N_CPU}
+
+
+class Benchmark(cli.Application):
+    '''Times the pure-Python paths of the pipeline on synthetic multi-shell DWI phantoms of several sizes:
+    pnl_eddy gradient rotation, atlas mutual_information/weightsFromMIExp/fuseWeightedAvg, dwi_quality minOverGrads/ROI statistics,
+    bse --avg, align header updates, and util save/load. FSL and ANTs are not run.
+    Results are saved as json, and compared against a baseline json saved by a previous run, hot_paths_baseline.json
+    by default: the exit code is 1 if any benchmark is slower than its baseline by more than --threshold,
+    and the baseline was timed on this host with as many cpus.'''
+
+    sizes= cli.SwitchAttr(['-s', '--sizes'], help='comma separated DWI sizes XxYxZxN',
+                          default='96x96x96x30,112x112x112x100')
+    ntrain= cli.SwitchAttr('--ntrain', int, help='number of training labelmaps fused by atlas', default=10)
+    nlabels= cli.SwitchAttr('--nlabels', int, help='number of labels for the ROI statistics', default=100)
+    only= cli.SwitchAttr('--only', help='comma separated benchmarks to run, default: all of '+
+                         ', '.join(b.__name__ for b in BENCHMARKS))
+    repeat= cli.SwitchAttr(['--repeat'], int, help='number of repeats, best time is taken', default=3)
+    out= cli.SwitchAttr(['-o', '--output'], help='save results to this json file')
+    baseline= cli.SwitchAttr(['-b', '--baseline'], cli.ExistingFile, help='compare with results of a previous run',
+                             default=BASELINE)
+    nobaseline= cli.Flag('--no-baseline', help='do not compare with a baseline')
+    threshold= cli.SwitchAttr(['-t', '--threshold'], float,
+                              help='slowdown relative to the baseline counted as a regression', default=0.2)
+
+    def main(self):
+
+        # rotate_bvecs() logs every transform, and the scripts set up logging when imported
+        logging.disable(logging.INFO)
+
+        names= self.only.split(',') if self.only else [b.__name__ for b in BENCHMARKS]
+        unknown= set(names)-set(b.__name__ for b in BENCHMARKS)
+        if unknown:
+            raise ValueError('Unknown benchmarks: '+', '.join(sorted(unknown)))
+
+        results= {'machine': machine(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': self.repeat,
+                  'ntrain': self.ntrain, 'nlabels': self.nlabels, 'sizes': {}}
+
+        print('{:<20}{:<28}{:>12}'.format('size', 'benchmark', 'time (s)'))
+        for size in self.sizes.split(','):
+            dims= [int(x) for x in size.split('x')]
+            with TemporaryDirectory() as tmpdir:
+                case= Case(tmpdir, tuple(dims[:3]), dims[3], self.ntrain, self.nlabels)
+                results['sizes'][size]= run_case(case, names, self.repeat)
+                del case
+
+            for name, r in results['sizes'][size].items():
+                print('{:<20}{:<28}{:>12}'.format(size, name,
+                                                  '{:.6f}'.format(r['time']) if 'time' in r else 'skipped'))
+
+        if self.out:
+            with open(self.out, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if not self.nobaseline:
+            with open(self.baseline) as f:
+                baseline= json.load(f)
+
+            rows= compare(results, baseline, self.threshold)
+            print('\nComparison with {} ({}, {})'.format(self.baseline, baseline['date'], baseline['machine']['host']))
+            # timings of other machines are shown for reference only
+            same= all(baseline['machine'][k]==results['machine'][k] for k in ['host', 'ncpu'])
+            if not same:
+                print('The baseline was timed on another machine, {host} with {ncpu} cpus, '
+                      'regressions are not checked'.format(**baseline['machine']))
+            print('{:<20}{:<28}{:>14}{:>12}{:>9}'.format('size', 'benchmark', 'baseline (s)', 'time (s)', 'change'))
+            for size, name, before, after, ratio, regressed in rows:
+                print('{:<20}{:<28}{:>14.6f}{:>12.6f}{:>+9.1%}{}'.format(size, name, before, after, ratio-1,
+                                                                       '  REGRESSION' if same and regressed else ''))
+            missing= [size for size in results['sizes'] if size not in baseline['sizes']]
+            if missing:
+                print('No baseline for '+', '.join(missing))
+
+            if same and any(row[-1] for row in rows):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    Benchmark.run()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+from plumbum import cli, local
+import sys, os, gzip, json, time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import TemporaryDirectory, Nifti1Image
+
+# intermediate image I/O done by each script inside its temporary directory
+# (op, number of volumes per image, number of images) for a DWI of N volumes with B b0 volumes
+# 'w'/'r' are intermediate writes/reads, 'final' is an image that leaves the temporary directory compressed
+def script_io(N, B):
+    return {
+        'pnl_eddy': [('w', 1, N), ('w', 1, 1),           # fslsplit, bse
+                     ('r', 1, 2*N), ('w', 1, N),         # flirt reads vol and b0, writes vol
+                     ('r', 1, N), ('final', N, 1)],      # fslmerge, copy to output
+
+        'antsApplyTransformsDWI': [('w', 1, N),                  # fslsplit
+                                   ('r', 1, N), ('w', 1, N),     # WarpImageMultiTransform
+                                   ('r', 1, N), ('final', N, 1)],# fslmerge, copy to output
+
+        'fsl_topup_epi_eddy': [('w', N, 2),                      # fslmaths -mas
+                               ('r', N, 2), ('w', B, 2),         # bse.py --all
+                               ('r', B, 2), ('w', 2*B, 1),       # fslmerge
+                               ('r', 2*B, 1), ('w', 1, 1),       # topup
+                               ('r', N, 2), ('w', N, 1),         # applytopup
+                               ('r', N, 1), ('w', 1, 1),         # fslmaths -Tmean
+                               ('r', N, 1),                      # eddy --imain
+                               ('final', N, 2), ('final', B, 2), ('final', 2*B, 1),
+                               ('final', N, 1), ('final', 1, 2)],# intermediates moved to the output directory
+
+        'pnl_epi': [('r', N, 1), ('w', 1, 1),            # bse.py
+                    ('w', 1, 1),                         # fslmaths t2mask -mul t2
+                    ('r', 1, 2), ('r', 1, 1), ('w', 1, 1),  # rigid registration, antsApplyTransforms
+                    ('r', 1, 2), ('r', 1, 1)],           # antsRegistration, DWI mask warp reference
+    }
+
+
+def phantom(shape, nvols):
+    '''Smooth ellipsoid with Rician-like noise, zero background, float32 like FSL outputs'''
+
+    grid= np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    r2= sum(g**2 for g in grid)
+    brain= np.where(r2<0.8, 1000*(1.2-r2), 0).astype('float32')
+
+    rng= np.random.RandomState(0)
+    data= np.empty(shape+(nvols,), dtype='float32')
+    for i in range(nvols):
+        data[..., i]= brain*(0.3+0.7*rng.rand()) + (brain>0)*rng.normal(0, 20, shape)
+
+    return data
+
+
+def serialize(data):
+    from io import BytesIO
+    raw= BytesIO()
+    img= Nifti1Image(data, np.eye(4))
+    file_map= img.make_file_map()
+    file_map['image'].fileobj= raw
+    img.to_file_map(file_map)
+    return raw.getvalue()
+
+
+def best_of(fun, repeat):
+    times= []
+    for _ in range(repeat):
+        start= time.perf_counter()
+        fun()
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+
+class Benchmark(cli.Application):
+    '''Compares intermediate image I/O of the temporary-directory heavy scripts with gzipped (.nii.gz) vs
+    uncompressed (.nii) intermediates on a synthetic DWI. FSL and ANTs are not required, the I/O performed by
+    each script is modeled from the files it writes/reads in its temporary directory, see script_io()'''
+
+    shape= cli.SwitchAttr(['-s', '--shape'], help='spatial shape of the DWI', default='96x96x60')
+    nvols= cli.SwitchAttr(['-N', '--nvols'], int, help='number of gradient volumes', default=30)
+    nb0= cli.SwitchAttr(['-B', '--nb0'], int, help='number of b0 volumes', default=3)
+    level= cli.SwitchAttr(['--level'], int, help='gzip level used by FSL (zlib default)', default=6)
+    repeat= cli.SwitchAttr(['--repeat'], int, help='number of repeats, best time is taken', default=3)
+    out= cli.SwitchAttr(['-o', '--output'], help='save results to this json file')
+
+    def main(self):
+
+        shape= tuple(int(x) for x in self.shape.split('x'))
+        io= script_io(self.nvols, self.nb0)
+        sizes= sorted(set(n for ops in io.values() for _, n, _ in ops))
+
+        # time a single write/read of an image with n volumes in each format
+        cost= {}
+        with TemporaryDirectory() as tmpdir:
+            tmpdir= local.path(tmpdir)
+            for n in sizes:
+                raw= serialize(phantom(shape, n))
+                nii= tmpdir / 'img.nii'
+                niigz= tmpdir / 'img.nii.gz'
+
+                def write_nii():
+                    with open(nii, 'wb') as f:
+                        f.write(raw)
+
+                def write_niigz():
+                    with gzip.open(niigz, 'wb', compresslevel=self.level) as f:
+                        f.write(raw)
+
+                def read_nii():
+                    with open(nii, 'rb') as f:
+                        f.read()
+
+                def read_niigz():
+                    with gzip.open(niigz, 'rb') as f:
+                        f.read()
+
+                cost[('w', '.nii', n)]= best_of(write_nii, self.repeat)
+                cost[('w', '.nii.gz', n)]= best_of(write_niigz, self.repeat)
+                cost[('r', '.nii', n)]= best_of(read_nii, self.repeat)
+                cost[('r', '.nii.gz', n)]= best_of(read_niigz, self.repeat)
+
+        result= {}
+        print('{:<24}{:>14}{:>14}{:>10}'.format('script', '.nii.gz (s)', '.nii (s)', 'saving'))
+        for script, ops in io.items():
+            t= {'.nii.gz': 0., '.nii': 0.}
+            for op, n, count in ops:
+                if op=='final':
+                    # gzipped: written compressed in place; uncompressed: written, read back, and compressed once
+                    t['.nii.gz']+= count*cost[('w', '.nii.gz', n)]
+                    t['.nii']+= count*(cost[('w', '.nii', n)]+cost[('r', '.nii', n)]+cost[('w', '.nii.gz', n)])
+                else:
+                    for ext in t:
+                        t[ext]+= count*cost[(op, ext, n)]
+
+            saving= 1-t['.nii']/t['.nii.gz']
+            result[script]= {'nii.gz': t['.nii.gz'], 'nii': t['.nii'], 'saving': saving}
+            print('{:<24}{:>14.3f}{:>14.3f}{:>9.1f}%'.format(script, t['.nii.gz'], t['.nii'], 100*saving))
+
+        if self.out:
+            with open(self.out, 'w') as f:
+                json.dump({'shape': shape, 'nvols': self.nvols, 'nb0': self.nb0, 'level': self.level,
+                           'scripts': result}, f, indent=2)
+
+
+if __name__ == '__main__':
+    Benchmark.run()
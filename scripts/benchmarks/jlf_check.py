@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+from plumbum import cli, local
+from contextlib import redirect_stdout
+import sys, os, time, logging
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import TemporaryDirectory, save_nifti, load_nifti, Nifti1Image
+from atlas import fuseJointLabels, ANTSJOINTFUSION_PARAMS, _jlf_params
+
+
+def phantom(shape, natlases, nlabels, seed):
+    '''Target image and natlases training images and labelmaps: an ellipsoid split into nlabels slabs along z,
+    each atlas shifted by up to 2 voxels and with its own noise, so that the atlases disagree near the boundaries'''
+
+    rng= np.random.RandomState(seed)
+    grid= np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    r2= sum(g**2 for g in grid)
+    brain= r2<0.7
+    labels= np.zeros(shape, dtype='uint8')
+    for label, slab in enumerate(np.array_split(np.arange(shape[2]), nlabels), start=1):
+        labels[..., slab]= label
+    labels*= brain
+    image= np.where(brain, 100*(1.2-r2)+20*labels, 0).astype('float32')
+
+    target= image+rng.normal(0, 5, shape).astype('float32')
+    atlases, labelmaps= [], []
+    for _ in range(natlases):
+        shift= tuple(rng.randint(-2, 3, 3))
+        atlases.append(np.roll(image, shift, axis=(0, 1, 2))+rng.normal(0, 5, shape).astype('float32'))
+        labelmaps.append(np.roll(labels, shift, axis=(0, 1, 2)))
+
+    return target, atlases, labelmaps
+
+
+def _similarity(Tp, patches, pc):
+    # Pearson correlation of the patches for PC, minus their mean squared difference for MSQ
+    if not pc:
+        return -((patches-Tp)**2).mean(axis=-1)
+    t= Tp-Tp.mean()
+    p= patches-patches.mean(axis=-1, keepdims=True)
+    denom= np.sqrt((t*t).sum()*(p*p).sum(axis=-1))
+    return np.divide(p@t, denom, out=np.zeros_like(denom), where=denom>0)
+
+
+def _normalized(patch, pc):
+    if not pc:
+        return patch
+    patch= patch-patch.mean(axis=-1, keepdims=True)
+    std= np.sqrt((patch*patch).mean(axis=-1, keepdims=True))
+    return np.divide(patch, std, out=np.zeros_like(patch), where=std>0)
+
+
+def _weights(D, alpha, beta, nonneg):
+    '''(M+alpha*I)^-1 1 normalized to unit sum for one voxel, M[i,j]= mean(D[i]*D[j])^beta, solved again without
+    the atlases of negative weight until none is left if nonneg'''
+
+    N= len(D)
+    M= (D@D.T/D.shape[1])**beta+alpha*np.eye(N)
+    active= np.arange(N)
+    while True:
+        w= np.zeros(N)
+        w[active]= np.linalg.solve(M[np.ix_(active, active)], np.ones(len(active)))
+        w/= w.sum()
+        if not nonneg or (w>=0).all():
+            return np.clip(w, 0, None) if nonneg else w
+        active= active[w[active]>=0]
+
+
+def brute_force(target, atlases, labelmaps, params):
+    '''Joint label fusion written voxel by voxel: every offset of the search window is compared directly,
+    in the order of their distance to the center, and the weights are solved one voxel at a time'''
+
+    r, s= params['patch'], params['search']
+    h= r+s
+    pc= params['metric']=='PC'
+
+    # same intensity scaling and zero padding as fuseJointLabels()
+    scales= [np.abs(img[::4, ::4, ::4]).max() or 1. for img in [target]+atlases]
+    if not pc:
+        scales= [scales[0]]*len(scales)
+    T= np.pad(target/scales[0], h).astype('float64')
+    A= [np.pad(img/scale, h).astype('float64') for img, scale in zip(atlases, scales[1:])]
+    L= [np.pad(label, h) for label in labelmaps]
+
+    window= np.stack(np.meshgrid(*[np.arange(-r, r+1)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets= np.stack(np.meshgrid(*[np.arange(-s, s+1)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets= offsets[np.argsort(np.abs(offsets).sum(axis=1), kind='stable')]
+
+    stack= np.stack(labelmaps)
+    fused= stack[0].astype('int32')
+    for v in np.argwhere((stack!=stack[0]).any(axis=0)):
+        c= v+h
+        Tp= T[tuple((c+window).T)]
+        D, votes= [], []
+        for a, l in zip(A, L):
+            idx= c+offsets[:, None, :]+window[None, :, :]
+            best= offsets[np.argmax(_similarity(Tp, a[idx[..., 0], idx[..., 1], idx[..., 2]], pc))]
+            D.append(np.abs(_normalized(a[tuple((c+best+window).T)], pc)-_normalized(Tp, pc)))
+            votes.append(l[tuple(c+best)])
+        w= _weights(np.array(D), params['alpha'], params['beta'], params['nonneg'])
+        votes= np.array(votes)
+        values= np.unique(votes)
+        fused[tuple(v)]= values[np.argmax([w[votes==value].sum() for value in values])]
+
+    return fused
+
+
+def ants_joint_fusion(tmpdir, target, atlases, labelmaps, args):
+    '''Labelmap fused by the antsJointFusion binary, None if it is not on PATH'''
+
+    try:
+        from plumbum.cmd import antsJointFusion
+    except ImportError:
+        return None
+
+    out= tmpdir / 'ants.nii.gz'
+    antsJointFusion['-d', 3, '-t', target, '-g', atlases, '-l', labelmaps, '-o', out, args]()
+    return np.asanyarray(load_nifti(str(out)).dataobj)
+
+
+class JlfCheck(cli.Application):
+    '''Compares the in-process joint label fusion of atlas.py, fuseJointLabels(), with a brute-force voxel by voxel
+    implementation on a synthetic phantom, and with the antsJointFusion binary if it is on PATH.
+    The brute force is our own rewrite of the same algorithm, so it checks the vectorization, not equivalence with
+    ANTs, which is only reported when antsJointFusion is on PATH.
+    The exit code is 1 if fuseJointLabels() and the brute force disagree on more than --tolerance of the voxels.'''
+
+    shape= cli.SwitchAttr(['-s', '--shape'], help='phantom size XxYxZ', default='16x16x16')
+    natlases= cli.SwitchAttr('--natlases', int, help='number of training images', default=5)
+    nlabels= cli.SwitchAttr('--nlabels', int, help='number of labels', default=4)
+    metric= cli.SwitchAttr('--metric', cli.Set('PC', 'MSQ'), help='patch metric', default='PC')
+    search= cli.SwitchAttr('--search', int, help='search radius, default: that of ANTSJOINTFUSION_PARAMS')
+    patch= cli.SwitchAttr('--patch', int, help='patch radius, default: that of ANTSJOINTFUSION_PARAMS')
+    threads= cli.SwitchAttr(['-n', '--nproc'], int, help='threads of fuseJointLabels()', default=1)
+    seed= cli.SwitchAttr('--seed', int, help='random seed of the phantom', default=0)
+    tolerance= cli.SwitchAttr(['-t', '--tolerance'], float,
+                              help='fraction of the fused voxels allowed to differ from the brute force', default=0.001)
+
+    def main(self):
+
+        logging.disable(logging.INFO)
+
+        args= [str(x) for x in ANTSJOINTFUSION_PARAMS]
+        args[args.index('--patch-metric')+1]= self.metric.upper()
+        if self.search is not None:
+            args[args.index('--search-radius')+1]= str(self.search)
+        if self.patch is not None:
+            args[args.index('--patch-radius')+1]= str(self.patch)
+        params= _jlf_params(args)
+
+        shape= tuple(int(x) for x in self.shape.split('x'))
+        target, atlases, labelmaps= phantom(shape, self.natlases, self.nlabels, self.seed)
+        disagree= (np.stack(labelmaps)!=labelmaps[0]).any(axis=0).sum()
+        print('Phantom {}, {} atlases, {} voxels where they disagree, {}'.format(self.shape, self.natlases, disagree,
+                                                                                 ' '.join(args)))
+
+        with TemporaryDirectory() as tmpdir:
+            tmpdir= local.path(tmpdir)
+            affine= np.eye(4)
+            hdr= Nifti1Image(target, affine).header
+            files= {}
+            for name, data in [('target', target)]+[('atlas{}'.format(i), a) for i, a in enumerate(atlases)]+\
+                              [('label{}'.format(i), l) for i, l in enumerate(labelmaps)]:
+                files[name]= tmpdir / (name+'.nii.gz')
+                save_nifti(files[name], data, affine, Nifti1Image(data, affine).header)
+            images= [files['atlas{}'.format(i)] for i in range(self.natlases)]
+            labels= [files['label{}'.format(i)] for i in range(self.natlases)]
+
+            start= time.time()
+            out= tmpdir / 'fused.nii.gz'
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                fuseJointLabels(files['target'], images, {'label': labels}, {'label': out}, hdr, self.threads, params)
+            fused= np.asanyarray(load_nifti(str(out)).dataobj)
+            print('fuseJointLabels  {:8.2f} s'.format(time.time()-start))
+
+            start= time.time()
+            reference= brute_force(target, atlases, labelmaps, params)
+            print('brute force      {:8.2f} s'.format(time.time()-start))
+
+            ants= ants_joint_fusion(tmpdir, files['target'], images, labels, args)
+
+        differ= (fused!=reference).sum()
+        print('fuseJointLabels differs from the brute force at {} voxels, {:.4%} of those fused'.format(
+              differ, differ/max(disagree, 1)))
+        if ants is not None:
+            print('antsJointFusion differs from fuseJointLabels at {} voxels, from the brute force at {}'.format(
+                  (ants!=fused).sum(), (ants!=reference).sum()))
+
+        if differ>self.tolerance*disagree:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    JlfCheck.run()
@@ -1,30 +1,22 @@
 #!/usr/bin/env python
 
-from plumbum.cmd import bet, fslroi
-from plumbum import cli, FG, local
+from plumbum.cmd import bet
+from plumbum import cli, local, FG
 import os
-import numpy as np
-from conversion import read_bvals
-from util import BET_THRESHOLD, B0_THRESHOLD, load_nifti
+from util import BET_THRESHOLD, load_nifti, TMP_EXT
+from bse import bse
 
 
 def bet_mask(imgPath, maskPath, dim, bvalFile= None, thr= BET_THRESHOLD):
+    '''Brain mask of a 3D image, or of the first b0 of a 4D DWI, saved as maskPath_mask.nii.gz'''
 
     with local.tempdir() as tmpdir:
-        bsetmp = tmpdir / 'bse.nii.gz'
+        bsetmp = tmpdir / ('bse'+TMP_EXT)
 
         if dim==4:
-            bvals = read_bvals(bvalFile)
-            idx = np.where([bval < B0_THRESHOLD for bval in bvals])[0]
+            bse(imgPath, bvalFile, bsetmp)
 
-
-            if len(idx) >= 1:
-                fslroi[imgPath, bsetmp, idx, 1] & FG
-
-                bet[bsetmp, maskPath, '-m', '-n', '-f', thr] & FG
-
-            else:
-                raise Exception('No b0 image found. Check the bval file.')
+            bet[bsetmp, maskPath, '-m', '-n', '-f', thr] & FG
 
 
         elif dim==3:
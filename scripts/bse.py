@@ -1,13 +1,57 @@
 #!/usr/bin/env python
 
-from plumbum import cli, FG
-from plumbum.cmd import fslroi, ImageMath
+from plumbum import cli
 from conversion import read_bvals
 import os
-from util import load_nifti, save_nifti, B0_THRESHOLD
+from util import as_nifti, iter_volumes, save_nifti, B0_THRESHOLD
+from masking import masking
 
 import numpy as np
 
+
+def bse(dwi, bvals, out=None, mask=None, threshold=B0_THRESHOLD, method='first'):
+    '''Extracts the baseline image of a 4D DWI in-process. dwi may be a path or a nibabel image, bvals a bval file
+    or a list of bvalues, mask a path, image, or array. method is one of
+    first: the first b0, min: the volume of minimum bvalue, avg: the average of b0s, all: all b0s stacked in 4D.
+    Returns the baseline image, and saves it if out is given.'''
+
+    dwi= as_nifti(dwi)
+    if isinstance(bvals, (str, os.PathLike)):
+        bvals= read_bvals(str(bvals))
+
+    idx= np.where([bval < float(threshold) for bval in bvals])[0]
+    if len(idx)<1:
+        raise Exception('No b0 image found. Check the bval file.')
+
+    if method=='first':
+        data= np.asanyarray(dwi.dataobj[..., int(idx[0])])
+
+    elif method=='min':
+        data= np.asanyarray(dwi.dataobj[..., int(np.argmin(bvals))])
+
+    elif method=='avg':
+        # only the b0 volumes are read, one at a time
+        data= np.zeros(dwi.shape[:3], dtype='float32')
+        for vol in iter_volumes(dwi, idx):
+            data+= vol
+        data/= len(idx)
+
+    elif method=='all':
+        data= np.stack([np.asanyarray(dwi.dataobj[..., int(i)]) for i in idx], axis=-1)
+
+    else:
+        raise ValueError('Invalid method {}, must be one of first, min, avg, all'.format(method))
+
+    b0= dwi.__class__(data, dwi.affine, header=dwi.header.copy())
+    if mask is not None:
+        b0= masking(b0, mask)
+
+    if out:
+        save_nifti(out, b0.dataobj, b0.affine, b0.header)
+
+    return b0
+
+
 class App(cli.Application):
     """Extracts the baseline (b0) from a nifti DWI. Assumes
     the diffusion volumes are indexed by the last axis. Chooses the first b0 as the
@@ -70,49 +114,23 @@ class App(cli.Application):
         if self.out is None:
             self.out= os.path.join(directory, prefix+'_bse.nii.gz')
 
-        if self.dwi.endswith('.nii') or self.dwi.endswith('.nii.gz'):
-
-            if not self.bval_file:
-                self.bval_file= os.path.join(directory, prefix+'.bval')
-
-            bvals= read_bvals(self.bval_file)
-            idx= np.where([bval < self.b0_threshold for bval in bvals])[0]
-
-
-            if len(idx)>=1:
-
-                # default is the first b0
-                if not (self.minimum or self.average or self.all):
-                    fslroi[self.dwi, self.out, idx, 1] & FG
-
-                elif self.minimum:
-                    fslroi[self.dwi, self.out, idx, np.argsort(bvals)[0]] & FG
-
-                elif self.average:
-                    # Load the given dwi to get image data
-                    dwi= load_nifti(self.dwi._path)
-                    hdr= dwi.header
-                    mri= dwi.get_data()
-
-                    avg_bse= np.mean(mri[:,:,:,idx], axis= 3)
-
-                    # Now write back the average bse
-                    save_nifti(self.out, avg_bse, dwi.affine, hdr)
-
-
-                elif self.all:
-                    fslroi[self.dwi, self.out, idx, len(idx)] & FG
-
-
-            else:
-                raise Exception('No b0 image found. Check the bval file.')
+        if not (self.dwi.endswith('.nii') or self.dwi.endswith('.nii.gz')):
+            raise Exception("Invalid dwi format, must be a nifti image")
 
+        if not self.bval_file:
+            self.bval_file= os.path.join(directory, prefix+'.bval')
 
+        if self.minimum:
+            method= 'min'
+        elif self.average:
+            method= 'avg'
+        elif self.all:
+            method= 'all'
         else:
-            raise Exception("Invalid dwi format, must be a nifti image")
+            # default is the first b0
+            method= 'first'
 
-        if self.dwimask:
-            ImageMath(3, self.out, 'm', self.out, self.dwimask)
+        bse(self.dwi, self.bval_file, self.out, self.dwimask, self.b0_threshold, method)
 
 
 if __name__ == '__main__':
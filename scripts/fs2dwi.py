@@ -1,28 +1,48 @@
 #!/usr/bin/env python
 
-from plumbum import local, cli
-import sys, os, tempfile, psutil, warnings
-from plumbum.cmd import ResampleImageBySpacing, antsApplyTransforms, ImageMath
-from subprocess import check_call
+from plumbum import local, cli, FG
+import sys, os, tempfile, warnings
+from plumbum.cmd import ResampleImageBySpacing, antsApplyTransforms
 
-from util import load_nifti, ANTSREG_THREADS, FILEDIR, pjoin
+from util import load_nifti, FILEDIR, pjoin, ANTSREG_OUTPUTS, ANTSREG_RIGID_OUTPUTS, \
+    cached, tool_identity, task_threads, crop_to_mask, TMP_EXT
+from bse import bse
+from masking import masking
+
+
+def antsRegistrationSyNMI(dim, moving, fixed, outPrefix, transform='s'):
+    '''Runs antsRegistrationSyNMI.sh, reusing the outputs of an identical earlier run from the cache'''
+
+    script= local[pjoin(FILEDIR,'antsRegistrationSyNMI.sh')]
+    outputs= ANTSREG_RIGID_OUTPUTS if transform=='r' else ANTSREG_OUTPUTS
+
+    cmd= script['-d', str(dim), '-t', transform, '-m', moving, '-f', fixed, '-o', outPrefix]
+    # the thread count does not change the outputs, so it is left out of the cache key
+    cached(lambda: cmd['-n', task_threads()] & FG, cmd.formulate(),
+           inputs= [moving, fixed],
+           outputs= [str(outPrefix)+x for x in outputs],
+           version= tool_identity(script.executable)+tool_identity('antsRegistration'))
 
 
 def rigid_registration(dim, moving, fixed, outPrefix):
 
-    check_call((' ').join([pjoin(FILEDIR,'antsRegistrationSyNMI.sh'), '-d', str(dim), '-t', 'r', '-m', moving, 
-                           '-f', fixed, '-o', outPrefix, '-n', ANTSREG_THREADS]), shell=True)
+    antsRegistrationSyNMI(dim, moving, fixed, outPrefix, transform='r')
 
 
-def registerFs2Dwi(tmpdir, namePrefix, b0masked, brain, wmparc, wmparc_out):
+def registerFs2Dwi(tmpdir, namePrefix, b0masked, brain, wmparc, wmparc_out, crop=False):
 
     pre = tmpdir / namePrefix
     affine = pre + '0GenericAffine.mat'
     warp = pre + '1Warp.nii.gz'
 
+    fixed, moving= b0masked, brain
+    if crop:
+        # the transforms computed on the crops apply to the full images, which are kept as the reference below
+        fixed= crop_to_mask(b0masked, pre + 'FixedCrop' + TMP_EXT)
+        moving= crop_to_mask(brain, pre + 'MovingCrop' + TMP_EXT)
+
     print('Computing warp from brain.nii.gz to (resampled) baseline')
-    check_call((' ').join([pjoin(FILEDIR,'antsRegistrationSyNMI.sh'), '-d', '3', '-m', brain, '-f', b0masked, '-o', pre,
-                           '-n', ANTSREG_THREADS]), shell=True)
+    antsRegistrationSyNMI(3, moving, fixed, pre)
 
     print('Applying warp to wmparc.nii.gz to create (resampled) wmparcindwi.nii.gz')
     antsApplyTransforms('-d', '3', '-i', wmparc, '-t', warp, affine,
@@ -35,15 +55,19 @@ def registerFs2Dwi(tmpdir, namePrefix, b0masked, brain, wmparc, wmparc_out):
 # The functions registerFs2Dwi and registerFs2Dwi_T2 differ by the use of t2masked, T2toBrainAffine, and a print statement
 
 
-def registerFs2Dwi_T2(tmpdir, namePrefix, b0masked, t2masked, T2toBrainAffine, wmparc, wmparc_out):
+def registerFs2Dwi_T2(tmpdir, namePrefix, b0masked, t2masked, T2toBrainAffine, wmparc, wmparc_out, crop=False):
 
     pre = tmpdir / namePrefix
     affine = pre + '0GenericAffine.mat'
     warp = pre + '1Warp.nii.gz'
 
+    fixed, moving= b0masked, t2masked
+    if crop:
+        fixed= crop_to_mask(b0masked, pre + 'FixedCrop' + TMP_EXT)
+        moving= crop_to_mask(t2masked, pre + 'MovingCrop' + TMP_EXT)
+
     print('Computing warp from t2 to (resampled) baseline')
-    check_call((' ').join([pjoin(FILEDIR,'antsRegistrationSyNMI.sh'), '-d', '3', '-m', t2masked, '-f', b0masked, '-o', pre,
-                           '-n', ANTSREG_THREADS]), shell=True)
+    antsRegistrationSyNMI(3, moving, fixed, pre)
 
     print('Applying warp to wmparc.nii.gz to create (resampled) wmparcindwi.nii.gz')
     antsApplyTransforms('-d', '3', '-i', wmparc, '-t', warp, affine, T2toBrainAffine,
@@ -96,6 +120,12 @@ class FsToDwi(cli.Application):
         help='Debug mode, saves intermediate transforms to out/fs2dwi-debug-<pid>',
         default= False)
 
+    crop = cli.Flag(
+        ['--crop'],
+        help='register the images cropped to the bounding box of the brain, padded by PNLPIPE_CROP_PADDING mm, '
+             'which is faster on images with a large empty background',
+        default= False)
+
     def main(self):
 
         if not self.nested_command:
@@ -150,8 +180,7 @@ class Direct(cli.Application):
                           '--regheader', wmparcmgz, '--o', wmparc)
 
             print('Extracting B0 from DWI and masking it')
-            check_call((' ').join([pjoin(FILEDIR, 'bse.py'), '-i', self.parent.dwi, '--bvals', self.parent.bvals_file,
-                                   '-m', self.parent.dwimask, '-o', b0masked]), shell= True)
+            bse(self.parent.dwi, self.parent.bvals_file, b0masked, self.parent.dwimask)
             print('Made masked B0')
 
 
@@ -162,7 +191,7 @@ class Direct(cli.Application):
 
 
             print('Registering wmparc to B0')
-            registerFs2Dwi(tmpdir, 'fsbrainToB0', b0masked, brain, wmparc, wmparcindwi)
+            registerFs2Dwi(tmpdir, 'fsbrainToB0', b0masked, brain, wmparc, wmparcindwi, self.parent.crop)
 
             if (dwi_res!=brain_res).any():
                 print('DWI resolution is different from FreeSurfer brain resolution')
@@ -174,7 +203,8 @@ class Direct(cli.Application):
                 ResampleImageBySpacing('3', b0masked, b0maskedbrain, brain_res.tolist())
 
                 print('Registering wmparc to resampled B0')
-                registerFs2Dwi(tmpdir, 'fsbrainToResampledB0', b0maskedbrain, brain, wmparc, wmparcinbrain)
+                registerFs2Dwi(tmpdir, 'fsbrainToResampledB0', b0maskedbrain, brain, wmparc, wmparcinbrain,
+                               self.parent.crop)
 
 
             # copying images to outDir
@@ -219,7 +249,7 @@ class WithT2(cli.Application):
 
             t2masked= tmpdir / 't2masked.nii.gz'
             print('Masking the T2')
-            ImageMath(3, t2masked, 'm', self.t2, self.t2mask)
+            masking(self.t2, self.t2mask, t2masked)
 
             brain = tmpdir / "brain.nii.gz"
             wmparc = tmpdir / "wmparc.nii.gz"
@@ -242,8 +272,7 @@ class WithT2(cli.Application):
                           '--regheader', wmparcmgz, '--o', wmparc)
 
             print('Extracting B0 from DWI and masking it')
-            check_call((' ').join([pjoin(FILEDIR, 'bse.py'), '-i', self.parent.dwi, '--bvals', self.parent.bvals_file,
-                                   '-m', self.parent.dwimask, '-o', b0masked]), shell= True)
+            bse(self.parent.dwi, self.parent.bvals_file, b0masked, self.parent.dwimask)
             print('Made masked B0')
 
 
@@ -268,7 +297,7 @@ class WithT2(cli.Application):
 
             print('Registering wmparc to B0 through T2')
             registerFs2Dwi_T2(tmpdir, 'fsbrainToT2ToB0', b0masked, t2masked,
-                              BrainToT2Affine, wmparc, wmparcindwi)
+                              BrainToT2Affine, wmparc, wmparcindwi, self.parent.crop)
 
             if (dwi_res!=brain_res).any():
                 print('DWI resolution is different from FreeSurfer brain resolution')
@@ -281,7 +310,7 @@ class WithT2(cli.Application):
 
                 print('Registering wmparc to resampled B0')
                 registerFs2Dwi_T2(tmpdir, 'fsbrainToT2ToResampledB0', b0maskedbrain, t2masked,
-                                  BrainToT2Affine, wmparc, wmparcinbrain)
+                                  BrainToT2Affine, wmparc, wmparcinbrain, self.parent.crop)
 
             # copying images to outDir
             b0masked.copy(self.parent.out)
@@ -7,7 +7,7 @@ from util import BET_THRESHOLD, logfmt, pjoin, B0_THRESHOLD, REPOL_BSHELL_GREATE
 from shutil import copyfile
 from _eddy_config import obtain_fsl_eddy_params
 from nibabel import load
-from util import save_nifti
+from util import save_nifti, load_nifti_lazy, read_volumes
 from conversion import read_bvals, read_bvecs, write_bvecs
 import numpy as np
 
@@ -163,9 +163,9 @@ class Eddy(cli.Application):
             merged_bvecs[ind,: ]= wo_repol_bvecs[ind,: ]
 
             repol_data= load(outPrefix + '.nii.gz')
-            wo_repol_data= load(wo_repol_outPrefix + '.nii.gz')
-            merged_data= repol_data.get_fdata().copy()
-            merged_data[...,ind]= wo_repol_data.get_fdata()[...,ind]
+            wo_repol_data= load_nifti_lazy(wo_repol_outPrefix + '.nii.gz')
+            merged_data= repol_data.get_fdata(dtype='float32', caching='unchanged')
+            merged_data[...,ind]= read_volumes(wo_repol_data, ind)
 
             save_nifti(outPrefix + '.nii.gz', merged_data, repol_data.affine, hdr=repol_data.header)
             
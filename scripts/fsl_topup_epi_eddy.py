@@ -4,13 +4,15 @@ from plumbum import cli, FG, local
 from plumbum.cmd import topup, applytopup, fslmaths, rm, fslmerge, cat, bet, gzip
 
 from util import BET_THRESHOLD, TemporaryDirectory, logfmt, load_nifti, FILEDIR, \
-    REPOL_BSHELL_GREATER, save_nifti, B0_THRESHOLD
+    REPOL_BSHELL_GREATER, save_nifti, B0_THRESHOLD, load_nifti_lazy, read_volumes, \
+    TMP_EXT, intermediate_env, compress_niftis, cached_call, fsl_ext
 from os.path import join as pjoin, abspath, basename
-from subprocess import check_call
 from os import environ
+import os
 from shutil import copyfile
 from conversion import read_bvals, read_bvecs, write_bvals, write_bvecs
 from _eddy_config import obtain_fsl_eddy_params
+from bse import bse
 from nibabel import load
 import numpy as np
 
@@ -22,12 +24,47 @@ logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format=logfmt(__file__))
 
 
+# topup options naming an output image, an output text file, and a series of per-volume outputs
+TOPUP_IMAGE_OUTPUTS= ['--iout', '--fout']
+TOPUP_TEXT_OUTPUTS= ['--logout']
+TOPUP_SERIES_OUTPUTS= ['--dfout', '--rbmout', '--jacout']
+
+
+def topup_files(params):
+    '''Config files read and extra files written by topup with the options params, (None, None) if it writes
+    per-volume series that the cache cannot restore'''
+
+    options= {}
+    tokens= params.split()
+    for i, token in enumerate(tokens):
+        if token.startswith('--'):
+            if '=' in token:
+                key, value= token.split('=', 1)
+            else:
+                key, value= token, tokens[i+1] if i+1<len(tokens) else ''
+            options[key]= value
+
+    if any(key in options for key in TOPUP_SERIES_OUTPUTS):
+        return None, None
+
+    inputs= []
+    if '--config' in options:
+        config= options['--config']
+        # topup looks up bare names in $FSLDIR/etc/flirtsch
+        inputs.append(config if os.path.isfile(config) else pjoin(FSLDIR, 'etc', 'flirtsch', config))
+
+    outputs= [options[key]+fsl_ext() for key in TOPUP_IMAGE_OUTPUTS if key in options]+ \
+             [options[key] for key in TOPUP_TEXT_OUTPUTS if key in options]
+
+    return inputs, outputs
+
+
 def obtainB0(inVol, bvalFile, outVol, num_b0):
 
     if num_b0 == '1':
-        check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', inVol, '--bvals', bvalFile, '-o', outVol]), shell=True)
+        bse(inVol, bvalFile, outVol)
     elif num_b0 == '-1':
-        check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', inVol, '--bvals', bvalFile, '-o', outVol, '--all']), shell=True)
+        bse(inVol, bvalFile, outVol, method='all')
     else:
         raise ValueError('Invalid --numb0')
 
@@ -192,9 +229,9 @@ class TopupEddyEpi(cli.Application):
                 merged_bvecs[ind, :] = wo_repol_bvecs[ind, :]
 
                 repol_data = load(outPrefix + '.nii.gz')
-                wo_repol_data = load(wo_repol_outPrefix + '.nii.gz')
-                merged_data = repol_data.get_fdata().copy()
-                merged_data[..., ind] = wo_repol_data.get_fdata()[..., ind]
+                wo_repol_data = load_nifti_lazy(wo_repol_outPrefix + '.nii.gz')
+                merged_data = repol_data.get_fdata(dtype='float32', caching='unchanged')
+                merged_data[..., ind] = read_volumes(wo_repol_data, ind)
 
                 save_nifti(outPrefix + '.nii.gz', merged_data, repol_data.affine, hdr=repol_data.header)
 
@@ -282,35 +319,36 @@ class TopupEddyEpi(cli.Application):
             # mask both volumes, fslmaths can do that irrespective of dimension
             logging.info('Masking the volumes')
 
-            primaryMaskedVol = tmpdir / 'primaryMasked.nii.gz'
-            secondaryMaskedVol = tmpdir / 'secondaryMasked.nii.gz'
+            primaryMaskedVol = tmpdir / ('primaryMasked' + TMP_EXT)
+            secondaryMaskedVol = tmpdir / ('secondaryMasked' + TMP_EXT)
 
-            if primaryMask:
-                # mask the volume
-                fslmaths[primaryVol, '-mas', primaryMask, primaryMaskedVol] & FG
-            else:
-                primaryMaskedVol= primaryVol
+            with intermediate_env():
+                if primaryMask:
+                    # mask the volume
+                    fslmaths[primaryVol, '-mas', primaryMask, primaryMaskedVol] & FG
+                else:
+                    primaryMaskedVol= primaryVol
 
-            if secondaryMask:
-                # mask the volume
-                fslmaths[secondaryVol, '-mas', secondaryMask, secondaryMaskedVol] & FG
-            else:
-                secondaryMaskedVol= secondaryVol
+                if secondaryMask:
+                    # mask the volume
+                    fslmaths[secondaryVol, '-mas', secondaryMask, secondaryMaskedVol] & FG
+                else:
+                    secondaryMaskedVol= secondaryVol
 
 
-            logging.info('Extracting B0 from masked volumes')
-            B0_PA= tmpdir / 'B0_PA.nii.gz'
-            B0_AP= tmpdir / 'B0_AP.nii.gz'
+                logging.info('Extracting B0 from masked volumes')
+                B0_PA= tmpdir / ('B0_PA' + TMP_EXT)
+                B0_AP= tmpdir / ('B0_AP' + TMP_EXT)
 
-            obtainB0(primaryMaskedVol, primaryBval, B0_PA, self.num_b0)
+                obtainB0(primaryMaskedVol, primaryBval, B0_PA, self.num_b0)
 
-            if dim2==4:
-                obtainB0(secondaryMaskedVol, secondaryBval, B0_AP, self.num_b0)
-            else:
-                B0_AP= secondaryMaskedVol
+                if dim2==4:
+                    obtainB0(secondaryMaskedVol, secondaryBval, B0_AP, self.num_b0)
+                else:
+                    B0_AP= secondaryMaskedVol
 
 
-            B0_PA_AP_merged = tmpdir / 'B0_PA_AP_merged.nii.gz'
+            B0_PA_AP_merged = tmpdir / ('B0_PA_AP_merged' + TMP_EXT)
             with open(self.acqparams_file._path) as f:
                 acqp= f.read().split('\n')
 
@@ -330,7 +368,8 @@ class TopupEddyEpi(cli.Application):
 
 
             logging.info('Merging B0_PA and BO_AP')
-            fslmerge('-t', B0_PA_AP_merged, B0_PA, B0_AP)
+            with intermediate_env():
+                fslmerge('-t', B0_PA_AP_merged, B0_PA, B0_AP)
 
 
             topup_params, applytopup_params, eddy_openmp_params= obtain_fsl_eddy_params(self.eddy_config_file._path)
@@ -346,11 +385,20 @@ class TopupEddyEpi(cli.Application):
 
             logging.info('Running topup')
             topup_results= tmpdir / 'topup_results'
-            topup[f'--imain={B0_PA_AP_merged}',
-                  f'--datain={acqp_topup}',
-                  f'--out={topup_results}',
-                  '--verbose',
-                  topup_params.split()] & FG
+            with intermediate_env():
+                topupCmd= topup[f'--imain={B0_PA_AP_merged}',
+                                f'--datain={acqp_topup}',
+                                f'--out={topup_results}',
+                                '--verbose',
+                                topup_params.split()]
+                configs, extraOutputs= topup_files(topup_params)
+                if extraOutputs is None:
+                    topupCmd & FG
+                else:
+                    cached_call(topupCmd,
+                                inputs= [B0_PA_AP_merged, acqp_topup]+configs,
+                                outputs= [topup_results+'_fieldcoef'+fsl_ext(), topup_results+'_movpar.txt']+
+                                         extraOutputs)
 
 
 
@@ -359,28 +407,29 @@ class TopupEddyEpi(cli.Application):
             topupMask= tmpdir / 'topup_mask.nii.gz'
 
             # applytopup on primary4D,secondary4D/3D
-            topupOut= tmpdir / 'topup_out.nii.gz'
-            if dim2==4:
-                applytopup[f'--imain={primaryMaskedVol},{secondaryMaskedVol}',
-                           f'--datain={self.acqparams_file}',
-                           '--inindex=1,2',
-                           f'--topup={topup_results}',
-                           f'--out={topupOut}',
-                           '--verbose',
-                           applytopup_params.split()] & FG
-
-            else:
-                applytopup[f'--imain={B0_PA},{B0_AP}',
-                           f'--datain={self.acqparams_file}',
-                           '--inindex=1,2',
-                           f'--topup={topup_results}',
-                           f'--out={topupOut}',
-                           '--verbose',
-                           applytopup_params.split()] & FG
-
-
-            topupOutMean= tmpdir / 'topup_out_mean.nii.gz'
-            fslmaths[topupOut, '-Tmean', topupOutMean] & FG
+            topupOut= tmpdir / ('topup_out' + TMP_EXT)
+            with intermediate_env():
+                if dim2==4:
+                    applytopup[f'--imain={primaryMaskedVol},{secondaryMaskedVol}',
+                               f'--datain={self.acqparams_file}',
+                               '--inindex=1,2',
+                               f'--topup={topup_results}',
+                               f'--out={topupOut}',
+                               '--verbose',
+                               applytopup_params.split()] & FG
+
+                else:
+                    applytopup[f'--imain={B0_PA},{B0_AP}',
+                               f'--datain={self.acqparams_file}',
+                               '--inindex=1,2',
+                               f'--topup={topup_results}',
+                               f'--out={topupOut}',
+                               '--verbose',
+                               applytopup_params.split()] & FG
+
+
+                topupOutMean= tmpdir / ('topup_out_mean' + TMP_EXT)
+                fslmaths[topupOut, '-Tmean', topupOutMean] & FG
             bet[topupOutMean, topupMask._path.split('_mask.nii.gz')[0], '-m', '-n'] & FG
 
 
@@ -440,8 +489,9 @@ class TopupEddyEpi(cli.Application):
                 combinedBvecs = tmpdir / 'combinedBvecs.txt'
                 write_bvecs(combinedBvecs, bvecs1+bvecs2)
 
-                combinedData= tmpdir / 'combinedData.nii.gz'
-                fslmerge('-t', combinedData, primaryMaskedVol, secondaryMaskedVol)
+                combinedData= tmpdir / ('combinedData' + TMP_EXT)
+                with intermediate_env():
+                    fslmerge('-t', combinedData, primaryMaskedVol, secondaryMaskedVol)
 
 
                 _eddy_openmp(combinedData, combinedBvals, combinedBvecs, eddy_openmp_params)
@@ -458,6 +508,13 @@ class TopupEddyEpi(cli.Application):
             # rename topupMask to have same prefix as that of eddy corrected volume
             topupMask.move(outPrefix+'_mask.nii.gz')
 
+            # the working directory becomes the output directory: the throwaway intermediates are removed,
+            # and only the topup results kept next to the eddy outputs are compressed
+            for name in ['primaryMasked', 'secondaryMasked', 'B0_PA', 'B0_AP', 'B0_PA_AP_merged',
+                         'topup_out', 'topup_out_mean', 'combinedData']:
+                (tmpdir / (name + TMP_EXT)).delete()
+            compress_niftis(tmpdir, 'topup_results*')
+
             tmpdir.move(self.outDir)
 
 
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory, ANTSREG_THREADS, FILEDIR, pjoin
+from util import logfmt, TemporaryDirectory
+from fs2dwi import rigid_registration
 from plumbum import local, cli, FG
 from plumbum.cmd import antsApplyTransforms
-from subprocess import check_call
 
 import logging
 logger = logging.getLogger()
@@ -29,12 +29,7 @@ class App(cli.Application):
             tmpdir = local.path(tmpdir)
             pre = tmpdir / 'ants'
             rigidxfm = pre + '0GenericAffine.mat'
-            check_call((' ').join([pjoin(FILEDIR,'antsRegistrationSyNMI.sh'),'-f', self.target,
-                        '-m', self.infile,
-                        '-t', 'r',
-                        '-o', pre,
-                        '-n', ANTSREG_THREADS
-                        ]), shell= True)
+            rigid_registration(3, self.infile, self.target, pre)
 
             antsApplyTransforms['-d', '3'
                                 ,'-i', self.labelmap
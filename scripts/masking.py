@@ -1,7 +1,28 @@
 #!/usr/bin/env python
 
-from plumbum.cmd import ImageMath
 from plumbum import cli
+import numpy as np
+from util import as_nifti, save_nifti
+
+
+def masking(img, mask, out=None):
+    '''Multiplies a 3D/4D image by a 3D mask. img and mask may be paths or nibabel images, mask may also be an array.
+    Returns the masked image, and saves it if out is given.'''
+
+    img= as_nifti(img)
+    if not isinstance(mask, np.ndarray):
+        mask= np.asanyarray(as_nifti(mask).dataobj)
+
+    data= np.asanyarray(img.dataobj)
+    mask= (mask>0).reshape(mask.shape[:3]+(1,)*(data.ndim-3))
+    masked= data*mask
+
+    hdr= img.header.copy()
+    if out:
+        save_nifti(out, masked, img.affine, hdr)
+
+    return img.__class__(masked, img.affine, header=hdr)
+
 
 class App(cli.Application):
     "Multiplies an image by its mask"
@@ -30,7 +51,7 @@ class App(cli.Application):
 
     def main(self):
 
-        ImageMath(self.dim, self.out, 'm', self.img, self.mask)
+        masking(self.img, self.mask, self.out)
 
 
 if __name__ == '__main__':
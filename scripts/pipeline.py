@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+from plumbum import local, cli
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from subprocess import STDOUT
+import os, sys, json, time
+
+from util import logfmt, FILEDIR, pjoin, N_CPU, N_PROC
+
+import logging
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format=logfmt(__file__))
+
+
+class Stage(object):
+    '''One script call of the pipeline, with the files it reads and the files it makes.
+    A stage depends on the stages that make any of its inputs.'''
+
+    def __init__(self, name, script, args, inputs, outputs):
+        self.name= name
+        self.script= script
+        self.args= [str(x) for x in args]
+        self.inputs= [str(x) for x in inputs]
+        self.outputs= [str(x) for x in outputs]
+
+    def __repr__(self):
+        return '<Stage {}>'.format(self.name)
+
+    def cmd(self):
+        return [pjoin(FILEDIR, self.script)]+self.args
+
+    def stamp(self, stampDir):
+        return pjoin(stampDir, self.name+'.json')
+
+    def uptodate(self, stampDir):
+        '''True if all outputs exist, are newer than all inputs, and were made with the same command'''
+
+        try:
+            with open(self.stamp(stampDir)) as f:
+                if json.load(f)!=self.cmd():
+                    return False
+            oldest_output= min(os.path.getmtime(x) for x in self.outputs)
+            newest_input= max([os.path.getmtime(x) for x in self.inputs], default=0)
+        except (OSError, ValueError):
+            return False
+
+        return oldest_output>=newest_input
+
+    def run(self, stampDir, logDir, ncpu):
+        '''Runs the stage with a share ncpu of the CPU budget, logging its output to logDir/<name>.log'''
+
+        # a failed or interrupted run must not look complete
+        if os.path.exists(self.stamp(stampDir)):
+            os.remove(self.stamp(stampDir))
+
+        cmd= local[self.cmd()[0]][self.args].with_env(PNLPIPE_NCPU=str(ncpu))
+        with open(pjoin(logDir, self.name+'.log'), 'w') as log:
+            p= cmd.popen(stdout=log, stderr=STDOUT)
+            p.wait()
+
+        if p.returncode:
+            raise RuntimeError('{} failed with exit code {}, see {}'.format(
+                self.name, p.returncode, pjoin(logDir, self.name+'.log')))
+
+        missing= [x for x in self.outputs if not os.path.exists(x)]
+        if missing:
+            raise RuntimeError('{} did not make {}'.format(self.name, ', '.join(missing)))
+
+        with open(self.stamp(stampDir), 'w') as f:
+            json.dump(self.cmd(), f)
+
+
+def dependencies(stages):
+    '''Maps each stage name to the names of the stages making its inputs'''
+
+    maker= {x: s.name for s in stages for x in s.outputs}
+    return {s.name: sorted(set(maker[x] for x in s.inputs if x in maker)) for s in stages}
+
+
+def stale_stages(stages, stampDir):
+    '''Names of the stages that have to run: not up to date themselves, or depending on a stage that has to run'''
+
+    deps= dependencies(stages)
+    stale= set()
+    # stages are declared in dependency order
+    for s in stages:
+        if not s.uptodate(stampDir) or any(d in stale for d in deps[s.name]):
+            stale.add(s.name)
+
+    return stale
+
+
+def run_stages(stages, outDir, jobs=2, dry_run=False):
+    '''Runs the stale stages, up to jobs of them at a time as soon as the stages they depend on have finished.
+    The CPU budget is split between the concurrent stages. Returns the names of the failed stages.'''
+
+    stampDir= pjoin(outDir, '.pipeline')
+    logDir= pjoin(outDir, 'logs')
+    os.makedirs(stampDir, exist_ok=True)
+    os.makedirs(logDir, exist_ok=True)
+
+    deps= dependencies(stages)
+    stale= stale_stages(stages, stampDir)
+    for s in stages:
+        logging.info('{:<12} {}'.format(s.name, 'to run' if s.name in stale else 'up to date'))
+    if dry_run:
+        return []
+
+    # branches like FreeSurfer are mostly single-threaded, so jobs may exceed the CPU budget
+    jobs= max(1, int(jobs))
+    ncpu= max(1, N_CPU//jobs)
+
+    pending= [s for s in stages if s.name in stale]
+    done= set(s.name for s in stages if s.name not in stale)
+    failed= set()
+    running= {}
+    timing= {}
+
+    with ThreadPoolExecutor(jobs) as executor:
+        while pending or running:
+
+            # stages downstream of a failure are not run
+            for s in [s for s in pending if any(d in failed for d in deps[s.name])]:
+                logging.error('Skipping {}, a stage it depends on failed'.format(s.name))
+                pending.remove(s)
+                failed.add(s.name)
+
+            for s in [s for s in pending if all(d in done for d in deps[s.name])]:
+                if len(running)==jobs:
+                    break
+                logging.info('Running {}: {}'.format(s.name, ' '.join(s.cmd())))
+                pending.remove(s)
+                running[executor.submit(s.run, stampDir, logDir, ncpu)]= (s, time.time())
+
+            if not running:
+                continue
+
+            finished, _= wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                s, start= running.pop(future)
+                timing[s.name]= time.time()-start
+                try:
+                    future.result()
+                    done.add(s.name)
+                    logging.info('Finished {} in {:.1f} s'.format(s.name, timing[s.name]))
+                except Exception as e:
+                    failed.add(s.name)
+                    logging.error(str(e))
+
+    return sorted(failed)
+
+
+def pnl_stages(outDir, dwi, bvals, bvecs, t1, t2=None, nproc=N_PROC):
+    '''Stages of docs/dag.png for one subject: align -> bet_mask/atlas -> eddy -> epi -> ukf and
+    fs -> fs2dwi -> wmql, with outputs named after their inputs in outDir'''
+
+    out= lambda name: pjoin(outDir, name)
+    stages= []
+
+    stages.append(Stage('dwi_align', 'align.py',
+                        ['-i', dwi, '--bvals', bvals, '--bvecs', bvecs, '--axisAlign', '--center', '-o', out('dwi-xc')],
+                        [dwi, bvals, bvecs], [out('dwi-xc.nii.gz'), out('dwi-xc.bval'), out('dwi-xc.bvec')]))
+
+    stages.append(Stage('dwi_mask', 'bet_mask.py',
+                        ['-i', out('dwi-xc.nii.gz'), '--bvals', out('dwi-xc.bval'), '-o', out('dwi-xc')],
+                        [out('dwi-xc.nii.gz'), out('dwi-xc.bval')], [out('dwi-xc_mask.nii.gz')]))
+
+    structurals= [('t1', t1)]+([('t2', t2)] if t2 else [])
+    for modality, img in structurals:
+        stages.append(Stage(modality+'_align', 'align.py',
+                            ['-i', img, '--axisAlign', '--center', '-o', out(modality+'-xc')],
+                            [img], [out(modality+'-xc.nii.gz')]))
+
+        stages.append(Stage(modality+'_mask', 'atlas.py',
+                            ['-t', out(modality+'-xc.nii.gz'), '--train', modality, '-n', nproc,
+                             '-o', out(modality+'-xc')],
+                            [out(modality+'-xc.nii.gz')], [out(modality+'-xc-mask.nii.gz')]))
+
+    stages.append(Stage('eddy', 'pnl_eddy.py',
+                        ['-i', out('dwi-xc.nii.gz'), '--bvals', out('dwi-xc.bval'), '--bvecs', out('dwi-xc.bvec'),
+                         '-o', out('dwi-xc-ed'), '-n', nproc, '--force'],
+                        [out('dwi-xc.nii.gz'), out('dwi-xc.bval'), out('dwi-xc.bvec')],
+                        [out('dwi-xc-ed.nii.gz'), out('dwi-xc-ed.bval'), out('dwi-xc-ed.bvec')]))
+    dwiPrefix, dwimask= out('dwi-xc-ed'), out('dwi-xc_mask.nii.gz')
+
+    if t2:
+        stages.append(Stage('epi', 'pnl_epi.py',
+                            ['--dwi', dwiPrefix+'.nii.gz', '--bvals', dwiPrefix+'.bval', '--bvecs', dwiPrefix+'.bvec',
+                             '--dwimask', dwimask, '--t2', out('t2-xc.nii.gz'), '--t2mask', out('t2-xc-mask.nii.gz'),
+                             '-o', out('dwi-xc-ed-epi'), '-n', nproc, '--force'],
+                            [dwiPrefix+'.nii.gz', dwiPrefix+'.bval', dwiPrefix+'.bvec', dwimask,
+                             out('t2-xc.nii.gz'), out('t2-xc-mask.nii.gz')],
+                            [out('dwi-xc-ed-epi.nii.gz'), out('dwi-xc-ed-epi-mask.nii.gz'),
+                             out('dwi-xc-ed-epi.bval'), out('dwi-xc-ed-epi.bvec')]))
+        dwiPrefix, dwimask= out('dwi-xc-ed-epi'), out('dwi-xc-ed-epi-mask.nii.gz')
+
+    stages.append(Stage('ukf', 'ukf.py',
+                        ['-i', dwiPrefix+'.nii.gz', '--bvals', dwiPrefix+'.bval', '--bvecs', dwiPrefix+'.bvec',
+                         '-m', dwimask, '-o', out('ukf.vtk')],
+                        [dwiPrefix+'.nii.gz', dwiPrefix+'.bval', dwiPrefix+'.bvec', dwimask], [out('ukf.vtk')]))
+
+    fs_args= ['-i', out('t1-xc.nii.gz'), '-m', out('t1-xc-mask.nii.gz'), '-o', out('fs'), '-n', nproc, '--force']
+    stages.append(Stage('fs', 'fs.py', fs_args,
+                        [out('t1-xc.nii.gz'), out('t1-xc-mask.nii.gz')],
+                        [out('fs/mri/brain.mgz'), out('fs/mri/wmparc.mgz')]))
+
+    stages.append(Stage('fs2dwi', 'fs2dwi.py',
+                        ['-f', out('fs'), '--dwi', dwiPrefix+'.nii.gz', '--bvals', dwiPrefix+'.bval',
+                         '--dwimask', dwimask, '-o', out('fs2dwi'), '--force', 'direct'],
+                        [out('fs/mri/brain.mgz'), out('fs/mri/wmparc.mgz'), dwiPrefix+'.nii.gz', dwimask],
+                        [out('fs2dwi/wmparcInDwi.nii.gz')]))
+
+    stages.append(Stage('wmql', 'wmql.py',
+                        ['-i', out('ukf.vtk'), '-f', out('fs2dwi/wmparcInDwi.nii.gz'), '-o', out('wmql'),
+                         '-n', nproc],
+                        [out('ukf.vtk'), out('fs2dwi/wmparcInDwi.nii.gz')], [out('wmql')]))
+
+    return stages
+
+
+class App(cli.Application):
+    '''Runs the pnlNipype pipeline of docs/dag.png for one subject.
+    Stages whose outputs are newer than their inputs, and were made with the same arguments, are skipped,
+    and independent branches (e.g. FreeSurfer and the DWI eddy/epi/ukf branch) run concurrently.
+    Outputs are saved in the output directory, the log of each stage in outDir/logs.'''
+
+    dwi = cli.SwitchAttr('--dwi', cli.ExistingFile, help='DWI in nifti', mandatory=True)
+    bvals = cli.SwitchAttr('--bvals', cli.ExistingFile, help='bval file of the DWI', mandatory=True)
+    bvecs = cli.SwitchAttr('--bvecs', cli.ExistingFile, help='bvec file of the DWI', mandatory=True)
+    t1 = cli.SwitchAttr('--t1', cli.ExistingFile, help='T1w image in nifti', mandatory=True)
+    t2 = cli.SwitchAttr('--t2', cli.ExistingFile,
+                        help='T2w image in nifti, if given, EPI distortion correction is performed', mandatory=False)
+    out = cli.SwitchAttr(['-o', '--outDir'], help='output directory', mandatory=True)
+    jobs = cli.SwitchAttr(['-j', '--jobs'], int, help='number of stages to run concurrently', default=2)
+    nproc = cli.SwitchAttr(['-n', '--nproc'], help='--nproc passed to each stage', default=N_PROC)
+    dry_run = cli.Flag('--dry-run', help='only show which stages would run', default=False)
+
+    def main(self):
+
+        outDir= os.path.abspath(self.out)
+        os.makedirs(outDir, exist_ok=True)
+
+        stages= pnl_stages(outDir, self.dwi, self.bvals, self.bvecs, self.t1, self.t2, self.nproc)
+        failed= run_stages(stages, outDir, self.jobs, self.dry_run)
+
+        if failed:
+            logging.error('Failed stages: '+', '.join(failed))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    App.run()
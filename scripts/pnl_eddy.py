@@ -2,14 +2,14 @@
 
 from __future__ import print_function
 from os import getpid
-from util import logfmt, TemporaryDirectory, pjoin, FILEDIR, N_PROC, dirname
+from util import logfmt, TemporaryDirectory, pjoin, FILEDIR, N_PROC, dirname, \
+    TMP_EXT, intermediate_env, compress_nifti, cpu_pool, nifti_nbytes
 from plumbum import local, cli, FG
 from plumbum.cmd import ls, flirt, fslmerge, tar, fslsplit
 import numpy as np
 import sys
-from multiprocessing import Pool
-from subprocess import check_call
 from conversion import read_bvecs, write_bvecs
+from bse import bse
 
 import logging
 logger = logging.getLogger()
@@ -22,7 +22,7 @@ def _Register_vol(volnii):
           ,'-sincwidth' ,'7'
           ,'-sincwindow' ,'blackman'
           ,'-in', volnii
-          ,'-ref', 'b0.nii.gz'
+          ,'-ref', 'b0'+TMP_EXT
           ,'-nosearch'
           ,'-o', volnii
           ,'-omat', volnii.with_suffix('.txt', depth=2)
@@ -30,6 +30,34 @@ def _Register_vol(volnii):
 
     return volnii
 
+
+def rotate_bvecs(bvecs, transforms):
+    '''Rotates each gradient by the rotation part of the flirt transform of its volume'''
+
+    bvecs_new= bvecs.copy()
+    for (i,t) in enumerate(transforms):
+
+        logging.info('Apply ' + t)
+        tra = np.loadtxt(t)
+
+        # removes the translation
+        aff = np.matrix(tra[0:3,0:3])
+
+        # computes the finite strain of aff to get the rotation
+        rot = aff*aff.T
+
+        # compute the square root of rot
+        [el, ev] = np.linalg.eig(rot)
+        eL = np.identity(3)*np.sqrt(el)
+        sq = ev*eL*ev.I
+
+        # finally the rotation is defined as
+        rot = sq.I*aff
+
+        bvecs_new[i] = np.dot(rot,bvecs[i]).tolist()[0]
+
+    return bvecs_new
+
 class App(cli.Application):
     '''Eddy current correction.'''
 
@@ -54,7 +82,9 @@ class App(cli.Application):
 
         outxfms = self.out.dirname / self.out.stem+'-xfms.tgz'
 
-        with TemporaryDirectory() as tmpdir, local.cwd(tmpdir):
+        # diced volumes, their registered float copies, and the merged DWI
+        expected_size= 3*nifti_nbytes(self.dwi, 'float32')
+        with TemporaryDirectory(expected_size=expected_size) as tmpdir, local.cwd(tmpdir), intermediate_env():
             tmpdir = local.path(tmpdir)
 
             dicePrefix = 'vol'
@@ -63,14 +93,13 @@ class App(cli.Application):
             fslsplit[self.dwi] & FG
 
             logging.info('Extract the B0')
-            check_call((' ').join([pjoin(FILEDIR,'bse.py'), '-i', self.dwi._path, 
-                                   '--bvals', self.bvalFile, '-o', 'b0.nii.gz']), shell= True)
+            bse(self.dwi, self.bvalFile, 'b0'+TMP_EXT)
 
             logging.info('Register each volume to the B0')
-            vols = sorted(tmpdir // (dicePrefix + '*.nii.gz'))
+            vols = sorted(tmpdir // (dicePrefix + '*'+TMP_EXT))
 
             # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
+            pool= cpu_pool(self.nproc)
             res= pool.map_async(_Register_vol, vols)
             volsRegistered= res.get()
             pool.close()
@@ -85,7 +114,7 @@ class App(cli.Application):
             #           ,'-sincwidth' ,'7'
             #           ,'-sincwindow' ,'blackman'
             #           ,'-in', volnii
-            #           ,'-ref', 'b0.nii.gz'
+            #           ,'-ref', 'b0'+TMP_EXT
             #           ,'-nosearch'
             #           ,'-o', volnii
             #           ,'-omat', volnii.with_suffix('.txt', depth=2)
@@ -93,36 +122,14 @@ class App(cli.Application):
             #     volsRegistered.append(volnii)
 
 
-            fslmerge('-t', 'EddyCorrect-DWI.nii.gz', volsRegistered)
+            fslmerge('-t', 'EddyCorrect-DWI'+TMP_EXT, volsRegistered)
             transforms = tmpdir.glob(dicePrefix+'*.txt')
             transforms.sort()
 
 
             logging.info('Extract the rotations and realign the gradients')
 
-            bvecs= read_bvecs(self.bvecFile._path)
-            bvecs_new= bvecs.copy()
-            for (i,t) in enumerate(transforms):
-
-                logging.info('Apply ' + t)
-                tra = np.loadtxt(t)
-
-                # removes the translation
-                aff = np.matrix(tra[0:3,0:3])
-
-                # computes the finite strain of aff to get the rotation
-                rot = aff*aff.T
-
-                # compute the square root of rot
-                [el, ev] = np.linalg.eig(rot)
-                eL = np.identity(3)*np.sqrt(el)
-                sq = ev*eL*ev.I
-
-                # finally the rotation is defined as
-                rot = sq.I*aff
-
-                bvecs_new[i] = np.dot(rot,bvecs[i]).tolist()[0]
-
+            bvecs_new= rotate_bvecs(read_bvecs(self.bvecFile._path), transforms)
 
 
             tar('cvzf', outxfms, transforms)
@@ -130,8 +137,8 @@ class App(cli.Application):
             # save modified bvecs
             write_bvecs(self.out._path+'.bvec', bvecs_new)
 
-            # save EddyCorrect-DWI
-            local.path('EddyCorrect-DWI.nii.gz').copy(self.out._path+'.nii.gz')
+            # save EddyCorrect-DWI, compressing only this final output
+            compress_nifti('EddyCorrect-DWI'+TMP_EXT, self.out._path+'.nii.gz')
 
             # copy bvals
             self.bvalFile.copy(self.out._path+'.bval')
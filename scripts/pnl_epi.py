@@ -3,10 +3,13 @@
 from __future__ import print_function
 from os import getpid
 from plumbum import local, cli
-from plumbum.cmd import antsApplyTransforms, antsRegistration, fslmaths, WarpTimeSeriesImageMultiTransform
+from plumbum.cmd import antsApplyTransforms, antsRegistration, fslmaths, WarpTimeSeriesImageMultiTransform, \
+    ComposeMultiTransform
 from fs2dwi import rigid_registration
-from subprocess import check_call
-from util import logfmt, TemporaryDirectory, FILEDIR, pjoin, N_PROC
+from bse import bse
+from masking import masking
+from antsApplyTransformsDWI import antsApplyTransformsDWI
+from util import logfmt, TemporaryDirectory, N_PROC, TMP_EXT, intermediate_env, cached_call, crop_to_mask
 import sys
 
 import logging
@@ -71,6 +74,11 @@ class App(cli.Application):
             ['-n', '--nproc'], help='''number of threads to use, if other processes in your computer 
             becomes sluggish/you run into memory error, reduce --nproc''', default= N_PROC)
 
+    crop = cli.Flag(
+            '--crop',
+            help='register the images cropped to the bounding box of their masks, padded by PNLPIPE_CROP_PADDING mm, '
+                 'which is faster on images with a large empty background')
+
     def main(self):
 
         self.out = local.path(self.out)
@@ -81,43 +89,59 @@ class App(cli.Application):
 
         with TemporaryDirectory() as tmpdir:
             tmpdir = local.path(tmpdir)
-            bse = tmpdir / 'maskedbse.nii.gz'
-            t2masked = tmpdir / 'maskedt2.nii.gz'
-            t2inbse = tmpdir / 't2inbse.nii.gz'
+            bse_file = tmpdir / ('maskedbse' + TMP_EXT)
+            t2masked = tmpdir / ('maskedt2' + TMP_EXT)
+            t2inbse = tmpdir / ('t2inbse' + TMP_EXT)
             epiwarp = tmpdir / 'epiwarp.nii.gz'
 
             t2tobse_rigid = tmpdir / 't2tobse_rigid'
             affine= tmpdir / 't2tobse_rigid0GenericAffine.mat'
 
-            logging.info('1. Extract B0 and and mask it')
-            check_call((' ').join([pjoin(FILEDIR, 'bse.py'), '-m', self.dwimask, '-i', self.dwi, 
-                                   '--bvals', self.bvals_file, '-o', bse]), shell=True)
+            with intermediate_env():
+                logging.info('1. Extract B0 and and mask it')
+                bse(self.dwi, self.bvals_file, bse_file, self.dwimask)
+
+                logging.info('2. Mask the T2')
+                masking(self.t2, self.t2mask, t2masked)
 
-            logging.info('2. Mask the T2')
-            fslmaths(self.t2mask, '-mul', self.t2, t2masked)
+            # the transforms computed on the crops apply to the full images, which are kept as the references
+            fixed, moving= bse_file, t2masked
+            if self.crop:
+                bse_crop= crop_to_mask(bse_file, tmpdir / ('maskedbse_crop' + TMP_EXT), self.dwimask)
+                fixed= bse_crop
+                moving= crop_to_mask(t2masked, tmpdir / ('maskedt2_crop' + TMP_EXT), self.t2mask)
 
             logging.info('3. Compute a rigid registration from the T2 to the DWI baseline')
-            rigid_registration(3, t2masked, bse, t2tobse_rigid)
+            rigid_registration(3, moving, fixed, t2tobse_rigid)
 
-            antsApplyTransforms('-d', '3', '-i', t2masked, '-o', t2inbse, '-r', bse, '-t', affine)
+            antsApplyTransforms('-d', '3', '-i', t2masked, '-o', t2inbse, '-r', bse_file, '-t', affine)
 
 
             logging.info('4. Compute 1d nonlinear registration from the DWI to T2-in-bse along the phase direction')
-            moving = bse
+            moving = bse_file
             fixed = t2inbse
+            if self.crop:
+                moving= bse_crop
+                fixed= crop_to_mask(t2inbse, tmpdir / ('t2inbse_crop' + TMP_EXT), self.dwimask)
             pre = tmpdir / 'epi'
             dwiepi = tmpdir / 'dwiepi.nii.gz'
-            antsRegistration('-d', '3', '-m',
-                             'cc[' + str(fixed) + ',' + str(moving) + ',1,2]', '-t',
-                             'SyN[0.25,3,0]', '-c', '50x50x10', '-f', '4x2x1',
-                             '-s', '2x1x0', '--restrict-deformation', '0x1x0',
-                             '-v', '1', '-o', pre)
-
-            local.path(str(pre) + '0Warp.nii.gz').move(epiwarp)
+            cached_call(antsRegistration['-d', '3', '-m',
+                                         'cc[' + str(fixed) + ',' + str(moving) + ',1,2]', '-t',
+                                         'SyN[0.25,3,0]', '-c', '50x50x10', '-f', '4x2x1',
+                                         '-s', '2x1x0', '--restrict-deformation', '0x1x0',
+                                         '-v', '1', '-o', pre],
+                        inputs= [fixed, moving], outputs= [str(pre) + '0Warp.nii.gz'], fg= False)
+
+            warp= local.path(str(pre) + '0Warp.nii.gz')
+            if self.crop:
+                # the warp of the crops is defined on the cropped grid, resample it on the full bse grid
+                # that the DWI and its mask are warped on
+                ComposeMultiTransform('3', epiwarp, '-R', bse_file, warp)
+            else:
+                warp.move(epiwarp)
 
             logging.info('5. Apply warp to the DWI')
-            check_call((' ').join([pjoin(FILEDIR, 'antsApplyTransformsDWI.py'), '-i', self.dwi, '-m', self.dwimask,
-                                  '-t', epiwarp, '-o', dwiepi, '-n', self.nproc]), shell= True)
+            antsApplyTransformsDWI(self.dwi, epiwarp, dwiepi, self.dwimask, self.nproc)
 
 
             # WarpTimeSeriesImageMultiTransform can also be used
@@ -128,7 +152,7 @@ class App(cli.Application):
             logging.info('6. Apply warp to the DWI mask')
             epimask = self.out._path+'-mask.nii.gz'
             antsApplyTransforms('-d', '3', '-i', self.dwimask, '-o', epimask,
-                                '-n', 'NearestNeighbor', '-r', bse, '-t', epiwarp)
+                                '-n', 'NearestNeighbor', '-r', bse_file, '-t', epiwarp)
             fslmaths(epimask, '-mul', '1', epimask, '-odt', 'char')
 
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory, save_nifti, load_nifti
+from util import logfmt, TemporaryDirectory, save_nifti, load_nifti_lazy
 from plumbum import local, cli, FG
 from plumbum.cmd import UKFTractography
 
 from conversion import nhdr_write
+import numpy as np
 
 import logging
 logger = logging.getLogger()
@@ -48,11 +49,12 @@ class App(cli.Application):
 
             # TODO when UKFTractography supports float32, it should be removed
             # typecast to short
-            short= load_nifti(self.dwi._path)
-            save_nifti(shortdwi._path, short.get_data().astype('int16'), short.affine, short.header)
+            # the data are read through the lazy proxy so that no decoded copy is cached alongside the int16 one
+            short= load_nifti_lazy(self.dwi._path)
+            save_nifti(shortdwi._path, np.asanyarray(short.dataobj).astype('int16'), short.affine, short.header)
 
-            short= load_nifti(self.dwimask._path)
-            save_nifti(shortmask._path, short.get_data().astype('int16'), short.affine, short.header)
+            short= load_nifti_lazy(self.dwimask._path)
+            save_nifti(shortmask._path, np.asanyarray(short.dataobj).astype('int16'), short.affine, short.header)
 
             # convert the dwi to NRRD
             nhdr_write(shortdwi._path, self.bvalFile._path, self.bvecFile._path, tmpdwi._path)
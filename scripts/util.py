@@ -1,10 +1,16 @@
 __version__ = '0.1.3'
 
-from os.path import abspath, dirname, join as pjoin
+from os.path import abspath, dirname, basename, join as pjoin
 import os
-from plumbum import local
+from plumbum import local, FG
 from tempfile import mkdtemp
-import weakref, shutil
+import weakref, shutil, warnings, time, logging
+import struct, zlib, gzip, mmap, hashlib
+from contextlib import contextmanager
+from io import BytesIO
+
+# numpy, nibabel, multiprocessing, and concurrent.futures are imported where they are used,
+# so that importing util, and `script.py -h`, stay fast
 
 FILEDIR= abspath(dirname(__file__))
 LIBDIR= dirname(FILEDIR)
@@ -15,41 +21,751 @@ ROOTDIR= dirname(LIBDIR)
 
 BET_THRESHOLD = '0.25'
 B0_THRESHOLD = 50
-ANTSREG_THREADS = '4'
-N_PROC = '4'
 REPOL_BSHELL_GREATER= 500
 
+
+def available_cpus():
+    '''Number of cores this process can use: its CPU affinity, limited by a cgroup CPU quota if any'''
+
+    try:
+        ncpu= len(os.sched_getaffinity(0))
+    except AttributeError:
+        ncpu= os.cpu_count() or 1
+
+    quota= None
+    try:
+        # cgroup v2: "$MAX $PERIOD" or "max $PERIOD"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            q, period= f.read().split()[:2]
+            if q!='max':
+                quota= int(q)/int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1: quota is -1 when unlimited
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f, \
+                    open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as g:
+                q, period= int(f.read()), int(g.read())
+                if q>0:
+                    quota= q/period
+        except (OSError, ValueError):
+            pass
+
+    if quota:
+        ncpu= min(ncpu, int(-(-quota//1)))
+
+    return max(ncpu, 1)
+
+
+# CPU budget shared by process pools and multi-threaded external tools, PNLPIPE_NCPU overrides the detected cores
+N_CPU= int(os.getenv('PNLPIPE_NCPU', available_cpus()))
+# default number of processes for the scripts' --nproc
+N_PROC= os.getenv('PNLPIPE_NPROC', str(min(4, N_CPU)))
+
+# number of threads given to external tools by the current process, set in the workers of cpu_pool()
+_TASK_THREADS= None
+
+
+def task_threads():
+    '''Number of threads an external tool run by this process may use, its share inside a cpu_pool()'''
+
+    return _TASK_THREADS or N_CPU
+
+
+def thread_env(threads):
+    '''Environment variables that limit ITK/ANTs, OpenMP (FSL), and BLAS threading to threads cores'''
+
+    threads= str(threads)
+    return {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': threads,
+            'OMP_NUM_THREADS': threads,
+            'OPENBLAS_NUM_THREADS': threads,
+            'MKL_NUM_THREADS': threads}
+
+
+def _init_worker(threads):
+
+    global _TASK_THREADS
+    _TASK_THREADS= threads
+    env= thread_env(threads)
+    os.environ.update(env)
+    local.env.update(**env)
+
+
+def cpu_pool(nproc=None, threads=None):
+    '''multiprocessing.Pool of nproc (-1 for all) workers within the CPU budget, with threads each for their tools'''
+
+    budget= task_threads()
+    nproc= budget if nproc is None or int(nproc)==-1 else max(1, min(int(nproc), budget))
+    if threads is None:
+        threads= max(1, budget//nproc)
+
+    import multiprocessing
+    return multiprocessing.Pool(nproc, initializer=_init_worker, initargs=(threads,))
+
+
+def _run_task(threads, fn, args):
+
+    # the task and the external tools it runs can be killed together
+    os.setpgrp()
+    _init_worker(threads)
+    fn(*args)
+
+
+class Task(object):
+
+    def __init__(self, name, fn, args):
+        self.name= name
+        self.fn= fn
+        self.args= args
+        # queued, running, done, failed, or timed out
+        self.status= 'queued'
+        self.attempts= 0
+        # wall time of each attempt
+        self.times= []
+        self.process= None
+        self.start= None
+
+    def __repr__(self):
+        return '<Task {} {}>'.format(self.name, self.status)
+
+
+class TaskManager(object):
+    '''Runs tasks in processes, nproc at a time with threads each, killing and retrying failed or late ones'''
+
+    def __init__(self, nproc=None, threads=None, retries=0, timeout=None):
+
+        budget= task_threads()
+        self.nproc= budget if nproc is None or int(nproc)==-1 else max(1, min(int(nproc), budget))
+        self.threads= threads or max(1, budget//self.nproc)
+        self.retries= retries
+        self.timeout= timeout
+        self.queue= []
+        self.running= []
+        self.tasks= []
+
+    def submit(self, name, fn, *args, front=False):
+        '''Queues fn(*args) as the task name, ahead of the queued tasks if front'''
+
+        task= Task(name, fn, args)
+        self.queue.insert(0 if front else len(self.queue), task)
+        self.tasks.append(task)
+        return task
+
+    def _start(self, task):
+
+        import multiprocessing
+        task.attempts+= 1
+        task.status= 'running'
+        task.process= multiprocessing.Process(target=_run_task, args=(self.threads, task.fn, task.args))
+        task.start= time.time()
+        task.process.start()
+        self.running.append(task)
+
+    def _stop(self, task, status):
+
+        self.running.remove(task)
+        task.times.append(time.time()-task.start)
+        task.process.join()
+        task.process.close()
+        task.process= None
+
+        if status!='done' and task.attempts<=self.retries:
+            logging.warning('{} {} after {:.1f} s, retrying ({}/{})'.format(
+                task.name, status, task.times[-1], task.attempts, self.retries))
+            task.status= 'queued'
+            self.queue.insert(0, task)
+            return False
+
+        task.status= status
+        if status!='done':
+            logging.error('{} {} after {} attempts'.format(task.name, status, task.attempts))
+        return True
+
+    def _kill(self, task):
+
+        import signal
+        try:
+            os.killpg(task.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # killed before it made its process group
+            task.process.kill()
+
+    def finished(self):
+        '''Runs the queued tasks and yields each one once it is done, or has failed or timed out for good'''
+
+        from multiprocessing.connection import wait
+
+        while self.queue or self.running:
+            while self.queue and len(self.running)<self.nproc:
+                self._start(self.queue.pop(0))
+
+            now= time.time()
+            deadline= None
+            if self.timeout:
+                deadline= max(0, min(task.start+self.timeout for task in self.running)-now)
+            wait([task.process.sentinel for task in self.running], deadline)
+
+            now= time.time()
+            for task in list(self.running):
+                if task.process.exitcode is not None:
+                    status= 'done' if task.process.exitcode==0 else 'failed'
+                elif self.timeout and now-task.start>=self.timeout:
+                    self._kill(task)
+                    status= 'timed out'
+                else:
+                    continue
+
+                if self._stop(task, status):
+                    yield task
+
+    def report(self):
+        '''Table of the attempts, wall time, and status of every task'''
+
+        lines= ['{:<48}{:>10}{:>10}  {}'.format('task', 'attempts', 'time (s)', 'status')]
+        for task in self.tasks:
+            lines.append('{:<48}{:>10}{:>10.1f}  {}'.format(task.name, task.attempts, sum(task.times), task.status))
+        return '\n'.join(lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        for task in list(self.running):
+            self._kill(task)
+            task.process.join()
+            self.running.remove(task)
+            task.status= 'killed'
+
+# created on first use by TemporaryDirectory and the caches
 TMPDIR= local.path(os.getenv('PNLPIPE_TMPDIR','/tmp/'))
 # TMPDIR= local.path(os.getenv('PNLPIPE_TMPDIR',pjoin(os.environ['HOME'],'tmp'))
-if not TMPDIR.exists():
-    TMPDIR.mkdir()
 
+# tmpfs preferred by a TemporaryDirectory that declares its expected size, as long as PNLPIPE_RAM_RESERVE GB
+# stay free after it, PNLPIPE_RAMDIR='' disables it
+RAMDIR= os.getenv('PNLPIPE_RAMDIR', '/dev/shm')
+RAM_RESERVE= float(os.getenv('PNLPIPE_RAM_RESERVE', '2'))*1024**3
+
+# PNLPIPE_TRACE=/some/dir records every external command run by the script to /some/dir/<script>-<pid>.jsonl
+if os.getenv('PNLPIPE_TRACE'):
+    from _proctrace import enable_trace
+    enable_trace(os.getenv('PNLPIPE_TRACE'))
+
+# block-parallel gzip for util.save_nifti, PNLPIPE_GZIP_THREADS=1 falls back to nibabel's single-threaded writer
+GZIP_LEVEL= int(os.getenv('PNLPIPE_GZIP_LEVEL', '1'))
+GZIP_THREADS= int(os.getenv('PNLPIPE_GZIP_THREADS', N_PROC))
+GZIP_BLOCK_SIZE= 4*1024*1024
+
+# float images are saved by save_nifti as float32 by default, or as int16/uint16 with scl_slope/scl_inter:
+# PNLPIPE_SCALED_INT=int16|uint16|auto (uint16 for non-negative data, int16 otherwise)
+SCALED_INT= os.getenv('PNLPIPE_SCALED_INT', '')
+
+# intermediate images in TemporaryDirectory are written uncompressed and only final outputs are gzipped,
+# PNLPIPE_TMP_COMPRESS=1 restores gzipped intermediates
+TMP_COMPRESS= os.getenv('PNLPIPE_TMP_COMPRESS', '0')=='1'
+TMP_EXT= '.nii.gz' if TMP_COMPRESS else '.nii'
+TMP_FSLOUTPUTTYPE= 'NIFTI_GZ' if TMP_COMPRESS else 'NIFTI'
+
+# margin (mm) around the bounding box of the brain kept by crop_to_mask() for registrations with --crop
+CROP_PADDING= float(os.getenv('PNLPIPE_CROP_PADDING', '10'))
+
+# content-addressed cache of expensive tool outputs, bounded to PNLPIPE_CACHE_SIZE GB, 0 disables it
+CACHEDIR= TMPDIR / 'pnlpipe_cache'
+CACHE_SIZE= float(os.getenv('PNLPIPE_CACHE_SIZE', '20'))*1024**3
+
+# outputs of antsRegistrationSyN*.sh and conversion.antsUtil.antsReg for a given output prefix
+ANTSREG_OUTPUTS= ['0GenericAffine.mat', '1Warp.nii.gz', '1InverseWarp.nii.gz', 'Warped.nii.gz', 'InverseWarped.nii.gz']
+ANTSREG_RIGID_OUTPUTS= ['0GenericAffine.mat', 'Warped.nii.gz', 'InverseWarped.nii.gz']
+
+
+def _nibabel():
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        import nibabel
+    return nibabel
+
+
+def load_nifti(*args, **kwargs):
+    '''nibabel.load()'''
+    return _nibabel().load(*args, **kwargs)
+
+
+def __getattr__(name):
+    # util.Nifti1Image imports nibabel on first access
+    if name=='Nifti1Image':
+        return _nibabel().Nifti1Image
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def load_nifti_lazy(fname):
+    '''Loads a nifti image without decoding its data: memory-mapped if .nii, a slice-wise proxy if .nii.gz'''
+
+    fname= str(fname)
+    if fname.endswith('.gz'):
+        return load_nifti(fname, keep_file_open=True)
+    else:
+        return load_nifti(fname, mmap='r')
+
+
+def as_nifti(img):
+    '''Returns img itself if it is already a nibabel image, otherwise lazily loads it from the path img'''
+
+    if hasattr(img, 'dataobj'):
+        return img
+    return load_nifti_lazy(img)
+
+
+def iter_volumes(img, idx=None, dtype='float32'):
+    '''Yields the volumes idx (default: all) along the last axis of a 4D image one at a time'''
+
+    if idx is None:
+        idx= range(img.shape[-1])
+
+    import numpy as np
+    for i in idx:
+        yield np.asarray(img.dataobj[..., int(i)], dtype=dtype)
 
-import warnings
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=FutureWarning)
-    from nibabel import load as load_nifti, Nifti1Image
 
+def read_volumes(img, idx, dtype='float32'):
+    '''Reads only the volumes idx along the last axis of a 4D image into an array of shape (X,Y,Z,len(idx))'''
+
+    import numpy as np
+    data= np.zeros(img.shape[:3]+(len(idx),), dtype=dtype)
+    for j, vol in enumerate(iter_volumes(img, idx, dtype)):
+        data[..., j]= vol
+
+    return data
+
+
+def crop_to_mask(img, out, mask=None, padding=None):
+    '''Crops a 3D image to the bounding box of mask, or of its foreground, padded by padding mm, into out'''
+
+    import numpy as np
+    img= as_nifti(img)
+    data= np.asanyarray(img.dataobj)
+    if mask is not None:
+        inside= np.asanyarray(as_nifti(mask).dataobj)>0
+    else:
+        # a fast threshold that leaves out the background noise
+        positive= data[data>0]
+        inside= data>0.1*np.percentile(positive, 99) if positive.size else data>0
+
+    if not inside.any():
+        inside= np.ones(data.shape, dtype=bool)
+
+    pad= np.ceil((CROP_PADDING if padding is None else padding)/np.array(img.header.get_zooms()[:3])).astype(int)
+    box= []
+    for axis in range(3):
+        idx= np.flatnonzero(inside.any(axis=tuple(a for a in range(3) if a!=axis)))
+        box.append(slice(max(idx[0]-pad[axis], 0), min(idx[-1]+pad[axis]+1, data.shape[axis])))
+
+    crop= img.slicer[tuple(box)]
+    save_nifti(out, np.asanyarray(crop.dataobj), crop.affine, crop.header.copy())
+
+    return out
+
+
+def scaled_int_dtype(data, scaled):
+    '''On-disk integer type for saving float data with scl_slope/scl_inter, None to keep float32'''
+
+    import numpy as np
+    if not scaled or data.size==0:
+        return None
+
+    lo, hi= np.min(data), np.max(data)
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        # nan/inf cannot be represented
+        return None
+
+    if scaled=='auto':
+        scaled= 'uint16' if lo>=0 else 'int16'
+    elif scaled=='uint16' and lo<0:
+        scaled= 'int16'
+
+    return np.dtype(scaled)
+
+
+def save_nifti(fname, data, affine, hdr=None, scaled=None):
+    '''Saves data as uint8/int16 if of that type, else as float32 or as scaled, see scaled_int_dtype()'''
+
+    import numpy as np
+    data= np.asanyarray(data)
+    int_dtype= None
+    if data.dtype.name not in ['uint8', 'int16']:
+        int_dtype= scaled_int_dtype(data, SCALED_INT if scaled is None else scaled)
 
-def save_nifti(fname, data, affine, hdr=None):
     if data.dtype.name=='uint8':
         hdr.set_data_dtype('uint8')
     elif data.dtype.name=='int16':
         hdr.set_data_dtype('int16')
+    elif int_dtype:
+        hdr.set_data_dtype(int_dtype)
+        info= np.iinfo(int_dtype)
+        if np.min(data)>=info.min and np.max(data)<=info.max and np.array_equal(data, np.round(data)):
+            # lossless, nibabel writes integer arrays unscaled
+            data= data.astype(int_dtype)
     else:
         hdr.set_data_dtype('float32')
 
-    result_img = Nifti1Image(data, affine, header=hdr)
-    result_img.to_filename(fname)
+    result_img = _nibabel().Nifti1Image(data, affine, header=hdr)
 
+    if str(fname).endswith('.gz') and GZIP_THREADS>1:
+        _to_filename_parallel_gz(result_img, str(fname))
+    else:
+        result_img.to_filename(fname)
 
-def logfmt(scriptname):
-    return '%(asctime)s ' + scriptname + ' %(levelname)s  %(message)s'
 
-import psutil
-N_CPU= psutil.cpu_count()
+# Each block of the serialized nifti is deflated independently into its own gzip member, pigz style.
+# Concatenated gzip members are standard gzip (RFC 1952), so nibabel, FSL, and gunzip read the output as usual.
+# Like BGZF, every member carries its compressed size in an extra header subfield ('PN'),
+# which lets load_nifti_parallel() locate and inflate the members concurrently.
+_GZIP_MEMBER_HEADER= struct.Struct('<4BIBBHBBHI')
+_GZIP_MEMBER_TRAILER= struct.Struct('<II')
+
+def _gzip_member(block, level):
+
+    deflate= zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata= deflate.compress(block) + deflate.flush()
+    size= _GZIP_MEMBER_HEADER.size + len(cdata) + _GZIP_MEMBER_TRAILER.size
+
+    # ID1 ID2 CM FLG(FEXTRA) MTIME XFL OS(unknown) XLEN SI1 SI2 LEN member-size
+    header= _GZIP_MEMBER_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 255, 8, ord('P'), ord('N'), 4, size)
+    trailer= _GZIP_MEMBER_TRAILER.pack(zlib.crc32(block) & 0xffffffff, len(block) & 0xffffffff)
+
+    return header + cdata + trailer
 
 
+def _write_parallel_gz(buf, fname, level=None, threads=None):
+
+    level= GZIP_LEVEL if level is None else level
+    threads= GZIP_THREADS if threads is None else threads
+
+    blocks= [buf[i:i+GZIP_BLOCK_SIZE] for i in range(0, len(buf), GZIP_BLOCK_SIZE)]
+
+    # zlib releases the GIL while compressing, so threads are enough
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max(threads, 1)) as executor, open(fname, 'wb') as f:
+        for member in executor.map(lambda block: _gzip_member(block, level), blocks):
+            f.write(member)
+
+    del blocks
+
+
+def _to_filename_parallel_gz(img, fname, level=None, threads=None):
+
+    # serialize the uncompressed nifti in memory
+    raw= BytesIO()
+    file_map= img.make_file_map()
+    file_map['image'].fileobj= raw
+    img.to_file_map(file_map)
+    buf= raw.getbuffer()
+
+    _write_parallel_gz(buf, fname, level, threads)
+
+    del buf
+
+
+def _inflate_member(member):
+
+    xlen= struct.unpack_from('<H', member, 10)[0]
+    return zlib.decompress(member[12+xlen:-_GZIP_MEMBER_TRAILER.size], -zlib.MAX_WBITS)
+
+
+def _parallel_member(buf, offset):
+    '''Size of the gzip member written by _gzip_member() at offset of buf, None if there is none'''
+
+    try:
+        (id1, id2, _, flg, _, _, _, _, si1, si2, _, size)= _GZIP_MEMBER_HEADER.unpack_from(buf, offset)
+    except struct.error:
+        return None
+
+    if (id1, id2, flg, si1, si2)!=(0x1f, 0x8b, 4, ord('P'), ord('N')):
+        return None
+    return size
+
+
+def load_nifti_parallel(fname, threads=None):
+    '''Loads a .nii.gz written by save_nifti() in block-parallel mode, any other file through nibabel'''
+
+    fname= str(fname)
+    threads= GZIP_THREADS if threads is None else threads
+
+    # files of other writers are left to nibabel before they are read whole
+    with open(fname, 'rb') as f:
+        head= f.read(_GZIP_MEMBER_HEADER.size)
+        if not _parallel_member(head, 0):
+            return load_nifti(fname)
+        cdata= memoryview(head+f.read())
+
+    members= []
+    offset= 0
+    while offset < len(cdata):
+        size= _parallel_member(cdata, offset)
+        if not size:
+            return load_nifti(fname)
+
+        members.append(cdata[offset:offset+size])
+        offset+= size
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(threads) as executor:
+        raw= b''.join(executor.map(_inflate_member, members))
+
+    Nifti1Image= _nibabel().Nifti1Image
+    file_map= Nifti1Image.make_file_map()
+    file_map['image'].fileobj= BytesIO(raw)
+
+    return Nifti1Image.from_file_map(file_map)
+
+
+@contextmanager
+def intermediate_env():
+    '''Within this context, FSL tools and the scripts they call write their outputs as TMP_FSLOUTPUTTYPE'''
+
+    prev= os.environ.get('FSLOUTPUTTYPE')
+    os.environ['FSLOUTPUTTYPE']= TMP_FSLOUTPUTTYPE
+    try:
+        with local.env(FSLOUTPUTTYPE=TMP_FSLOUTPUTTYPE):
+            yield
+    finally:
+        if prev is None:
+            del os.environ['FSLOUTPUTTYPE']
+        else:
+            os.environ['FSLOUTPUTTYPE']= prev
+
+
+def compress_nifti(src, dst):
+    '''Copies an intermediate nifti src to the final output dst, gzip compressing on the way if dst is a .nii.gz'''
+
+    src= str(src)
+    dst= str(dst)
+
+    if dst.endswith('.gz') and not src.endswith('.gz'):
+        with open(src, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            _write_parallel_gz(memoryview(buf), dst)
+
+    elif src.endswith('.gz') and not dst.endswith('.gz'):
+        with gzip.open(src, 'rb') as fr, open(dst, 'wb') as fw:
+            shutil.copyfileobj(fr, fw)
+
+    else:
+        shutil.copyfile(src, dst)
+
+
+def compress_niftis(directory, pattern='*.nii'):
+    '''Replaces every uncompressed .nii in directory matching pattern by its .nii.gz'''
+
+    for nii in local.path(directory) // pattern:
+        if not nii.name.endswith('.nii'):
+            continue
+        compress_nifti(nii, nii+'.gz')
+        nii.delete()
+
+
+def fsl_ext():
+    '''Extension that FSL tools give to their outputs under the current FSLOUTPUTTYPE'''
+
+    return '.nii' if local.env.get('FSLOUTPUTTYPE')=='NIFTI' else '.nii.gz'
+
+
+def tool_identity(tool):
+    '''Identifies the version of an executable by its resolved path, size, and modification time'''
+
+    path= str(tool) if os.path.isabs(str(tool)) else str(local.which(str(tool)))
+    st= os.stat(path)
+    return f'{path}:{st.st_size}:{int(st.st_mtime)}'
+
+
+def cache_key(argv, inputs, outputs, version=''):
+    '''Hash of argv, the tool version, and the input contents, independent of input and output directory names'''
+
+    h= hashlib.sha256()
+
+    subs= [(str(p), f'<in{i}>') for i, p in enumerate(inputs)] + \
+          [(d, '<out>') for d in set(dirname(str(p)) for p in outputs) if d]
+    subs.sort(key=lambda x: len(x[0]), reverse=True)
+
+    for arg in argv:
+        arg= str(arg)
+        for p, placeholder in subs:
+            arg= arg.replace(p, placeholder)
+        h.update(arg.encode()+b'\0')
+
+    h.update(version.encode())
+
+    for p in inputs:
+        h.update(b'\0')
+        with open(str(p), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
+# bytes this process believes the cache holds, the cache is only rescanned when that goes over CACHE_SIZE
+_cache_total= None
+# eviction frees the cache down to this fraction of CACHE_SIZE, so that stores do not rescan it each time
+CACHE_LOW_WATER= 0.9
+# age (s) after which a *.tmp entry left by an interrupted store is removed
+CACHE_TMP_AGE= 3600
+
+
+def _entry_size(entry):
+    '''Size of a cache entry, None if another process removed it meanwhile'''
+
+    try:
+        return sum(f.stat().st_size for f in entry.list())
+    except FileNotFoundError:
+        return None
+
+
+def _cache_scan():
+    '''[(mtime, size, entry)] of the complete cache entries, removing stale temporary ones'''
+
+    entries= []
+    now= time.time()
+    for entry in CACHEDIR.list():
+        try:
+            mtime= entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith('.tmp'):
+            if now-mtime>CACHE_TMP_AGE:
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        size= _entry_size(entry)
+        if size is not None:
+            entries.append((mtime, size, entry))
+
+    return entries
+
+
+def _cache_evict(added):
+
+    global _cache_total
+
+    if _cache_total is not None:
+        _cache_total+= added
+        if _cache_total<=CACHE_SIZE:
+            return
+
+    entries= _cache_scan()
+    total= sum(size for _, size, _ in entries)
+    if total>CACHE_SIZE:
+        # least recently used first
+        for _, size, entry in sorted(entries, key=lambda x: x[0]):
+            if total<=CACHE_LOW_WATER*CACHE_SIZE:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total-= size
+
+    _cache_total= total
+
+
+def _cache_restore(entry, outputs):
+    '''Copies the outputs back from a cache entry, False if it is missing or another process removed it'''
+
+    try:
+        for i, out in enumerate(outputs):
+            shutil.copyfile(entry / '{}_{}'.format(i, basename(str(out))), str(out))
+        os.utime(entry)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def cached(run, argv, inputs, outputs, version=''):
+    '''Calls run(), which must create every file in outputs, unless the outputs of an identical call are cached'''
+
+    if CACHE_SIZE<=0:
+        return run()
+
+    key= cache_key(argv, inputs, outputs, version)
+    entry= CACHEDIR / key
+
+    if _cache_restore(entry, outputs):
+        logging.info('Reusing cached outputs of {}'.format(basename(str(argv[0]))))
+        return
+
+    run()
+
+    if not all(os.path.exists(str(out)) for out in outputs):
+        return
+
+    # populate under a temporary name and rename, so a concurrent process never sees a partial entry
+    CACHEDIR.mkdir()
+    tmp= mkdtemp(suffix='.tmp', prefix=key, dir=CACHEDIR)
+    for i, out in enumerate(outputs):
+        shutil.copyfile(str(out), pjoin(tmp, '{}_{}'.format(i, basename(str(out)))))
+    added= sum(os.path.getsize(str(out)) for out in outputs)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        added= 0
+
+    _cache_evict(added)
+
+
+def cached_call(cmd, inputs, outputs, version=None, fg=True):
+    '''Runs a bound plumbum command through the cache, see cached()'''
+
+    argv= cmd.formulate()
+    if version is None:
+        version= tool_identity(argv[0])
+
+    if fg:
+        run= lambda: cmd & FG
+    else:
+        run= cmd
+
+    cached(run, argv, inputs, outputs, version)
+
+
+def nifti_nbytes(fname, dtype=None):
+    '''Size of the uncompressed data of a nifti image, of data type dtype if given, read from its header only'''
+
+    import numpy as np
+    hdr= load_nifti(str(fname)).header
+    return int(np.prod(hdr.get_data_shape()))*np.dtype(dtype or hdr.get_data_dtype()).itemsize
+
+
+def disk_usage(path):
+    '''Bytes allocated by the files under path'''
+
+    total= 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total+= os.lstat(pjoin(root, name)).st_blocks*512
+            except OSError:
+                pass
+    return total
+
+
+# live TemporaryDirectory objects of this process, their disk usage is measured only when another one is placed
+# and at cleanup, a sampling thread would be inherited mid-operation by the forked workers of cpu_pool(),
+# so the largest usage measured is not the peak, and files deleted in between are never counted
+_tmpdirs= {}
+
+
+def _tmp_parent(expected_size):
+    '''RAMDIR if expected_size bytes fit there besides its other tmpdirs and RAM_RESERVE, else TMPDIR'''
+
+    if expected_size and RAMDIR and os.path.isdir(RAMDIR):
+        reserved= 0
+        for t in list(_tmpdirs.values()):
+            if t.parent==RAMDIR:
+                t.measured= max(t.measured, disk_usage(t.name))
+                reserved+= max(t.expected_size-t.measured, 0)
+        if shutil.disk_usage(RAMDIR).free-reserved-expected_size > RAM_RESERVE:
+            return RAMDIR
+
+    return str(TMPDIR)
+
+
+def logfmt(scriptname):
+    return '%(asctime)s ' + scriptname + ' %(levelname)s  %(message)s'
+
 # the following context manager is copied from https://github.com/python/cpython/blob/master/Lib/tempfile.py#L762
 class TemporaryDirectory(object):
     """Create and return a temporary directory.  This has the same
@@ -59,14 +775,23 @@ class TemporaryDirectory(object):
             ...
     Upon exiting the context, the directory and everything contained
     in it are removed.
+    Without dir, it is created on RAMDIR if expected_size bytes fit there, in TMPDIR otherwise. Only this
+    placement is managed: a directory on RAMDIR stays there even if RAMDIR fills up afterwards.
     """
 
-    def __init__(self, suffix=None, prefix=None, dir=TMPDIR):
-        self.name = mkdtemp(suffix, prefix, dir)
+    def __init__(self, suffix=None, prefix=None, dir=None, expected_size=0):
+        self.parent= dir or _tmp_parent(expected_size)
+        self.expected_size= expected_size
+        self.measured= 0
+
+        os.makedirs(self.parent, exist_ok=True)
+        self.name = mkdtemp(suffix, prefix, self.parent)
         self._finalizer = weakref.finalize(
             self, self._cleanup, self.name,
             warn_message="Implicitly cleaning up {!r}".format(self))
 
+        _tmpdirs[self.name]= self
+
     @classmethod
     def _rmtree(cls, name):
         def onerror(func, path, exc_info):
@@ -99,6 +824,7 @@ class TemporaryDirectory(object):
 
     @classmethod
     def _cleanup(cls, name, warn_message):
+        _tmpdirs.pop(name, None)
         cls._rmtree(name)
         warnings.warn(warn_message, ResourceWarning)
 
@@ -113,5 +839,7 @@ class TemporaryDirectory(object):
 
     def cleanup(self):
         if self._finalizer.detach():
+            _tmpdirs.pop(self.name, None)
+            logging.info('{}: usage at cleanup {:.1f} MB'.format(self.name, disk_usage(self.name)/1024**2))
             self._rmtree(self.name)
 
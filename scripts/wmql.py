@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from util import logfmt, TemporaryDirectory, FILEDIR, pjoin, N_PROC, FILEDIR
+from util import logfmt, TemporaryDirectory, FILEDIR, pjoin, N_PROC, FILEDIR, cpu_pool
 from plumbum import local, cli, FG
 from subprocess import check_call
-from multiprocessing import Pool
 
 import logging
 logger = logging.getLogger()
@@ -73,7 +72,7 @@ class App(cli.Application):
             logging.info('Convert vtk field data to tensor data')
 
             # use the following multi-processed loop
-            pool= Pool(int(self.nproc))
+            pool= cpu_pool(self.nproc)
             pool.map_async(_activateTensors_py, self.out.glob('*.vtk'))
             pool.close()
             pool.join()